@@ -0,0 +1,477 @@
+"""
+ACQUISITION SERVER
+
+Python counterpart of stimDecodingServer.m. It speaks the same TCP protocol
+(communication/tcpProtocol) to client_shapes.py: it uploads the pseudorandom
+schedule of the session, starts every trial with a GO token and waits for the
+ACK of the client.
+
+Frames are acquired from a camera backend (see cameras) by a producer thread
+that fills a preallocated FrameRingBuffer. As in the MATLAB server, by default
+the camera is armed before every trial and stopped once the nFrames frames of
+the trial have been acquired. In continuous mode the camera is instead started
+once for the whole session, and every trial is cut out of the stream as a
+window of nFrames frames (preFrames of them before the event) around the
+trigger, located from the ACK of the client (see epoching). The movie of the
+trial is then handed to a consumer thread
+that runs the trial processors (e.g. binning, saving, preview), so that the
+next trial can start while the previous one is processed. A processor that
+raises is reported (processingErrors) and the next trials are still processed. A trial processor
+is any callable processor(entry, ack, movie, timestamps), where entry is the
+schedule entry of the trial and ack the decoded ACK of the client.
+
+The time spent in every stage of every trial is recorded in trialTimings and
+summarized by timingReport(), to profile where the per-trial seconds go.
+
+The timing of every trial (dropped frames, reversal and trigger delays, see
+trialQC) is checked as soon as its ACK arrives. The result is added to the
+schedule entry of the trial ('qc'), and so to the metadata saved by the
+stores, and a trial that fails is repeated later in the session: a new trial
+with the same stimulus is inserted among the remaining ones and sent to the
+client with a SCHEDULE message.
+
+Run a session with a synthetic camera and a simulated stimulation client
+(e.g. on a CI machine) with:
+    python -m acquisition.acquisitionServer --simulate-client
+"""
+
+import json
+import queue
+import socket
+import threading
+from time import perf_counter, sleep
+import numpy as np
+
+from acquisition.cameras import openCamera
+from acquisition.epoching import Epoch, Epocher, ackEventTime
+from acquisition.ringBuffer import FrameRingBuffer
+from acquisition.trialQC import TrialQC
+from communication.tcpProtocol import MessageBuffer, encodeMessage
+
+DEFAULT_SETTINGS = {
+    'stimuli': ['circle', 'cross', 'triangle'],
+    'repetitions': 40,
+    'nFrames': 60,                  # Frames acquired per trial
+    'address': '0.0.0.0',           # Address the server listens on
+    'port': 40000,
+    'camera': 'synthetic',          # Camera backend (see cameras.CAMERA_BACKENDS)
+    'cameraParams': {},             # Parameters of the camera backend
+    'ringCapacity': 256,            # Frames kept in the ring buffer
+    'armPause': 0,                  # Seconds between arming the camera and GO
+    'ackTimeout': 30,               # Max seconds between GO and the ACK
+    'frameTimeout': 5,              # Max seconds between the ACK and the last frame
+    'seed': None,                   # Seed of the pseudorandom sequence
+    'continuous': False,            # Acquire continuously and epoch the trials
+    'preFrames': 5,                 # Continuous mode: frames of the window before the event
+    'epochEvent': 'triggerTime',    # Continuous mode: ACK time the windows are aligned to
+    'qc': {},                       # QC thresholds (see trialQC), None: no quality control
+    'reschedule': True,             # Repeat the trials that fail the quality control
+    'maxRepeats': 2,                # Max repetitions of a failed trial
+    'clientConfig': None,           # Optional session config sent to the client (CONFIG)
+}
+
+
+def pseudorandomSequence(elements, repetitions, rng=None):
+    # Python version of pseudorandomSequence.m: every repetition is a random
+    # permutation of all the elements
+    rng = np.random.default_rng(rng)
+    sequence = []
+    for _ in range(repetitions):
+        sequence.extend(elements[i] for i in rng.permutation(len(elements)))
+    return sequence
+
+
+class Acquisition:
+    def __init__(self, camera, capacity):
+        # Producer side: a thread grabbing the frames of the camera directly
+        # into the ring buffer
+        self.camera = camera
+        self.ringBuffer = FrameRingBuffer(capacity, camera.frameShape, camera.dtype)
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._running.is_set():
+            return
+        self._running.set()
+        self.camera.start()
+        self._thread = threading.Thread(target=self._produce, name='Acquisition',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.camera.stop()
+
+    @property
+    def isRunning(self):
+        return self._running.is_set()
+
+    def _produce(self):
+        ringBuffer = self.ringBuffer
+        while self._running.is_set():
+            timestamp = self.camera.grab(ringBuffer.nextSlot())
+            ringBuffer.commit(timestamp)
+
+
+class AcquisitionServer:
+    def __init__(self, settings=None, processors=()):
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.processors = list(processors)
+        self.camera = openCamera(self.settings['camera'], **self.settings['cameraParams'])
+        self.acquisition = Acquisition(self.camera, self.settings['ringCapacity'])
+        self.epocher = Epocher(self.acquisition.ringBuffer, self.settings['preFrames'],
+                               self.settings['nFrames'] - self.settings['preFrames'])
+        self.qc = None
+        if self.settings['qc'] is not None:
+            self.qc = TrialQC(self.settings['qc'], self.settings['maxRepeats'])
+
+        self.schedule = []
+        self.acks = {}              # trial index -> decoded ACK
+        self.trialTimings = []      # one dict of stage durations per trial
+        self.processingErrors = []  # (trial, processor, exception) of the failed processors
+        self._conn = None
+        self._rxBuffer = MessageBuffer()
+        self._received = []         # (message, reception time) not yet consumed
+        self._processQueue = queue.Queue()
+        self._consumer = None
+
+    #---------------------------------------------------------------------------
+    #--- CONNECTION
+    #---------------------------------------------------------------------------
+
+    def listen(self):
+        # Opens the server socket. Returns the port (useful with port 0)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.settings['address'], self.settings['port']))
+        self._server.listen(1)
+        return self._server.getsockname()[1]
+
+    def accept(self):
+        print('Waiting for connection from clients...')
+        self._conn, address = self._server.accept()
+        # A partial line of a previous connection is dropped
+        self._rxBuffer = MessageBuffer()
+        print(f'Client connected from {address[0]}')
+
+    def send(self, msgType, trial=0, payload=''):
+        self._conn.sendall(encodeMessage(msgType, trial, payload))
+
+    def waitForMessage(self, msgType, trial, timeout):
+        # Reads messages until the one of the given type and trial arrives.
+        # Returns it with the time it was received, or (None, None) on timeout
+        # or if the client reports an ERROR for the trial.
+        deadline = perf_counter() + timeout
+        failed = False
+        while not failed:
+            for i, (msg, receivedAt) in enumerate(self._received):
+                if msg.type == msgType and msg.trial == trial:
+                    return self._received.pop(i)
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                return None, None
+            self._conn.settimeout(remaining)
+            try:
+                data = self._conn.recv(4096)
+            except socket.timeout:
+                return None, None
+            receivedAt = perf_counter()
+            if not data:
+                raise ConnectionError('Connection closed by the client')
+            for msg in self._rxBuffer.feed(data):
+                if msg.type == 'ERROR':
+                    error = json.loads(msg.payload)
+                    print(f"\nWARNING: the client could not apply {error['command']}: "
+                          f"{error['error']}")
+                    failed = failed or (trial != 0 and msg.trial == trial)
+                    continue
+                self._received.append((msg, receivedAt))
+        return None, None
+
+    #---------------------------------------------------------------------------
+    #--- SESSION
+    #---------------------------------------------------------------------------
+
+    def run(self):
+        # Runs a whole session with the connected client
+        settings = self.settings
+        rng = np.random.default_rng(settings['seed'])
+        stimList = pseudorandomSequence(settings['stimuli'], settings['repetitions'], rng)
+        seeds = rng.integers(2**31 - 1, size=len(stimList))
+        self.schedule = [{'trial': i+1, 'shape': shape, 'seed': int(seed)}
+                         for i, (shape, seed) in enumerate(zip(stimList, seeds))]
+        if settings['clientConfig'] is not None:
+            self.send('CONFIG', 0, json.dumps(settings['clientConfig']))
+        self.send('SCHEDULE', 0, json.dumps(self.schedule))
+        if self.qc is not None:
+            self.qc.rng = rng
+
+        self._consumer = threading.Thread(target=self._consume, name='TrialProcessing',
+                                          daemon=True)
+        self._consumer.start()
+        sessionStart = perf_counter()
+        if settings['continuous']:
+            # Frames for the window before the first trigger
+            self.acquisition.start()
+            self.acquisition.ringBuffer.waitForFrames(settings['preFrames'],
+                                                      settings['frameTimeout'])
+        # The schedule can grow during the session (rescheduled trials)
+        position = 0
+        while position < len(self.schedule):
+            entry = self.schedule[position]
+            print(f"Trial {entry['trial']} [{position+1}/{len(self.schedule)}] {entry['shape']}...",
+                  end=' ', flush=True)
+            if settings['continuous']:
+                self.runContinuousTrial(entry)
+            else:
+                self.runTrial(entry)
+            print(self.rescheduleFailed(position, entry))
+            position += 1
+        self.acquisition.stop()
+        self._processQueue.put(None)
+        self._consumer.join()
+        self.send('STOP')
+        print(f'END OF RECORDING ({perf_counter() - sessionStart:.1f} s).')
+        return self.timingReport()
+
+    def runTrial(self, entry):
+        settings = self.settings
+        ringBuffer = self.acquisition.ringBuffer
+        timing = {'trial': entry['trial']}
+        t = perf_counter()
+
+        # Arm the camera
+        self.acquisition.start()
+        firstFrame = ringBuffer.framesWritten
+        if settings['armPause']:
+            sleep(settings['armPause'])
+        timing['arm'] = perf_counter() - t; t = perf_counter()
+
+        # Start the trial and wait for its end
+        self.send('GO', entry['trial'])
+        ack, _ = self.waitForAck(entry['trial'])
+        timing['stimulation'] = perf_counter() - t; t = perf_counter()
+
+        # Wait for the last frames of the trial and disarm the camera
+        lastFrame = firstFrame + settings['nFrames']
+        complete = ringBuffer.waitForFrames(lastFrame, settings['frameTimeout'])
+        self.acquisition.stop()
+        timing['frames'] = perf_counter() - t; t = perf_counter()
+
+        self.qualityControl(entry, ack, complete)
+        if complete:
+            movie = ringBuffer.get(firstFrame, lastFrame)
+            timestamps = ringBuffer.getTimestamps(firstFrame, lastFrame)
+            self._processQueue.put((entry, ack, movie, timestamps, timing))
+        timing['copy'] = perf_counter() - t
+        timing['complete'] = complete
+        timing['acked'] = ack is not None
+        self.trialTimings.append(timing)
+
+    def runContinuousTrial(self, entry):
+        # The camera keeps running: the trial is cut out of the stream around
+        # its trigger. The frames are only copied by the consumer thread.
+        settings = self.settings
+        timing = {'trial': entry['trial'], 'arm': 0.}
+        t = perf_counter()
+
+        self.send('GO', entry['trial'])
+        ack, receivedAt = self.waitForAck(entry['trial'])
+        timing['stimulation'] = perf_counter() - t; t = perf_counter()
+
+        epoch = None
+        if ack is not None:
+            eventTime = ackEventTime(ack, receivedAt, settings['epochEvent'])
+            epoch = self.epocher.waitForEpoch(eventTime, settings['frameTimeout'])
+        timing['frames'] = perf_counter() - t; t = perf_counter()
+
+        self.qualityControl(entry, ack, epoch is not None)
+        if epoch is not None:
+            self._processQueue.put((entry, ack, epoch, None, timing))
+        timing['copy'] = perf_counter() - t
+        timing['complete'] = epoch is not None
+        timing['acked'] = ack is not None
+        self.trialTimings.append(timing)
+
+    def waitForAck(self, trial):
+        msg, receivedAt = self.waitForMessage('ACK', trial, self.settings['ackTimeout'])
+        ack = json.loads(msg.payload) if msg is not None else None
+        self.acks[trial] = ack
+        return ack, receivedAt
+
+    def qualityControl(self, entry, ack, complete):
+        # Adds the result of the quality control to the entry of the trial,
+        # before it goes to the trial processors
+        if self.qc is not None:
+            entry['qc'] = self.qc.evaluate(entry['trial'], ack, complete)
+
+    def rescheduleFailed(self, position, entry):
+        # Repeats the trial later in the session if it failed the quality
+        # control. Returns the outcome of the trial, for the console.
+        qc = entry.get('qc')
+        if qc is None or qc['passed']:
+            return 'done.'
+        outcome = f"done, failed QC ({', '.join(qc['failures'])})"
+        if not self.settings['reschedule']:
+            return outcome + '.'
+        newEntry = self.qc.reschedule(self.schedule, position, entry)
+        if newEntry is None:
+            return outcome + ', not repeated (max repeats).'
+        self.send('SCHEDULE', 0, json.dumps([newEntry]))
+        return outcome + f", repeated as trial {newEntry['trial']}."
+
+    def _consume(self):
+        # Consumer thread: runs the trial processors on every acquired trial
+        while True:
+            item = self._processQueue.get()
+            if item is None:
+                return
+            entry, ack, movie, timestamps, timing = item
+            t = perf_counter()
+            if isinstance(movie, Epoch):
+                # Continuous mode: copy the window out of the ring buffer
+                try:
+                    timestamps = movie.timestamps
+                    movie = movie.copy()
+                except IndexError as e:
+                    print(f"Trial {entry['trial']} lost: {e}")
+                    timing['complete'] = False
+                    continue
+            # A processor that fails is reported and skipped for this trial
+            # only, so that the following trials are still processed
+            for processor in self.processors:
+                try:
+                    processor(entry, ack, movie, timestamps)
+                except Exception as e:
+                    name = getattr(processor, '__name__', type(processor).__name__)
+                    print(f"\nWARNING: {name} failed on trial {entry['trial']}: {e!r}")
+                    self.processingErrors.append((entry['trial'], name, e))
+            timing['processing'] = perf_counter() - t
+
+    def timingReport(self):
+        # Mean and max duration (seconds) of every stage over the trials
+        stages = ['arm', 'stimulation', 'frames', 'copy', 'processing']
+        report = {}
+        for stage in stages:
+            values = np.array([t[stage] for t in self.trialTimings if stage in t])
+            if values.size:
+                report[stage] = {'mean': float(values.mean()), 'max': float(values.max())}
+        report['trials'] = len(self.trialTimings)
+        report['incomplete'] = sum(not t['complete'] for t in self.trialTimings)
+        report['missingAck'] = sum(not t['acked'] for t in self.trialTimings)
+        report['processingErrors'] = len(self.processingErrors)
+        if self.qc is not None:
+            report['qc'] = self.qc.summary()
+        return report
+
+    def close(self):
+        self.acquisition.stop()
+        for processor in self.processors:
+            if hasattr(processor, 'close'):
+                processor.close()
+        if self._conn is not None:
+            self._conn.close()
+        self._server.close()
+
+
+def printTimingReport(report):
+    print(f"{report['trials']} trials ({report['incomplete']} incomplete, "
+          f"{report['missingAck']} without ACK, "
+          f"{report['processingErrors']} processing errors)")
+    if 'qc' in report:
+        qc = report['qc']
+        failures = ', '.join(f'{name}: {n}' for name, n in qc['failures'].items())
+        print(f"  QC: {qc['failed']} failed{f' ({failures})' if failures else ''}, "
+              f"{qc['rescheduled']} repeated")
+    for stage, values in report.items():
+        if isinstance(values, dict) and 'mean' in values:
+            print(f"  {stage:<12} mean {1e3*values['mean']:9.1f} ms   "
+                  f"max {1e3*values['max']:9.1f} ms")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--port', type=int, default=DEFAULT_SETTINGS['port'])
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=30, help='frames per trial')
+    parser.add_argument('--frame-rate', type=float, default=20)
+    parser.add_argument('--resolution', type=int, nargs=2, default=(512, 512))
+    parser.add_argument('--continuous', action='store_true',
+                        help='acquire continuously and epoch the trials')
+    parser.add_argument('--save', metavar='FOLDER',
+                        help='save the raw movies in a MovieStore in this folder')
+    parser.add_argument('--compress', action='store_true',
+                        help='save the raw movies compressed (CompressedMovieStore)')
+    parser.add_argument('--bin', type=int, default=1, metavar='FACTOR',
+                        help='spatial binning of the movies before processing')
+    parser.add_argument('--decode', action='store_true',
+                        help='decode the stimulus of every trial online')
+    parser.add_argument('--pca', metavar='FILE',
+                        help='saved PCA basis of the decoder features (see pcaFeatures)')
+    parser.add_argument('--client-config', metavar='FILE',
+                        help='session config (JSON/TOML) sent to the client with CONFIG')
+    parser.add_argument('--no-reschedule', action='store_true',
+                        help='only flag the trials that fail the quality control')
+    parser.add_argument('--simulate-client', action='store_true',
+                        help='run a simulated stimulation client in the same process')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='fraction of the simulated trials that drop frames')
+    args = parser.parse_args()
+
+    processors = []
+    dtype = np.uint16 if args.bin == 1 else np.uint32
+    if args.save and args.compress:
+        from acquisition.compressedStore import CompressedMovieStore
+        processors.append(CompressedMovieStore(args.save, dtype=dtype))
+    elif args.save:
+        from acquisition.movieStore import MovieStore
+        processors.append(MovieStore(args.save, dtype=dtype))
+    decoder = None
+    if args.decode:
+        from analysis.onlineDecoder import OnlineDecoder
+        transform = None
+        if args.pca:
+            from analysis.pcaFeatures import IncrementalPCA
+            transform = IncrementalPCA.load(args.pca)
+        decoder = OnlineDecoder(DEFAULT_SETTINGS['stimuli'], pooling=4 // args.bin or 1,
+                                transform=transform)
+        processors.append(decoder)
+    if args.bin > 1:
+        from acquisition.binning import Binned
+        processors = [Binned(processors, spatial=args.bin)]
+
+    clientConfig = None
+    if args.client_config:
+        from stimuli.sessionConfig import readConfigFile
+        clientConfig = readConfigFile(args.client_config)
+
+    server = AcquisitionServer({
+        'port': args.port,
+        'repetitions': args.repetitions,
+        'nFrames': args.frames,
+        'continuous': args.continuous,
+        'reschedule': not args.no_reschedule,
+        'clientConfig': clientConfig,
+        'cameraParams': {'frameShape': tuple(args.resolution),
+                         'frameRate': args.frame_rate},
+    }, processors)
+    port = server.listen()
+    if args.simulate_client:
+        from acquisition.simulatedClient import SimulatedStimulusClient
+        trialDuration = args.frames / args.frame_rate
+        # Stimulus over frames ~10-19 of the trial (response window of the decoder)
+        SimulatedStimulusClient('127.0.0.1', port, camera=server.camera,
+                                trialDuration=0.9*trialDuration, prestim=0.35,
+                                stim=0.3, dropRate=args.drop_rate).start()
+    server.accept()
+    try:
+        printTimingReport(server.run())
+        if decoder is not None:
+            decoder.printReport()
+    finally:
+        server.close()
@@ -0,0 +1,128 @@
+from time import perf_counter, sleep
+import threading
+import numpy as np
+
+"""
+CAMERAS
+
+Camera abstraction for the Python acquisition server. A camera backend is a
+class with this interface:
+
+    camera.frameShape       (height, width) of the frames
+    camera.dtype            numpy data type of the frames
+    camera.frameRate        nominal frames per second
+    camera.start()          starts the acquisition
+    camera.stop()           stops the acquisition
+    camera.grab(out)        waits for the next frame, writes it into the
+                            array out and returns its timestamp (seconds,
+                            time.perf_counter clock)
+
+Backends are registered by name with the registerCamera decorator and opened
+with openCamera(name, **parameters), so that real cameras (e.g. the PCO Edge
+used by loadCamera_PCOEdge.m) can be added without changing the server.
+
+SyntheticCamera generates uint16 frames at a configurable rate and resolution,
+to test and profile the whole acquisition path without hardware.
+"""
+
+# Backend name -> camera class
+CAMERA_BACKENDS = {}
+
+
+def registerCamera(name):
+    def decorator(cls):
+        CAMERA_BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def openCamera(name, **parameters):
+    if name not in CAMERA_BACKENDS:
+        raise ValueError(f"Unknown camera backend '{name}'. "
+                         f"Available backends: {list(CAMERA_BACKENDS)}")
+    return CAMERA_BACKENDS[name](**parameters)
+
+
+class Camera:
+    frameShape = None
+    dtype = np.uint16
+    frameRate = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def grab(self, out):
+        raise NotImplementedError
+
+
+@registerCamera('synthetic')
+class SyntheticCamera(Camera):
+    def __init__(self,
+                frameShape = (512, 512),    # (height, width) of the frames
+                frameRate = 10,             # Frames per second
+                baseline = 2000,            # Mean intensity (counts)
+                noise = 20,                 # Standard deviation of the noise (counts)
+                nNoiseFrames = 16,          # Number of precomputed noise frames
+                realTime = True,            # Pace the frames at frameRate
+                seed = None,                # Seed of the random generator
+                ):
+
+        self.frameShape = tuple(frameShape)
+        self.dtype = np.uint16
+        self.frameRate = frameRate
+        self.baseline = baseline
+        self.realTime = realTime
+        self.rng = np.random.default_rng(seed)
+
+        # Generating random frames at full resolution is slower than the
+        # camera, so a few noise frames are precomputed and cycled with a
+        # random shift
+        self.noiseFrames = self.rng.normal(
+            baseline, noise, (nNoiseFrames,) + self.frameShape
+            ).clip(0, 2**16-1).astype(np.uint16)
+        # Optional response added to the frames: (pattern, start, stop) with
+        # pattern a relative change of intensity (dR/R) for each pixel
+        self.responses = []
+        self._responsesLock = threading.Lock()
+        self._frameIndex = 0
+        self._nextTime = None
+
+    def start(self):
+        self._nextTime = perf_counter()
+
+    def stop(self):
+        self._nextTime = None
+
+    def stimulate(self, pattern, start, stop):
+        # Adds a response (dR/R map) to the frames acquired between the times
+        # start and stop (perf_counter clock)
+        with self._responsesLock:
+            self.responses.append((np.asarray(pattern, dtype=np.float32), start, stop))
+
+    def grab(self, out):
+        if self._nextTime is None:
+            self.start()
+        if self.realTime:
+            delay = self._nextTime - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        timestamp = perf_counter() if self.realTime else self._nextTime
+        self._nextTime += 1 / self.frameRate
+
+        noise = self.noiseFrames[self._frameIndex % len(self.noiseFrames)]
+        shift = self.rng.integers(self.frameShape[1])
+        np.copyto(out[:, shift:], noise[:, :self.frameShape[1]-shift])
+        np.copyto(out[:, :shift], noise[:, self.frameShape[1]-shift:])
+        self._frameIndex += 1
+
+        # Active responses (the expired ones are dropped)
+        with self._responsesLock:
+            self.responses = [r for r in self.responses if r[2] > timestamp]
+            active = list(self.responses)
+        for pattern, start, stop in active:
+            if start <= timestamp:
+                np.add(out, self.baseline * pattern, out=out, casting='unsafe')
+        return timestamp
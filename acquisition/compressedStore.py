@@ -0,0 +1,402 @@
+import bz2
+import json
+import lzma
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+"""
+CompressedMovieStore CLASS
+
+Lossless compressed storage of the raw trial movies, with the same interface
+as MovieStore (write, read, movies, metadata, trial processor).
+
+Every trial is split into chunks of chunkFrames frames. Each chunk is filtered
+and compressed independently with a stdlib codec:
+
+    'delta'     temporal delta: every frame is replaced by its difference from
+                the previous frame of the chunk (uint16, wrapping). Useful when
+                consecutive frames differ less than their pixels (low noise);
+                with shot-noise limited frames it doubles the noise.
+    'shuffle'   byte shuffle: the low and high bytes of the uint16 pixels are
+                stored as two separate planes, so the (mostly constant) high
+                bytes compress well.
+
+Compression runs in a thread pool (zlib, lzma and bz2 release the GIL), and
+write() returns immediately: the chunks are compressed while the next trial is
+acquired, and written to disk in order by a single writer thread.
+
+A store is a folder with, for every stimulus:
+
+    <stimulus>.chunks       compressed chunks, appended
+    <stimulus>.cidx         one record per chunk (trial, frame, nFrames,
+                            trialFrames, offset, nBytes)
+    <stimulus>.meta.jsonl   one JSON line of metadata per trial
+
+and a store.json header with the frame shape, data type, codec and filters.
+The chunk records of a trial are written after all its chunks: on reopening,
+incomplete trials are dropped (as in MovieStore). Reading any (stimulus,
+repetition, frames) selection (a slice, an integer or an array of frames)
+only decompresses the chunks that contain it.
+
+Run the benchmark of compression ratio and speed with:
+    python -m acquisition.compressedStore
+"""
+
+CHUNK_DTYPE = np.dtype([('trial', '<i8'), ('frame', '<i8'), ('nFrames', '<i8'),
+                        ('trialFrames', '<i8'), ('offset', '<i8'), ('nBytes', '<i8')])
+
+# Codec name -> (compress(data, level), decompress(data))
+CODECS = {
+    'none': (lambda data, level: bytes(data), lambda data: data),
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, level), bz2.decompress),
+}
+
+FILTERS = ('delta', 'shuffle')
+
+
+def encodeChunk(frames, filters, codec, level):
+    # Filters and compresses a chunk of frames (nFrames, height, width)
+    data = frames
+    if 'delta' in filters:
+        data = data.copy()
+        np.subtract(frames[1:], frames[:-1], out=data[1:])
+    if 'shuffle' in filters:
+        data = np.ascontiguousarray(data.reshape(-1).view(np.uint8)
+                                    .reshape(-1, data.itemsize).T)
+    return CODECS[codec][0](memoryview(np.ascontiguousarray(data)).cast('B'), level)
+
+
+def decodeChunk(data, shape, dtype, filters, codec):
+    # Inverse of encodeChunk
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(CODECS[codec][1](data), np.uint8)
+    if 'shuffle' in filters:
+        raw = np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+    frames = raw.view(dtype).reshape(shape)
+    if 'delta' in filters:
+        frames = np.cumsum(frames, axis=0, dtype=dtype)
+    return frames
+
+
+class CompressedMovieStore:
+    def __init__(self,
+                folder,                     # Folder of the store
+                mode = 'a',                 # 'a': append (create if needed), 'r': read only
+                frameShape = None,          # (height, width), default from the first trial
+                dtype = np.uint16,          # Data type of the frames
+                codec = 'zlib',             # See CODECS
+                level = 1,                  # Compression level of the codec
+                filters = ('shuffle',),     # Filters applied before compression (see FILTERS)
+                chunkFrames = 8,            # Frames per compressed chunk
+                workers = None,             # Compression threads (default: CPU count)
+                ):
+
+        if mode not in ('a', 'r'):
+            raise ValueError(f"Invalid mode '{mode}' (must be 'a' or 'r')")
+        self.folder = folder
+        self.mode = mode
+        settings = {'frameShape': list(frameShape) if frameShape is not None else None,
+                    'dtype': np.dtype(dtype).str, 'codec': codec, 'level': level,
+                    'filters': list(filters), 'chunkFrames': chunkFrames}
+
+        headerPath = os.path.join(folder, 'store.json')
+        if os.path.exists(headerPath):
+            # The format of an existing store is kept
+            with open(headerPath) as f:
+                header = json.load(f)
+            if frameShape is not None and header['frameShape'] not in (None, list(frameShape)):
+                raise ValueError(f"Frame shape {tuple(frameShape)} does not match the "
+                                 f"store ({tuple(header['frameShape'])})")
+            settings.update({k: v for k, v in header.items() if v is not None})
+        elif mode == 'r':
+            raise FileNotFoundError(f'No movie store in {folder}')
+        else:
+            os.makedirs(folder, exist_ok=True)
+        if settings['codec'] not in CODECS:
+            raise ValueError(f"Unknown codec '{settings['codec']}'. "
+                             f"Available codecs: {list(CODECS)}")
+        if not set(settings['filters']) <= set(FILTERS):
+            raise ValueError(f"Unknown filters {settings['filters']}. "
+                             f"Available filters: {list(FILTERS)}")
+
+        self.frameShape = tuple(settings['frameShape']) if settings['frameShape'] else None
+        self.dtype = np.dtype(settings['dtype'])
+        self.codec = settings['codec']
+        self.level = settings['level']
+        self.filters = tuple(settings['filters'])
+        self.chunkFrames = settings['chunkFrames']
+        if self.frameShape is not None and mode == 'a':
+            self._writeHeader()
+
+        self.index = {}             # stimulus -> chunk records
+        self.repetitionChunks = {}  # stimulus -> first chunk of every repetition
+        self._files = {}            # stimulus -> (chunks, meta, cidx) files open for appending
+        self._pool = ThreadPoolExecutor(workers)
+        self._writer = ThreadPoolExecutor(1)
+        self._pending = []
+
+        if mode == 'a':
+            self._recover()
+        self.refresh()
+
+    #---------------------------------------------------------------------------
+    #--- WRITING
+    #---------------------------------------------------------------------------
+
+    def write(self, stimulus, movie, trial=-1, metadata=None):
+        # Queues the movie (nFrames, height, width) of a trial of the stimulus
+        # for compression and returns immediately. The trial is readable once
+        # flush() returns. The movie is copied, so the caller can reuse its
+        # buffer for the next trial.
+        if self.mode == 'r':
+            raise PermissionError('The store is open read only')
+        movie = np.array(movie, dtype=self.dtype, order='C', copy=True)
+        if self.frameShape is None:
+            self.frameShape = movie.shape[1:]
+            self._writeHeader()
+        if movie.shape[1:] != self.frameShape:
+            raise ValueError(f'Frame shape {movie.shape[1:]} does not match the '
+                             f'store ({self.frameShape})')
+
+        chunks = [(frame, self._pool.submit(encodeChunk, movie[frame:frame+self.chunkFrames],
+                                            self.filters, self.codec, self.level))
+                  for frame in range(0, len(movie), self.chunkFrames)]
+        self._pending.append(self._writer.submit(
+            self._append, stimulus, trial, len(movie), chunks, metadata))
+        # Raise the errors of the trials already written
+        while self._pending and self._pending[0].done():
+            self._pending.pop(0).result()
+
+    def flush(self):
+        # Waits until all the queued trials are written
+        while self._pending:
+            self._pending.pop(0).result()
+
+    def __call__(self, entry, ack, movie, timestamps):
+        # Trial processor of the AcquisitionServer
+        metadata = {'ack': ack}
+        if timestamps is not None:
+            metadata['timestamps'] = np.asarray(timestamps).tolist()
+        # Result of the quality control, and trial repeated by this one
+        for key in ('qc', 'repeatOf'):
+            if key in entry:
+                metadata[key] = entry[key]
+        self.write(entry['shape'], movie, entry['trial'], metadata)
+
+    def close(self):
+        if self.mode == 'a':
+            self.flush()
+        self._pool.shutdown()
+        self._writer.shutdown()
+        for files in self._files.values():
+            for f in files:
+                f.close()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #---------------------------------------------------------------------------
+    #--- READING
+    #---------------------------------------------------------------------------
+
+    def refresh(self):
+        # Rereads the indexes, to see the trials appended by another process
+        for stimulus in self._stimuliOnDisk():
+            path = self._path(stimulus, '.cidx')
+            nRecords = os.path.getsize(path) // CHUNK_DTYPE.itemsize
+            self._setIndex(stimulus, np.fromfile(path, CHUNK_DTYPE, count=nRecords))
+
+    @property
+    def stimuli(self):
+        return sorted(s for s, first in self.repetitionChunks.items() if len(first))
+
+    def repetitions(self, stimulus):
+        return len(self.repetitionChunks.get(stimulus, ()))
+
+    def trials(self, stimulus):
+        return self.index[stimulus]['trial'][self.repetitionChunks[stimulus]]
+
+    def read(self, stimulus, repetition, frames=slice(None)):
+        # Frames of a repetition of the stimulus, with any numpy index of the
+        # frames (as MovieStore.read, but a copy). Only the chunks containing
+        # the frames are read and decompressed.
+        index = self.index[stimulus]
+        firstChunk = self.repetitionChunks[stimulus][repetition]
+        trialFrames = int(index['trialFrames'][firstChunk])
+        selected = np.arange(trialFrames)[frames]
+        wanted = np.ravel(selected)
+        if wanted.size == 0:
+            return np.zeros(np.shape(selected) + self.frameShape, self.dtype)
+        nChunks = -(-trialFrames // self.chunkFrames)
+        chunks = index[firstChunk:firstChunk + nChunks]
+        chunkOfFrame = np.searchsorted(chunks['frame'], wanted, side='right') - 1
+        neededChunks = np.unique(chunkOfFrame)
+        needed = chunks[neededChunks]
+
+        with open(self._path(stimulus, '.chunks'), 'rb') as f:
+            data = []
+            for chunk in needed:
+                f.seek(int(chunk['offset']))
+                data.append(f.read(int(chunk['nBytes'])))
+        decoded = self._pool.map(
+            lambda args: decodeChunk(args[0], (int(args[1]['nFrames']),) + self.frameShape,
+                                     self.dtype, self.filters, self.codec),
+            zip(data, needed))
+        movie = np.concatenate(list(decoded))
+        # Position of every frame in the decoded chunks
+        chunkStarts = np.concatenate([[0], np.cumsum(needed['nFrames'])[:-1]])
+        k = np.searchsorted(neededChunks, chunkOfFrame)
+        positions = chunkStarts[k] + wanted - needed['frame'][k]
+        return movie[positions].reshape(np.shape(selected) + self.frameShape)
+
+    def movies(self, stimulus):
+        # All the trials of the stimulus, (repetitions, nFrames, height, width)
+        return np.stack([self.read(stimulus, r) for r in range(self.repetitions(stimulus))])
+
+    def metadata(self, stimulus):
+        # Metadata of the trials of the stimulus, in repetition order
+        with open(self._path(stimulus, '.meta.jsonl')) as f:
+            lines = f.readlines()[:self.repetitions(stimulus)]
+        return [json.loads(line) for line in lines]
+
+    def compressionRatio(self, stimulus=None):
+        stimuli = self.stimuli if stimulus is None else [stimulus]
+        frameBytes = self.dtype.itemsize * int(np.prod(self.frameShape))
+        raw = sum(int(self.index[s]['nFrames'].sum()) * frameBytes for s in stimuli)
+        compressed = sum(int(self.index[s]['nBytes'].sum()) for s in stimuli)
+        return raw / compressed
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _append(self, stimulus, trial, trialFrames, chunks, metadata):
+        # Writer thread: appends the chunks of a trial, its metadata and last
+        # its chunk records
+        data, meta, cidx = self._open(stimulus)
+        offset = data.tell()
+        records = np.zeros(len(chunks), CHUNK_DTYPE)
+        for record, (frame, future) in zip(records, chunks):
+            compressed = future.result()
+            data.write(compressed)
+            record['trial'], record['frame'], record['trialFrames'] = trial, frame, trialFrames
+            record['nFrames'] = min(self.chunkFrames, trialFrames - frame)
+            record['offset'], record['nBytes'] = offset, len(compressed)
+            offset += len(compressed)
+        data.flush()
+        meta.write(json.dumps(metadata) + '\n')
+        meta.flush()
+        cidx.write(records.tobytes())
+        cidx.flush()
+        self._setIndex(stimulus, np.concatenate([self.index.get(stimulus, records[:0]),
+                                                 records]))
+
+    def _setIndex(self, stimulus, index):
+        # Index of the chunks and first chunk of every complete repetition
+        firstChunks = np.flatnonzero(index['frame'] == 0)
+        if len(firstChunks):
+            # The last repetition is complete only if all its chunks are there
+            last = index[firstChunks[-1]:]
+            if last['nFrames'].sum() != last['trialFrames'][0]:
+                firstChunks = firstChunks[:-1]
+        self.repetitionChunks[stimulus] = firstChunks
+        self.index[stimulus] = index
+
+    def _path(self, stimulus, extension):
+        return os.path.join(self.folder, stimulus + extension)
+
+    def _stimuliOnDisk(self):
+        return [name[:-5] for name in os.listdir(self.folder) if name.endswith('.cidx')]
+
+    def _writeHeader(self):
+        with open(os.path.join(self.folder, 'store.json'), 'w') as f:
+            json.dump({'frameShape': list(self.frameShape), 'dtype': self.dtype.str,
+                       'codec': self.codec, 'level': self.level,
+                       'filters': list(self.filters), 'chunkFrames': self.chunkFrames}, f)
+
+    def _open(self, stimulus):
+        if stimulus not in self._files:
+            self._files[stimulus] = tuple(open(self._path(stimulus, ext), mode)
+                                          for ext, mode in (('.chunks', 'ab'),
+                                                            ('.meta.jsonl', 'a'),
+                                                            ('.cidx', 'ab')))
+        return self._files[stimulus]
+
+    def _recover(self):
+        # Drops whatever was written after the last complete trial
+        for stimulus in self._stimuliOnDisk():
+            idxPath = self._path(stimulus, '.cidx')
+            nRecords = os.path.getsize(idxPath) // CHUNK_DTYPE.itemsize
+            self._setIndex(stimulus, np.fromfile(idxPath, CHUNK_DTYPE, count=nRecords))
+            firstChunks = self.repetitionChunks[stimulus]
+            index = self.index[stimulus]
+            nChunks = (int(firstChunks[-1]) + -(-int(index['trialFrames'][firstChunks[-1]])
+                                                  // self.chunkFrames)
+                       if len(firstChunks) else 0)
+            os.truncate(idxPath, nChunks * CHUNK_DTYPE.itemsize)
+            end = int(index['offset'][nChunks-1] + index['nBytes'][nChunks-1]) if nChunks else 0
+            dataPath = self._path(stimulus, '.chunks')
+            if os.path.exists(dataPath) and os.path.getsize(dataPath) > end:
+                os.truncate(dataPath, end)
+            metaPath = self._path(stimulus, '.meta.jsonl')
+            if os.path.exists(metaPath):
+                with open(metaPath) as f:
+                    lines = f.readlines()
+                if len(lines) > len(firstChunks) or (lines and not lines[-1].endswith('\n')):
+                    with open(metaPath, 'w') as f:
+                        f.writelines(lines[:len(firstChunks)])
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    from time import perf_counter
+
+    rng = np.random.default_rng(0)
+    nTrials, nFrames, frameShape = 4, 60, (256, 256)
+
+    # Synthetic camera frames: constant baseline + white noise
+    synthetic = rng.normal(2000, 20, (nTrials, nFrames) + frameShape).clip(0).astype(np.uint16)
+    # Recorded-like frames: smooth vasculature-like image, slow drift and
+    # shot noise proportional to the intensity
+    y, x = np.mgrid[:frameShape[0], :frameShape[1]] / frameShape[0]
+    image = 1500 + 800*np.sin(9*x + 3*np.sin(7*y))**2 * np.exp(-((x-.5)**2 + (y-.5)**2))
+    drift = 1 + 0.01*np.sin(np.linspace(0, 2*np.pi, nTrials*nFrames)).reshape(nTrials, nFrames)
+    mean = image * drift[..., None, None]
+    recorded = rng.poisson(mean).astype(np.uint16)
+
+    print(f'{nTrials} trials x {nFrames} frames {frameShape} uint16 '
+          f'({synthetic.nbytes/2**20:.0f} MB per dataset)')
+    print(f"{'data':<10}{'codec':<6}{'filters':<15}{'ratio':>7}{'write MB/s':>12}"
+          f"{'read MB/s':>11}")
+    for name, movies in (('synthetic', synthetic), ('recorded', recorded)):
+        for codec, level in (('zlib', 1), ('lzma', 0)):
+            for filters in ((), ('shuffle',), ('delta', 'shuffle')):
+                folder = tempfile.mkdtemp()
+                try:
+                    store = CompressedMovieStore(folder, codec=codec, level=level,
+                                                 filters=filters)
+                    t = perf_counter()
+                    for trial, movie in enumerate(movies):
+                        store.write('stim', movie, trial)
+                    store.flush()
+                    writeTime = perf_counter() - t
+                    t = perf_counter()
+                    for repetition in range(nTrials):
+                        assert np.array_equal(store.read('stim', repetition), movies[repetition])
+                    readTime = perf_counter() - t
+                    print(f"{name:<10}{codec:<6}{'+'.join(filters) or '-':<15}"
+                          f"{store.compressionRatio():7.2f}"
+                          f"{movies.nbytes/2**20/writeTime:12.0f}"
+                          f"{movies.nbytes/2**20/readTime:11.0f}")
+                    store.close()
+                finally:
+                    shutil.rmtree(folder)
@@ -0,0 +1,122 @@
+import numpy as np
+
+"""
+EPOCHING
+
+Trigger-aligned epoching of a continuously acquired FrameRingBuffer.
+
+With continuous acquisition the camera is never stopped between trials: every
+frame goes into the ring buffer with its timestamp, and each trial is cut out
+of the stream afterwards as a fixed window of frames around an event (the
+trigger, the stimulus onset...):
+
+    frames [eventFrame - preFrames, eventFrame + postFrames)
+
+where eventFrame is the first frame acquired at or after the time of the event.
+All the events are located at once with a binary search on the timestamps, and
+the windows are plain index arrays (nEvents, preFrames + postFrames) of frame
+numbers: nothing is copied until the frames are actually needed (e.g. to save
+them), and any window can be cut again later (e.g. to take the baseline from
+the inter-trial frames) as long as its frames are still in the buffer.
+
+The events are on the clock of the server. Times measured by the stimulation
+client (on its own clock) are converted with ackEventTime(), from the time the
+ACK of the trial was received.
+"""
+
+
+def ackEventTime(ack, receivedAt, event='triggerTime'):
+    # Time (clock of the server) of an event reported in the ACK of a trial.
+    # The ACK is sent right after the last flip, so the event happened
+    # lastFlip - event seconds before the ACK was received.
+    return receivedAt - (ack['lastFlip'] - ack[event])
+
+
+class Epoch:
+    def __init__(self, ringBuffer, frameNumbers):
+        # Frames of one window, still in the ring buffer
+        self.ringBuffer = ringBuffer
+        self.frameNumbers = frameNumbers
+
+    def __len__(self):
+        return len(self.frameNumbers)
+
+    @property
+    def isAvailable(self):
+        return self.ringBuffer.isAvailable(self.frameNumbers[0], self.frameNumbers[-1] + 1)
+
+    @property
+    def timestamps(self):
+        return self.ringBuffer.getTimestamps(self.frameNumbers[0], self.frameNumbers[-1] + 1)
+
+    def view(self):
+        # Frames of the window without copying them, if they are contiguous in
+        # the buffer (i.e. the window does not wrap around). Otherwise None.
+        # The view is only valid until the frames are overwritten.
+        if not self.isAvailable:
+            raise IndexError(f'Frames [{self.frameNumbers[0]}, {self.frameNumbers[-1]+1}) '
+                             f'are no longer in the buffer')
+        first, last = self.ringBuffer.slots(self.frameNumbers[[0, -1]])
+        if last < first:
+            return None
+        return self.ringBuffer.frames[first:last+1]
+
+    def copy(self, out=None):
+        return self.ringBuffer.get(self.frameNumbers[0], self.frameNumbers[-1] + 1, out=out)
+
+
+class Epocher:
+    def __init__(self,
+                ringBuffer,                 # FrameRingBuffer acquired continuously
+                preFrames = 5,              # Frames in the window before the event
+                postFrames = 55,            # Frames in the window from the event on
+                ):
+
+        self.ringBuffer = ringBuffer
+        self.preFrames = preFrames
+        self.postFrames = postFrames
+        self.offsets = np.arange(-preFrames, postFrames)
+
+    def eventFrames(self, eventTimes):
+        # Number of the first frame acquired at or after each event time
+        # (vectorized). Events after the last written frame get framesWritten.
+        ringBuffer = self.ringBuffer
+        first = max(0, ringBuffer.framesWritten - ringBuffer.capacity)
+        timestamps = ringBuffer.getTimestamps(first, ringBuffer.framesWritten)
+        return first + np.searchsorted(timestamps, eventTimes, side='left')
+
+    def windows(self, eventFrames):
+        # Frame numbers of the windows, (nEvents, preFrames + postFrames)
+        return np.asarray(eventFrames)[..., None] + self.offsets
+
+    def epochs(self, eventTimes):
+        # Lazy epochs (no copy) of the given events
+        return [Epoch(self.ringBuffer, window)
+                for window in self.windows(self.eventFrames(np.atleast_1d(eventTimes)))]
+
+    def waitForEpoch(self, eventTime, timeout=None):
+        # Waits until the whole window of an event has been acquired. Returns
+        # its Epoch, or None if the timeout expired before.
+        ringBuffer = self.ringBuffer
+        while True:
+            written = ringBuffer.framesWritten
+            if written and ringBuffer.getTimestamps(written-1, written)[0] >= eventTime:
+                break
+            if not ringBuffer.waitForFrames(written + 1, timeout):
+                return None
+        epoch = self.epochs(eventTime)[0]
+        if not ringBuffer.waitForFrames(epoch.frameNumbers[-1] + 1, timeout):
+            return None
+        return epoch
+
+    def copyEpochs(self, eventTimes, out=None):
+        # Frames of the windows of all the events at once,
+        # (nEvents, preFrames + postFrames, height, width)
+        windows = self.windows(self.eventFrames(np.atleast_1d(eventTimes)))
+        ringBuffer = self.ringBuffer
+        if not (ringBuffer.isAvailable(windows.min(), windows.max() + 1)):
+            raise IndexError('Some of the windows are no longer in the buffer')
+        frames = np.take(ringBuffer.frames, ringBuffer.slots(windows), axis=0, out=out)
+        if not (ringBuffer.isAvailable(windows.min(), windows.max() + 1)):
+            raise IndexError('Some of the windows were overwritten while being copied')
+        return frames
@@ -0,0 +1,236 @@
+import json
+import os
+import numpy as np
+
+"""
+MovieStore CLASS
+
+Append-only storage of the raw trial movies, Python counterpart of the matfile
+written by saveRawData.m, for any number of stimuli.
+
+A store is a folder with, for every stimulus (e.g. shape):
+
+    <stimulus>.raw          frames of all the trials of the stimulus, appended
+                            one trial (chunk) after the other
+    <stimulus>.idx          index of the chunks: one fixed-size record
+                            (trial, firstFrame, nFrames) per trial
+    <stimulus>.meta.jsonl   one JSON line of metadata per trial (e.g. its ACK)
+
+and a store.json header with the shape and data type of the frames.
+
+A trial is first appended to the .raw file, then its metadata, and its index
+record last: a trial is in the store only once its index record is complete.
+When a store is reopened (e.g. after a crash) anything written after the last
+complete index record is truncated, and the recording can resume from there.
+
+Frames are read through memory maps of the .raw files, so reading a (stimulus,
+repetition, frames) slice is a zero-copy view. Readers (also in another
+process, with mode='r') can read while the recording is being written:
+refresh() picks up the trials appended since.
+
+The store can be used directly as a trial processor of the AcquisitionServer.
+"""
+
+INDEX_DTYPE = np.dtype([('trial', '<i8'), ('firstFrame', '<i8'), ('nFrames', '<i8')])
+
+
+class MovieStore:
+    def __init__(self,
+                folder,                     # Folder of the store
+                mode = 'a',                 # 'a': append (create if needed), 'r': read only
+                frameShape = None,          # (height, width), default from the first trial
+                dtype = np.uint16,          # Data type of the frames
+                fsync = False,              # Force every trial to disk before indexing it
+                ):
+
+        if mode not in ('a', 'r'):
+            raise ValueError(f"Invalid mode '{mode}' (must be 'a' or 'r')")
+        self.folder = folder
+        self.mode = mode
+        self.fsync = fsync
+        self.frameShape = tuple(frameShape) if frameShape is not None else None
+        self.dtype = np.dtype(dtype)
+        self.index = {}             # stimulus -> index records
+        self._maps = {}             # stimulus -> memmap of the .raw file
+        self._files = {}            # stimulus -> (raw, meta, idx) files open for appending
+
+        headerPath = os.path.join(folder, 'store.json')
+        if os.path.exists(headerPath):
+            with open(headerPath) as f:
+                header = json.load(f)
+            if self.frameShape is not None and tuple(header['frameShape']) != self.frameShape:
+                raise ValueError(f"Frame shape {self.frameShape} does not match the "
+                                 f"store ({tuple(header['frameShape'])})")
+            self.frameShape = tuple(header['frameShape'])
+            self.dtype = np.dtype(header['dtype'])
+        elif mode == 'r':
+            raise FileNotFoundError(f'No movie store in {folder}')
+        else:
+            os.makedirs(folder, exist_ok=True)
+            if self.frameShape is not None:
+                self._writeHeader()
+
+        if mode == 'a':
+            self._recover()
+        self.refresh()
+
+    #---------------------------------------------------------------------------
+    #--- WRITING
+    #---------------------------------------------------------------------------
+
+    def write(self, stimulus, movie, trial=-1, metadata=None):
+        # Appends the movie (nFrames, height, width) of a trial of the
+        # stimulus. Returns its repetition number.
+        if self.mode == 'r':
+            raise PermissionError('The store is open read only')
+        movie = np.ascontiguousarray(movie, dtype=self.dtype)
+        if self.frameShape is None:
+            self.frameShape = movie.shape[1:]
+            self._writeHeader()
+        if movie.shape[1:] != self.frameShape:
+            raise ValueError(f'Frame shape {movie.shape[1:]} does not match the '
+                             f'store ({self.frameShape})')
+
+        raw, meta, idx = self._open(stimulus)
+        index = self.index.get(stimulus, np.zeros(0, INDEX_DTYPE))
+        firstFrame = int(index['firstFrame'][-1] + index['nFrames'][-1]) if len(index) else 0
+
+        raw.write(memoryview(movie).cast('B'))
+        raw.flush()
+        meta.write(json.dumps(metadata) + '\n')
+        meta.flush()
+        if self.fsync:
+            os.fsync(raw.fileno())
+            os.fsync(meta.fileno())
+        record = np.array([(trial, firstFrame, len(movie))], INDEX_DTYPE)
+        idx.write(record.tobytes())
+        idx.flush()
+
+        self.index[stimulus] = np.concatenate([index, record])
+        return len(index)
+
+    def __call__(self, entry, ack, movie, timestamps):
+        # Trial processor of the AcquisitionServer
+        metadata = {'ack': ack}
+        if timestamps is not None:
+            metadata['timestamps'] = np.asarray(timestamps).tolist()
+        # Result of the quality control, and trial repeated by this one
+        for key in ('qc', 'repeatOf'):
+            if key in entry:
+                metadata[key] = entry[key]
+        self.write(entry['shape'], movie, entry['trial'], metadata)
+
+    def close(self):
+        for files in self._files.values():
+            for f in files:
+                f.close()
+        self._files.clear()
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #---------------------------------------------------------------------------
+    #--- READING
+    #---------------------------------------------------------------------------
+
+    def refresh(self):
+        # Rereads the indexes, to see the trials appended by another process
+        for stimulus in self._stimuliOnDisk():
+            path = self._path(stimulus, '.idx')
+            nRecords = os.path.getsize(path) // INDEX_DTYPE.itemsize
+            self.index[stimulus] = np.fromfile(path, INDEX_DTYPE, count=nRecords)
+
+    @property
+    def stimuli(self):
+        return sorted(s for s, index in self.index.items() if len(index))
+
+    def repetitions(self, stimulus):
+        return len(self.index.get(stimulus, ()))
+
+    def trials(self, stimulus):
+        return self.index[stimulus]['trial']
+
+    def read(self, stimulus, repetition, frames=slice(None)):
+        # Zero-copy view of frames of a repetition of the stimulus
+        record = self.index[stimulus][repetition]
+        first = int(record['firstFrame'])
+        movie = self._map(stimulus, first + int(record['nFrames']))
+        return movie[first:first + int(record['nFrames'])][frames]
+
+    def movies(self, stimulus):
+        # Zero-copy view (repetitions, nFrames, height, width) of all the
+        # trials of the stimulus. They must have the same number of frames.
+        index = self.index[stimulus]
+        nFrames = np.unique(index['nFrames'])
+        if len(nFrames) != 1:
+            raise ValueError(f"Trials of '{stimulus}' have different numbers of "
+                             f"frames ({nFrames.tolist()})")
+        total = len(index) * int(nFrames[0])
+        return self._map(stimulus, total)[:total].reshape(
+            (len(index), int(nFrames[0])) + self.frameShape)
+
+    def metadata(self, stimulus):
+        # Metadata of the trials of the stimulus, in repetition order
+        with open(self._path(stimulus, '.meta.jsonl')) as f:
+            lines = f.readlines()[:self.repetitions(stimulus)]
+        return [json.loads(line) for line in lines]
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _path(self, stimulus, extension):
+        return os.path.join(self.folder, stimulus + extension)
+
+    def _stimuliOnDisk(self):
+        return [name[:-4] for name in os.listdir(self.folder) if name.endswith('.idx')]
+
+    def _writeHeader(self):
+        with open(os.path.join(self.folder, 'store.json'), 'w') as f:
+            json.dump({'frameShape': list(self.frameShape), 'dtype': self.dtype.str}, f)
+
+    def _open(self, stimulus):
+        if stimulus not in self._files:
+            self._files[stimulus] = tuple(open(self._path(stimulus, ext), mode)
+                                          for ext, mode in (('.raw', 'ab'),
+                                                            ('.meta.jsonl', 'a'),
+                                                            ('.idx', 'ab')))
+        return self._files[stimulus]
+
+    def _map(self, stimulus, nFrames):
+        # Memory map of the .raw file covering at least nFrames frames
+        movie = self._maps.get(stimulus)
+        if movie is None or len(movie) < nFrames:
+            path = self._path(stimulus, '.raw')
+            frameBytes = self.dtype.itemsize * int(np.prod(self.frameShape))
+            movie = np.memmap(path, self.dtype, 'r',
+                              shape=(os.path.getsize(path) // frameBytes,) + self.frameShape)
+            self._maps[stimulus] = movie
+        return movie
+
+    def _recover(self):
+        # Drops whatever was written after the last complete index record
+        # (e.g. a trial interrupted by a crash)
+        if self.frameShape is None:
+            return
+        frameBytes = self.dtype.itemsize * int(np.prod(self.frameShape))
+        for stimulus in self._stimuliOnDisk():
+            idxPath = self._path(stimulus, '.idx')
+            nRecords = os.path.getsize(idxPath) // INDEX_DTYPE.itemsize
+            os.truncate(idxPath, nRecords * INDEX_DTYPE.itemsize)
+            index = np.fromfile(idxPath, INDEX_DTYPE)
+            nFrames = int(index['firstFrame'][-1] + index['nFrames'][-1]) if nRecords else 0
+            rawPath = self._path(stimulus, '.raw')
+            if os.path.exists(rawPath) and os.path.getsize(rawPath) > nFrames * frameBytes:
+                os.truncate(rawPath, nFrames * frameBytes)
+            metaPath = self._path(stimulus, '.meta.jsonl')
+            if os.path.exists(metaPath):
+                with open(metaPath) as f:
+                    lines = f.readlines()
+                if len(lines) > nRecords or (lines and not lines[-1].endswith('\n')):
+                    with open(metaPath, 'w') as f:
+                        f.writelines(lines[:nRecords])
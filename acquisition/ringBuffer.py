@@ -0,0 +1,91 @@
+import threading
+import numpy as np
+
+"""
+FrameRingBuffer CLASS
+
+Preallocated ring buffer of camera frames, written by a single producer (the
+acquisition thread) and read by any number of consumers.
+
+Frames are numbered from 0 since the creation of the buffer (or the last
+reset()); frame n is stored in slot n % capacity, together with its timestamp.
+The producer writes the camera frame directly into the buffer:
+
+    slot = ringBuffer.nextSlot()          # array view to fill in place
+    timestamp = camera.grab(out=slot)
+    ringBuffer.commit(timestamp)
+
+and consumers wait for and read frames by number. Since the producer fills
+the slot of frame framesWritten - capacity before committing it, a frame is
+available while n > framesWritten - capacity. get() checks it again after the
+copy, and raises IndexError if the producer overwrote the frames meanwhile.
+"""
+
+
+class FrameRingBuffer:
+    def __init__(self,
+                capacity,                   # Number of frames kept
+                frameShape,                 # (height, width) of the frames
+                dtype = np.uint16,          # Data type of the frames
+                ):
+
+        self.capacity = int(capacity)
+        self.frameShape = tuple(frameShape)
+        self.frames = np.zeros((self.capacity,) + self.frameShape, dtype=dtype)
+        self.timestamps = np.full(self.capacity, np.nan)
+        self.framesWritten = 0
+        self._newFrame = threading.Condition()
+
+    def reset(self):
+        with self._newFrame:
+            self.framesWritten = 0
+            self.timestamps[:] = np.nan
+
+    def nextSlot(self):
+        # View of the slot where the next frame has to be written
+        return self.frames[self.framesWritten % self.capacity]
+
+    def commit(self, timestamp):
+        # Publishes the frame written in nextSlot()
+        with self._newFrame:
+            self.timestamps[self.framesWritten % self.capacity] = timestamp
+            self.framesWritten += 1
+            self._newFrame.notify_all()
+
+    def waitForFrames(self, nFrames, timeout=None):
+        # Blocks until at least nFrames frames have been written. Returns
+        # False if the timeout expired before.
+        with self._newFrame:
+            return self._newFrame.wait_for(lambda: self.framesWritten >= nFrames,
+                                           timeout)
+
+    def isAvailable(self, start, stop=None):
+        # True if frames [start, stop) are written and not yet overwritten
+        # (nor being overwritten in nextSlot())
+        if stop is None:
+            stop = start + 1
+        return (start >= 0 and start > self.framesWritten - self.capacity and
+                stop <= self.framesWritten)
+
+    def slots(self, frameNumbers):
+        # Slots of the given frame numbers (any array shape)
+        return np.asarray(frameNumbers) % self.capacity
+
+    def get(self, start, stop, out=None):
+        # Copies frames [start, stop) into out (or a new array)
+        if not self.isAvailable(start, stop):
+            raise IndexError(f'Frames [{start}, {stop}) are not in the buffer '
+                             f'({self.framesWritten} frames written, '
+                             f'capacity {self.capacity})')
+        frames = np.take(self.frames, self.slots(np.arange(start, stop)), axis=0,
+                         out=out)
+        # The producer does not wait for the consumers: the first frames may
+        # have been overwritten during the copy
+        if not self.isAvailable(start, stop):
+            raise IndexError(f'Frames [{start}, {stop}) were overwritten while '
+                             f'being copied ({self.framesWritten} frames written, '
+                             f'capacity {self.capacity})')
+        return frames
+
+    def getTimestamps(self, start, stop):
+        return self.timestamps[self.slots(np.arange(start, stop))]
@@ -0,0 +1,114 @@
+"""
+SIMULATED STIMULATION CLIENT
+
+Stand-in for client_shapes.py, to test the acquisition side without psychopy,
+a stimulation monitor or a parallel port. It connects to the acquisition
+server, accepts TRIAL/SCHEDULE/GO/STOP messages (CONFIG is ignored),
+"presents" each trial by waiting for its duration and answers with the same
+ACK sent by the real client.
+
+If a SyntheticCamera is given, every trial also adds a response to the frames
+of the camera during the stimulus: by default the (negative) dR/R response is
+the mask of the shape rasterized at the resolution of the camera, so that the
+recorded movies actually contain information about the stimulus.
+"""
+
+import json
+import socket
+import threading
+from time import perf_counter, sleep
+import numpy as np
+
+from communication.tcpProtocol import MessageBuffer, encodeMessage, ackPayload
+
+
+def shapeResponseMaps(shapes, frameShape, amplitude=-0.01, width=20, stroke=2,
+                      pixPerDeg=None):
+    # dR/R response map of each shape: its mask scaled by amplitude
+    from stimuli.shapeMasks import shapeMask
+    if pixPerDeg is None:
+        pixPerDeg = 0.8 * min(frameShape) / (width + 2*stroke)
+    return {shape: amplitude * shapeMask(shape, width, stroke, frameShape, pixPerDeg,
+                                         supersample=2)
+            for shape in shapes}
+
+
+class SimulatedStimulusClient(threading.Thread):
+    def __init__(self,
+                address,                    # Address of the acquisition server
+                port,                       # Port of the acquisition server
+                camera = None,              # Optional SyntheticCamera to stimulate
+                trialDuration = 6,          # Seconds from trigger to the last flip
+                prestim = 1/6,              # Fraction of the trial before the stimulus
+                stim = 1/6,                 # Fraction of the trial with the stimulus
+                responseMaps = None,        # shape -> dR/R map (default: shape masks)
+                dropRate = 0,               # Fraction of the trials that drop frames
+                seed = None,                # Seed of the dropped frames
+                ):
+
+        super().__init__(name='SimulatedStimulusClient', daemon=True)
+        self.address = address
+        self.port = port
+        self.camera = camera
+        self.trialDuration = trialDuration
+        self.prestim = prestim
+        self.stim = stim
+        self.responseMaps = responseMaps
+        self.dropRate = dropRate
+        self.rng = np.random.default_rng(seed)
+        self.schedule = {}
+
+    def run(self):
+        sock = socket.create_connection((self.address, self.port))
+        rxBuffer = MessageBuffer()
+        try:
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    return
+                for msg in rxBuffer.feed(data):
+                    if msg.type == 'STOP':
+                        return
+                    elif msg.type == 'SCHEDULE':
+                        for entry in json.loads(msg.payload):
+                            self.schedule[entry['trial']] = entry
+                    elif msg.type in ('TRIAL', 'GO'):
+                        entry = self.schedule.pop(msg.trial, None) or \
+                            {'trial': msg.trial, 'shape': msg.payload}
+                        timing = self.doTrial(entry['shape'])
+                        sock.sendall(encodeMessage('ACK', msg.trial, ackPayload(
+                            msg.trial, entry['shape'], timing, entry.get('seed'))))
+                    elif msg.type == 'HEARTBEAT' and msg.payload != 'pong':
+                        sock.sendall(encodeMessage('HEARTBEAT', msg.trial, 'pong'))
+        finally:
+            sock.close()
+
+    def doTrial(self, shape):
+        # Simulated trial, with the same timing report of doTrial()
+        triggerTime = perf_counter()
+        onset = triggerTime + self.prestim * self.trialDuration
+        offset = onset + self.stim * self.trialDuration
+        if self.camera is not None:
+            if self.responseMaps is None:
+                self.responseMaps = shapeResponseMaps(
+                    [shape], self.camera.frameShape)
+            if shape not in self.responseMaps:
+                self.responseMaps.update(shapeResponseMaps(
+                    [shape], self.camera.frameShape))
+            self.camera.stimulate(self.responseMaps[shape], onset, offset)
+        sleep(self.trialDuration)
+        # Frames dropped during the stimulus, to test the quality control
+        dropped = int(self.rng.integers(1, 4)) if self.rng.random() < self.dropRate else 0
+        return {
+            'triggerTime': triggerTime,
+            'firstFlip': triggerTime,
+            'stimOnset': onset,
+            'stimOffset': offset,
+            'lastFlip': triggerTime + self.trialDuration,
+            'dropped': dropped,
+            'droppedStim': dropped,
+            'reversalOffset': dropped / 60,
+            'setupTime': 0.,
+            'aborted': False,
+            'framesPresented': None,
+        }
@@ -0,0 +1,116 @@
+import numpy as np
+
+"""
+TrialQC CLASS
+
+Quality control of the timing of every trial, from the ACK of the stimulation
+client (see communication/tcpProtocol.ackPayload) and the acquisition of its
+frames. A trial fails if any of these checks fails:
+
+    droppedStim     frames dropped while the stimulus was on screen
+    dropped         frames dropped in the whole trial
+    reversalOffset  largest delay (s) of a checkerboard reversal from its
+                    nominal time
+    triggerDelay    delay (s) of the trigger from the first flip of the trial
+    aborted         trial aborted
+    ack             no ACK from the client
+    frames          frames of the trial not (or not completely) acquired
+
+Every threshold is the largest value accepted (None disables the check), and
+checks whose value is missing from the ACK (e.g. an older client) are
+skipped. evaluate() returns the result stored with the trial, e.g.
+
+    {'passed': False, 'failures': ['droppedStim'], 'droppedStim': 2, ...}
+
+The AcquisitionServer adds it to the schedule entry of the trial ('qc'), so
+that it is saved in the metadata of the stores, and reschedules the failed
+trials with reschedule(): a new trial with the same stimulus, inserted at a
+random position among the trials still to run, so that the repetitions of
+every stimulus stay balanced and a failure does not always fall at the end of
+the session.
+"""
+
+# Largest accepted value of every timing check (None: not checked)
+DEFAULT_THRESHOLDS = {
+    'droppedStim': 0,
+    'dropped': None,
+    'reversalOffset': 0.004,
+    'triggerDelay': 0.002,          # The trigger rises 1 ms (pulse width) after the flip
+}
+
+
+class TrialQC:
+    def __init__(self,
+                thresholds = None,          # Overrides of DEFAULT_THRESHOLDS
+                maxRepeats = 2,             # Max times a trial is rescheduled
+                minDistance = 1,            # Min trials before a rescheduled trial
+                rng = None,                 # numpy Generator of the positions
+                ):
+
+        unknown = set(thresholds or {}) - set(DEFAULT_THRESHOLDS)
+        if unknown:
+            raise ValueError(f'Unknown QC thresholds {sorted(unknown)} '
+                             f'(must be in {list(DEFAULT_THRESHOLDS)})')
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        self.maxRepeats = maxRepeats
+        self.minDistance = minDistance
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.results = {}           # trial index -> result of evaluate()
+        self.rescheduled = {}       # trial index -> index of its repetition
+
+    def measures(self, ack):
+        # Timing values of a trial checked against the thresholds
+        measures = {'droppedStim': ack.get('droppedStim'),
+                    'dropped': ack.get('dropped'),
+                    'reversalOffset': ack.get('reversalOffset'),
+                    'triggerDelay': None}
+        if ack.get('triggerTime') is not None and ack.get('firstFlip') is not None:
+            measures['triggerDelay'] = ack['triggerTime'] - ack['firstFlip']
+        return measures
+
+    def evaluate(self, trial, ack, complete=True):
+        # Result of the quality control of a trial
+        failures = []
+        result = {}
+        if ack is None:
+            failures.append('ack')
+        else:
+            if ack.get('aborted'):
+                failures.append('aborted')
+            for name, value in self.measures(ack).items():
+                result[name] = value
+                limit = self.thresholds[name]
+                if limit is not None and value is not None and value > limit:
+                    failures.append(name)
+        if not complete:
+            failures.append('frames')
+        result = dict(passed=not failures, failures=failures, **result)
+        self.results[trial] = result
+        return result
+
+    def reschedule(self, schedule, position, entry):
+        # Inserts a repetition of the failed trial entry (at schedule[position])
+        # at a random position among the trials after it. Returns the new
+        # entry, or None if the trial was already repeated maxRepeats times.
+        original = entry.get('repeatOf', entry['trial'])
+        repeats = sum(e.get('repeatOf') == original for e in schedule)
+        if repeats >= self.maxRepeats:
+            return None
+        newEntry = {key: value for key, value in entry.items() if key != 'qc'}
+        newEntry.update(trial=max(e['trial'] for e in schedule) + 1, repeatOf=original)
+        if 'seed' in entry:
+            newEntry['seed'] = int(self.rng.integers(2**31 - 1))
+        first = min(position + 1 + self.minDistance, len(schedule))
+        schedule.insert(int(self.rng.integers(first, len(schedule) + 1)), newEntry)
+        self.rescheduled[entry['trial']] = newEntry['trial']
+        return newEntry
+
+    def summary(self):
+        # Number of trials failing every check
+        failed = [r for r in self.results.values() if not r['passed']]
+        counts = {}
+        for result in failed:
+            for failure in result['failures']:
+                counts[failure] = counts.get(failure, 0) + 1
+        return {'trials': len(self.results), 'failed': len(failed),
+                'rescheduled': len(self.rescheduled), 'failures': counts}
@@ -0,0 +1,135 @@
+import numpy as np
+
+from stimuli.shapeGeometry import SHAPES
+from stimuli.triggers import SYMBOL_BITS, WORD_COUNTER_SYMBOLS, wordPins
+
+"""
+TRIGGER DECODING
+
+Decoder of the strobe-coded words sent by the stimulation client on the pins
+of the parallel port (see stimuli/triggers), so that the trials can be labeled
+from a recorded digital channel alone, without the TCP messages.
+
+The input is a sampled record of the 8 pins, one port value (0-255) per
+sample: a digital channel of the acquisition board, or the digital lines
+stored in the metadata of every camera frame (the symbols must then last
+longer than a frame, see the strobeSymbolWidth of the trials). The symbols are
+read on the rising edges of the strobe bit and grouped into words: a group is
+accepted only if its symbols are close enough in time and its checksum is
+valid, otherwise the decoder drops the first symbol and tries again from the
+next one (resynchronization), so that a corrupted or truncated word never
+shifts the labels of the following trials.
+
+decodeWords() returns, for every word, the sample (and time) of its first
+strobe, the shape and the trial counter. The counter (modulo 2**12) reveals
+lost words as gaps in the sequence: missingWords() counts them, including the
+words lost before the first and after the last decoded word if the expected
+first counter and number of words are given (the counters of a session start
+from 0, see stimuli/shapesStimuli).
+"""
+
+
+def readSymbols(samples, triggerPin=1):
+    # Sample index and value of the symbols (on the rising edges of the strobe)
+    samples = np.asarray(samples).astype(np.int64)
+    dataBits, strobeBit = wordPins(triggerPin)
+    strobe = (samples >> strobeBit) & 1
+    edges = np.flatnonzero(np.diff(strobe) > 0) + 1
+    symbols = np.zeros(len(edges), np.int64)
+    for i, bit in enumerate(dataBits):
+        symbols |= ((samples[edges] >> bit) & 1) << i
+    return edges, symbols
+
+
+def decodeWords(samples, times=None, triggerPin=1, counter=True, maxGap=None):
+    # Words of a sampled record of the port. times (seconds) of the samples are
+    # optional; maxGap is the longest interval between the strobes of a word,
+    # in seconds if times are given, in samples otherwise (by default 4 times
+    # the median interval between strobes).
+    nSymbols = 2 + (WORD_COUNTER_SYMBOLS if counter else 0)
+    edges, symbols = readSymbols(samples, triggerPin)
+    edgeTimes = edges.astype(float) if times is None else np.asarray(times)[edges]
+    if maxGap is None:
+        maxGap = 4 * np.median(np.diff(edgeTimes)) if len(edges) > 1 else np.inf
+
+    shapes = list(SHAPES)
+    words = []
+    i = 0
+    while i + nSymbols <= len(symbols):
+        word = symbols[i:i + nSymbols]
+        checksum = np.bitwise_xor.reduce(word[:-1])
+        if np.all(np.diff(edgeTimes[i:i + nSymbols]) <= maxGap) and checksum == word[-1] \
+                and word[0] < len(shapes):
+            count = None
+            if counter:
+                count = int(sum(int(s) << (SYMBOL_BITS * k) for k, s in enumerate(word[1:-1])))
+            words.append({'sample': int(edges[i]),
+                          'time': float(edgeTimes[i]),
+                          'shape': shapes[word[0]],
+                          'counter': count})
+            i += nSymbols
+        else:
+            i += 1
+    return words
+
+
+def missingWords(words, firstCounter=None, nWords=None):
+    # Number of words lost before every word (from the gaps of the counters),
+    # followed by the number lost after the last word. firstCounter is the
+    # counter of the first word sent (None: the first decoded word is not
+    # checked) and nWords the number of words sent from it (None: the end of
+    # the record is not checked).
+    modulo = 2**(SYMBOL_BITS * WORD_COUNTER_SYMBOLS)
+    counters = np.array([word['counter'] for word in words], np.int64)
+    if nWords is not None and firstCounter is None:
+        raise ValueError('nWords needs the counter of the first word (firstCounter)')
+    if not len(counters):
+        return np.array([nWords or 0])
+    first = counters[0] if firstCounter is None else firstCounter
+    lost = np.diff(counters, prepend=first - 1) % modulo - 1
+    after = 0
+    if nWords is not None:
+        after = max(nWords - 1 - (counters[-1] - first) % modulo, 0)
+    return np.append(lost, after)
+
+
+def samplesFromEvents(events, rate, start=None, end=None):
+    # Port record sampled at rate (Hz) from (time, value) events, e.g. the
+    # events of a MockBackend. Returns (samples, times).
+    eventTimes = np.array([t for t, _ in events])
+    values = np.array([v for _, v in events], np.uint8)
+    start = eventTimes[0] if start is None else start
+    end = eventTimes[-1] + 1 / rate if end is None else end
+    times = np.arange(start, end, 1 / rate)
+    indices = np.searchsorted(eventTimes, times, side='right') - 1
+    samples = np.where(indices >= 0, values[np.maximum(indices, 0)], 0).astype(np.uint8)
+    return samples, times
+
+
+if __name__ == '__main__':
+    from time import sleep
+    from stimuli.triggers import Trigger, MockBackend, encodeWord
+
+    # Words sent on a mock port, sampled at 10 kHz like a digital channel of
+    # the acquisition board, with a few samples corrupted
+    nTrials, symbolWidth, triggerPin = 40, 0.002, 1
+    rng = np.random.default_rng(0)
+    trigger = Trigger(MockBackend())
+    sent = []
+    for trial in range(nTrials):
+        shape = list(SHAPES)[rng.integers(len(SHAPES))]
+        trigger.pulse(2**(triggerPin - 1))
+        trigger.sendWord(encodeWord(list(SHAPES).index(shape), trial), 2**(triggerPin - 1),
+                         triggerPin, symbolWidth)
+        trigger.waitWord()
+        sent.append(shape)
+        sleep(0.01)
+
+    samples, times = samplesFromEvents(trigger.backend.events, rate=10000)
+    corrupted = rng.choice(len(samples), 3, replace=False)
+    samples[corrupted] ^= 0xFE
+    words = decodeWords(samples, times, triggerPin)
+    decoded = {word['counter']: word['shape'] for word in words}
+    correct = sum(decoded.get(trial) == shape for trial, shape in enumerate(sent))
+    print(f'{len(words)}/{nTrials} words decoded, {correct} labels correct, '
+          f'{int(missingWords(words, 0, nTrials).sum())} lost (counter gaps)')
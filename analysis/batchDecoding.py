@@ -0,0 +1,310 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy as np
+
+from acquisition.compressedStore import CompressedMovieStore
+from acquisition.movieStore import MovieStore
+from analysis.onlineDecoder import OnlineDecoder, poolMap
+from analysis.pcaFeatures import IncrementalPCA
+from analysis.responseAccumulator import responseMap
+
+"""
+BATCH DECODING
+
+Offline decoding of all the sessions recorded in a folder, in parallel.
+
+Every session is a movie store (MovieStore or CompressedMovieStore folder).
+The decoding runs in two parallel steps on a process pool:
+
+1.  Features: for every (session, window) the dR/R response maps of all the
+    trials are computed (window = baseline and response frames, as
+    RESPONSE_WINDOW in analysisTemplate.m) and mean-pooled. Workers open the
+    stores themselves and read the raw movies through memory maps, so no
+    movie is copied between processes. Features are cached on disk, in files
+    named after a hash of the preprocessing parameters: they are only
+    computed again when the session or the parameters change. Trials
+    flagged in the metadata as failing the quality control of the
+    acquisition (see acquisition/trialQC) are left out.
+
+2.  Decoding: every (session, fold, window) job trains a decoder (see
+    onlineDecoder) on the training trials and tests it on the others, with
+    either cross-validation:
+
+        'kfold'     within each session, trials split in k folds (the i-th
+                    repetition of every stimulus goes to fold i % k)
+        'loso'      leave one session out: train on all the other sessions,
+                    test on the left out one (same frame size required)
+
+The features can be reduced with a saved PCA basis (see pcaFeatures) fitted
+on the same features. Only the stimuli in shapes (default: all) are decoded.
+scaling() reports the wall time of the decoding with different numbers of
+workers.
+
+Example:
+    python -m analysis.batchDecoding SESSIONS_FOLDER --cv loso --workers 4
+    python -m analysis.batchDecoding --demo --scaling
+"""
+
+CV_METHODS = ('kfold', 'loso')
+
+
+def openStore(folder):
+    # Opens a MovieStore or CompressedMovieStore folder read only
+    with open(os.path.join(folder, 'store.json')) as f:
+        header = json.load(f)
+    if 'codec' in header:
+        return CompressedMovieStore(folder, 'r', workers=1)
+    return MovieStore(folder, 'r')
+
+
+def findSessions(folder):
+    # Session stores in a folder (or the folder itself if it is a store)
+    if os.path.exists(os.path.join(folder, 'store.json')):
+        return [folder]
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if os.path.exists(os.path.join(folder, name, 'store.json')))
+
+
+def sessionFeatures(session, window, pooling, shapes, cacheFolder):
+    # Features of all the trials of a session (cached). Returns the cache file.
+    baselineFrames, responseFrames = window
+    store = openStore(session)
+    stimuli = [s for s in store.stimuli if shapes is None or s in shapes]
+    # The cache key includes the size of the indexes, so that sessions still
+    # being recorded are recomputed
+    key = json.dumps([os.path.abspath(session), list(baselineFrames), list(responseFrames),
+                      pooling, stimuli, [store.repetitions(s) for s in stimuli]])
+    cacheFile = os.path.join(cacheFolder, os.path.basename(os.path.normpath(session)) + '-' +
+                             hashlib.sha1(key.encode()).hexdigest()[:16] + '.npz')
+    if os.path.exists(cacheFile):
+        return cacheFile
+
+    features, labels, repetitions = [], [], []
+    for stimulus in stimuli:
+        for repetition, metadata in enumerate(store.metadata(stimulus)):
+            # Trials that failed the quality control of the acquisition
+            if not (metadata or {}).get('qc', {}).get('passed', True):
+                continue
+            movie = store.read(stimulus, repetition)
+            features.append(poolMap(responseMap(movie, slice(*baselineFrames),
+                                                slice(*responseFrames)), pooling).ravel())
+            labels.append(stimulus)
+            repetitions.append(repetition)
+    store.close()
+    # Written to a temporary file first, so that a cache file is always complete
+    temporary = cacheFile[:-4] + f'.{os.getpid()}.tmp.npz'
+    np.savez(temporary, features=np.array(features, np.float32), labels=np.array(labels),
+             repetitions=np.array(repetitions))
+    os.replace(temporary, cacheFile)
+    return cacheFile
+
+
+def decodeJob(job):
+    # Trains a decoder on the training trials of the job and tests it on the
+    # test trials. Runs in the worker processes.
+    def load(parts):
+        features, labels = [], []
+        for cacheFile, selection in parts:
+            with np.load(cacheFile) as data:
+                features.append(data['features'][selection])
+                labels.append(data['labels'][selection])
+        return np.concatenate(features), np.concatenate(labels)
+
+    trainX, trainY = load(job['train'])
+    testX, testY = load(job['test'])
+    if job['pca'] is not None:
+        pca = IncrementalPCA.load(job['pca'])
+        trainX, testX = pca.transform(trainX), pca.transform(testX)
+    decoder = OnlineDecoder(job['classes'], job['method'], job['shrinkage'])
+    for x, y in zip(trainX, trainY):
+        decoder.update(x.astype(np.float64), y)
+    predicted = [decoder.predict(x.astype(np.float64)) for x in testX]
+    # Trials without a prediction (no trained class) count as errors
+    confusion = np.zeros((len(job['classes']),) * 2, int)
+    unpredicted = 0
+    for y, p in zip(testY, predicted):
+        if p is None:
+            unpredicted += 1
+            continue
+        confusion[job['classes'].index(y), job['classes'].index(p)] += 1
+    return {'session': job['session'], 'fold': job['fold'], 'window': job['window'],
+            'accuracy': float(np.trace(confusion) / max(len(testY), 1)),
+            'nTest': len(testY), 'unpredicted': unpredicted, 'confusion': confusion}
+
+
+class BatchDecoder:
+    def __init__(self,
+                folder,                     # Folder with the session stores
+                cacheFolder = None,         # Folder of the feature cache (default: folder/featureCache)
+                windows = (((0, 10), (9, 20)),), # (baseline, response) frame ranges to sweep
+                shapes = None,              # Stimuli to decode (default: all the recorded ones)
+                pooling = 4,                # Spatial pooling of the dR/R maps
+                method = 'lda',             # Decoder method (see OnlineDecoder)
+                shrinkage = 0.2,            # Shrinkage of the LDA variances
+                folds = 5,                  # Folds of the k-fold cross-validation
+                workers = None,             # Worker processes (default: CPU count)
+                pca = None,                 # Optional saved IncrementalPCA applied to the features
+                ):
+
+        self.sessions = findSessions(folder)
+        if not self.sessions:
+            raise FileNotFoundError(f'No session stores in {folder}')
+        self.cacheFolder = cacheFolder or os.path.join(folder, 'featureCache')
+        os.makedirs(self.cacheFolder, exist_ok=True)
+        self.windows = [tuple(tuple(w) for w in window) for window in windows]
+        self.shapes = list(shapes) if shapes is not None else None
+        self.pooling = pooling
+        self.method = method
+        self.shrinkage = shrinkage
+        self.folds = folds
+        self.workers = workers
+        self.pca = pca
+        self.cacheFiles = {}        # (session, window) -> feature cache file
+
+    def computeFeatures(self, workers=None):
+        # Computes (or finds in the cache) the features of every session and window
+        tasks = [(session, window) for session in self.sessions for window in self.windows]
+        with ProcessPoolExecutor(workers or self.workers) as pool:
+            futures = [pool.submit(sessionFeatures, session, window, self.pooling,
+                                   self.shapes, self.cacheFolder)
+                       for session, window in tasks]
+            self.cacheFiles = {task: future.result() for task, future in zip(tasks, futures)}
+        return self.cacheFiles
+
+    def jobs(self, cv='kfold'):
+        # (session, fold, window) decoding jobs of the cross-validation
+        if cv not in CV_METHODS:
+            raise ValueError(f"Invalid cross-validation '{cv}' (must be one of {CV_METHODS})")
+        if cv == 'loso' and len(self.sessions) < 2:
+            raise ValueError(f'Leave-one-session-out needs at least 2 sessions '
+                             f'(found {len(self.sessions)})')
+        if not self.cacheFiles:
+            self.computeFeatures()
+        labels, repetitions = {}, {}
+        for key, cacheFile in self.cacheFiles.items():
+            with np.load(cacheFile) as data:
+                labels[key], repetitions[key] = data['labels'], data['repetitions']
+        classes = self.shapes or sorted(set(np.concatenate(list(labels.values()))))
+
+        jobs = []
+        for window in self.windows:
+            for session in self.sessions:
+                key = (session, window)
+                job = {'session': session, 'window': window, 'classes': classes,
+                       'method': self.method, 'shrinkage': self.shrinkage,
+                       'pca': self.pca}
+                if cv == 'kfold':
+                    folds = repetitions[key] % self.folds
+                    for fold in range(self.folds):
+                        jobs.append(dict(job, fold=fold,
+                                         train=[(self.cacheFiles[key], folds != fold)],
+                                         test=[(self.cacheFiles[key], folds == fold)]))
+                else:
+                    others = [s for s in self.sessions if s != session]
+                    jobs.append(dict(job, fold=0,
+                                     train=[(self.cacheFiles[(s, window)],
+                                             np.ones(len(labels[(s, window)]), bool))
+                                            for s in others],
+                                     test=[(self.cacheFiles[key],
+                                            np.ones(len(labels[key]), bool))]))
+        return jobs
+
+    def run(self, cv='kfold', workers=None):
+        # Runs all the decoding jobs. Returns one result per job.
+        jobs = self.jobs(cv)
+        with ProcessPoolExecutor(workers or self.workers) as pool:
+            return list(pool.map(decodeJob, jobs))
+
+    def summary(self, results):
+        # Accuracy of every window, over all the sessions and folds (the
+        # unpredicted trials count as errors)
+        summary = {}
+        for window in self.windows:
+            selected = [r for r in results if r['window'] == window]
+            confusion = sum(r['confusion'] for r in selected)
+            perSession = {}
+            for r in selected:
+                perSession.setdefault(r['session'], []).append(r)
+            summary[window] = {
+                'accuracy': float(np.trace(confusion) / max(sum(r['nTest'] for r in selected), 1)),
+                'sessions': {s: float(sum(np.trace(r['confusion']) for r in rs) /
+                                      max(sum(r['nTest'] for r in rs), 1))
+                             for s, rs in perSession.items()},
+                'unpredicted': sum(r['unpredicted'] for r in selected),
+                'confusion': confusion,
+            }
+        return summary
+
+    def scaling(self, workerCounts=(1, 2, 4), cv='kfold'):
+        # Wall time of the decoding jobs with every number of workers
+        self.computeFeatures()
+        times = {}
+        for workers in workerCounts:
+            t = perf_counter()
+            self.run(cv, workers)
+            times[workers] = perf_counter() - t
+        return times
+
+
+def makeDemoSessions(folder, nSessions=3, nRepetitions=10, nFrames=30,
+                     frameShape=(128, 128), seed=0):
+    # Simulated sessions (see simulatedClient), to try the batch decoding
+    from acquisition.simulatedClient import shapeResponseMaps
+    from stimuli.shapeGeometry import SHAPES
+    rng = np.random.default_rng(seed)
+    responses = shapeResponseMaps(SHAPES, frameShape, amplitude=-0.003)
+    for session in range(nSessions):
+        with MovieStore(os.path.join(folder, f'session{session+1}')) as store:
+            for repetition in range(nRepetitions):
+                for shape in rng.permutation(list(SHAPES)):
+                    movie = rng.normal(2000, 20, (nFrames,) + frameShape)
+                    movie[9:20] += 2000 * responses[shape]
+                    store.write(shape, movie.astype(np.uint16))
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser(description='Offline decoding of the sessions '
+                                                 'recorded in a folder')
+    parser.add_argument('folder', nargs='?', help='folder with the session stores')
+    parser.add_argument('--demo', action='store_true',
+                        help='decode simulated sessions in a temporary folder')
+    parser.add_argument('--cv', choices=CV_METHODS, default='kfold')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shapes', nargs='+', default=None)
+    parser.add_argument('--pca', metavar='FILE', help='saved PCA basis of the features')
+    parser.add_argument('--scaling', action='store_true',
+                        help='report the wall time with 1, 2, 4... workers')
+    args = parser.parse_args()
+    if args.folder is None and not args.demo:
+        parser.error('a folder or --demo is required')
+
+    folder = args.folder
+    if args.demo:
+        folder = tempfile.mkdtemp()
+        print(f'Simulating sessions in {folder}...')
+        makeDemoSessions(folder)
+
+    windows = [((0, 10), (9, 20)), ((0, 10), (20, 30)), ((0, 5), (9, 15))]
+    decoder = BatchDecoder(folder, windows=windows, shapes=args.shapes, folds=args.folds,
+                           workers=args.workers, pca=args.pca)
+    t = perf_counter()
+    decoder.computeFeatures()
+    print(f'Features of {len(decoder.sessions)} sessions x {len(windows)} windows: '
+          f'{perf_counter() - t:.1f} s')
+    results = decoder.run(args.cv)
+    for window, summary in decoder.summary(results).items():
+        print(f"Baseline {window[0]} response {window[1]}: "
+              f"accuracy {100*summary['accuracy']:.1f}% ({args.cv})")
+    if args.scaling:
+        counts = [1]
+        while counts[-1] * 2 <= (os.cpu_count() or 1) * 2:
+            counts.append(counts[-1] * 2)
+        times = decoder.scaling(counts, args.cv)
+        for workers, elapsed in times.items():
+            print(f'  {workers} workers: {elapsed:6.2f} s (speed-up {times[1]/elapsed:.1f}x)')
@@ -0,0 +1,214 @@
+from time import perf_counter
+import numpy as np
+
+from analysis.responseAccumulator import responseMap
+from stimuli.shapeGeometry import SHAPES
+
+"""
+OnlineDecoder CLASS
+
+Trial-by-trial decoder of the stimulus from the dR/R response, updated online
+as the trials arrive from the acquisition loop.
+
+The features of a trial are its dR/R response map (see responseAccumulator),
+mean-pooled over pooling x pooling pixels, optionally transformed by a
+feature transform (e.g. a fitted PCA basis, see pcaFeatures) given as a
+callable features -> features.
+
+Two incremental classifiers are available, both updated in O(features) per
+trial from running per-class means and variances (Welford):
+
+    'centroid'  nearest centroid (euclidean distance to the class means)
+    'lda'       diagonal LDA with shrinkage: the pooled within-class variance
+                of every feature is shrunk towards the average variance
+                (shrinkage 0: plain diagonal LDA, 1: scaled nearest centroid)
+
+Every trial is first predicted and then used for training (prequential
+evaluation), so the running accuracy is always measured on unseen trials.
+The time spent on features, prediction and update is recorded for every trial
+and compared by timingReport() with the budget (the inter-trial interval).
+
+The decoder can be used directly as a trial processor of the AcquisitionServer
+(the trials that fail the quality control of the server are skipped).
+"""
+
+
+def poolMap(image, pooling):
+    # Mean over pooling x pooling blocks of a 2D map (incomplete blocks dropped)
+    if pooling == 1:
+        return image
+    h, w = image.shape[0] // pooling, image.shape[1] // pooling
+    return image[:h*pooling, :w*pooling].reshape(h, pooling, w, pooling).mean(axis=(1, 3))
+
+
+class OnlineDecoder:
+    def __init__(self,
+                classes = None,             # Stimuli to decode (default: all the shapes)
+                method = 'lda',             # 'lda' or 'centroid'
+                shrinkage = 0.2,            # Shrinkage of the LDA variances [0, 1]
+                pooling = 4,                # Spatial pooling of the dR/R maps
+                baselineFrames = (0, 10),   # [first, last) frames of the baseline
+                responseFrames = (9, 20),   # [first, last) frames of the response
+                transform = None,           # Optional feature transform (e.g. PCA)
+                budget = 1.,                # Seconds available per trial (inter-trial interval)
+                ):
+
+        if method not in ('lda', 'centroid'):
+            raise ValueError(f"Invalid method '{method}' (must be 'lda' or 'centroid')")
+        if not 0 <= shrinkage <= 1:
+            raise ValueError(f'Shrinkage must be in [0, 1] (got {shrinkage})')
+        self.classes = list(classes) if classes is not None else list(SHAPES)
+        self.method = method
+        self.shrinkage = shrinkage
+        self.pooling = pooling
+        self.baselineFrames = slice(*baselineFrames)
+        self.responseFrames = slice(*responseFrames)
+        self.transform = transform
+        self.budget = budget
+
+        self.counts = np.zeros(len(self.classes), int)
+        self.means = None           # (classes, features), allocated on the first trial
+        self.m2 = None              # per-class sums of squared deviations
+        self.confusion = np.zeros((len(self.classes),) * 2, int)
+        self.predictions = []       # (trial, true, predicted) for every trial
+        self.timings = []           # seconds of features, predict, update per trial
+
+    #---------------------------------------------------------------------------
+    #--- DECODING
+    #---------------------------------------------------------------------------
+
+    def features(self, movie):
+        # Feature vector of a trial movie (nFrames, height, width)
+        x = poolMap(responseMap(movie, self.baselineFrames, self.responseFrames),
+                    self.pooling).ravel()
+        if self.transform is not None:
+            x = self.transform(x)
+        return np.asarray(x, np.float64)
+
+    def scores(self, x):
+        # Score of every trained class (the higher the more likely), NaN for
+        # the classes without trials
+        scores = np.full(len(self.classes), np.nan)
+        trained = self.counts > 0
+        if not trained.any():
+            return scores
+        sqDistances = (x - self.means[trained])**2
+        if self.method == 'lda':
+            sqDistances /= self.variances()
+        scores[trained] = -0.5 * sqDistances.sum(axis=1)
+        return scores
+
+    def variances(self):
+        # Pooled within-class variance of every feature, shrunk towards the
+        # average variance
+        dof = self.counts.sum() - (self.counts > 0).sum()
+        if dof < 1:
+            return np.ones(self.means.shape[1])
+        pooled = self.m2.sum(axis=0) / dof
+        shrunk = (1 - self.shrinkage) * pooled + self.shrinkage * pooled.mean()
+        # Guard against constant features
+        return np.maximum(shrunk, np.finfo(np.float64).tiny)
+
+    def predict(self, x):
+        # Predicted stimulus (None before the first trial)
+        scores = self.scores(x)
+        if np.isnan(scores).all():
+            return None
+        return self.classes[int(np.nanargmax(scores))]
+
+    def update(self, x, stimulus):
+        # Adds a trial of the stimulus to the model (Welford update)
+        if self.means is None:
+            self.means = np.zeros((len(self.classes), len(x)))
+            self.m2 = np.zeros((len(self.classes), len(x)))
+        k = self.classes.index(stimulus)
+        self.counts[k] += 1
+        delta = x - self.means[k]
+        self.means[k] += delta / self.counts[k]
+        self.m2[k] += delta * (x - self.means[k])
+
+    def processTrial(self, stimulus, movie, trial=None):
+        # Predicts the stimulus of a trial, then trains on it. Returns the
+        # prediction.
+        if stimulus not in self.classes:
+            raise NameError(f"Stimulus '{stimulus}' is not one of the decoded "
+                            f"classes {self.classes}")
+        t0 = perf_counter()
+        x = self.features(movie)
+        t1 = perf_counter()
+        predicted = self.predict(x)
+        t2 = perf_counter()
+        self.update(x, stimulus)
+        t3 = perf_counter()
+
+        self.timings.append((t1 - t0, t2 - t1, t3 - t2))
+        self.predictions.append((trial, stimulus, predicted))
+        if predicted is not None:
+            self.confusion[self.classes.index(stimulus), self.classes.index(predicted)] += 1
+        return predicted
+
+    def __call__(self, entry, ack, movie, timestamps):
+        # Trial processor of the AcquisitionServer. Trials that failed the
+        # quality control (see acquisition/trialQC) are skipped.
+        if entry.get('qc', {}).get('passed', True):
+            self.processTrial(entry['shape'], movie, entry['trial'])
+
+    #---------------------------------------------------------------------------
+    #--- REPORTS
+    #---------------------------------------------------------------------------
+
+    @property
+    def accuracy(self):
+        # Running (prequential) accuracy over the predicted trials
+        predicted = self.confusion.sum()
+        return np.trace(self.confusion) / predicted if predicted else np.nan
+
+    def runningAccuracy(self):
+        # Accuracy after every predicted trial
+        correct = [true == predicted for _, true, predicted in self.predictions
+                   if predicted is not None]
+        return np.cumsum(correct) / np.arange(1, len(correct) + 1)
+
+    def timingReport(self):
+        timings = np.array(self.timings).reshape(-1, 3)
+        total = timings.sum(axis=1)
+        report = {stage: {'mean': float(timings[:, i].mean()), 'max': float(timings[:, i].max())}
+                  for i, stage in enumerate(('features', 'predict', 'update'))
+                  if len(timings)}
+        report['total'] = {'mean': float(total.mean()), 'max': float(total.max())} \
+            if len(total) else {}
+        report['budget'] = self.budget
+        report['withinBudget'] = bool(len(total) and total.max() < self.budget)
+        return report
+
+    def printReport(self):
+        print(f'Decoded {len(self.predictions)} trials, accuracy {100*self.accuracy:.1f}% '
+              f'(chance {100/len(self.classes):.1f}%)')
+        report = self.timingReport()
+        for stage in ('features', 'predict', 'update', 'total'):
+            if report.get(stage):
+                print(f"  {stage:<9} mean {1e3*report[stage]['mean']:8.2f} ms   "
+                      f"max {1e3*report[stage]['max']:8.2f} ms")
+        print(f"  budget {1e3*report['budget']:.0f} ms per trial: "
+              f"{'OK' if report['withinBudget'] else 'EXCEEDED'}")
+
+
+if __name__ == '__main__':
+    # Decoding of simulated trials of all the shapes, with the responses of
+    # the simulated stimulation client
+    from acquisition.simulatedClient import shapeResponseMaps
+
+    nRepetitions, nFrames, frameShape = 10, 30, (512, 512)
+    rng = np.random.default_rng(0)
+    responses = shapeResponseMaps(SHAPES, frameShape, amplitude=-0.002)
+    noise = rng.normal(0, 20, (8, nFrames) + frameShape).astype(np.float32)
+
+    decoder = OnlineDecoder()
+    for repetition in range(nRepetitions):
+        for shape in rng.permutation(list(SHAPES)):
+            movie = 2000 + np.roll(noise[rng.integers(len(noise))],
+                                   rng.integers(frameShape[1]), axis=2)
+            movie[9:20] += 2000 * responses[shape]
+            decoder.processTrial(shape, movie.astype(np.uint16))
+    print(f'{nRepetitions} repetitions of {len(SHAPES)} shapes, {nFrames} frames {frameShape}')
+    decoder.printReport()
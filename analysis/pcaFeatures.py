@@ -0,0 +1,217 @@
+import json
+import numpy as np
+
+"""
+IncrementalPCA CLASS
+
+Dimensionality reduction of the trial features (e.g. pooled dR/R maps, or
+whole dR/R movies with responseMovie()) before the decoder.
+
+The PCA basis is fitted incrementally over batches of trials (incremental SVD:
+the current basis, scaled by its singular values, is stacked with the centered
+new batch and a mean correction, and the SVD of the stack is truncated).
+Only the kept components + batch size vectors are in memory at any time, so
+the basis can be fitted over any number of trials streamed from the movie
+stores.
+
+The truncation after every batch drops the variance outside the kept
+components, so the result is an approximation of the exact PCA, worst for the
+last components. To limit the error, nComponents + oversampling components are
+kept during the fit and only the first nComponents are used. The accuracy
+depends on the spectrum of the features: with a decaying spectrum (e.g. 300
+trials of 50 features with singular values falling by 15% per component,
+batches of 37 trials, see tests/test_pcaFeatures.py) the default oversampling
+(nComponents) gives singular values within 0.1% of the largest one and
+components aligned with the exact ones (|cosine| > 0.999). Components whose
+singular values are close to those of the discarded ones are mixed with them,
+and with a flat spectrum even their subspace is approximate (as it is from
+sample to sample for the exact PCA). A larger oversampling or larger batches
+make the basis more accurate; the fit is exact if nComponents + oversampling
+reaches the number of features, or if a single batch holds all the trials.
+
+A fitted basis projects any new trial to nComponents features. It can be saved
+and loaded again (e.g. to reuse it across the sessions of the same animal),
+and plugs into OnlineDecoder (transform=pca) and BatchDecoder (pca=file).
+"""
+
+
+def responseMovie(movie, baselineFrames=slice(0, 10), frames=slice(None), pooling=4):
+    # dR/R movie (float32) of the frames of a trial movie (nFrames, height,
+    # width), mean-pooled over pooling x pooling pixels, as one flat vector.
+    # Computed one frame at a time (no float copy of the whole movie).
+    from analysis.onlineDecoder import poolMap
+    baseline = np.mean(movie[baselineFrames], axis=0, dtype=np.float32)
+    frameBuffer = np.empty(baseline.shape, np.float32)
+    pooled = []
+    for frame in movie[frames]:
+        np.divide(frame, baseline, out=frameBuffer)
+        np.subtract(frameBuffer, 1, out=frameBuffer)
+        pooled.append(poolMap(frameBuffer, pooling).ravel())
+    return np.concatenate(pooled)
+
+
+class IncrementalPCA:
+    def __init__(self,
+                nComponents = 20,           # Number of principal components kept
+                whiten = False,             # Scale the features to unit variance
+                oversampling = None,        # Extra components kept during the fit
+                                            # (default: nComponents)
+                ):
+
+        self.nComponents = nComponents
+        self.whiten = whiten
+        self.oversampling = nComponents if oversampling is None else oversampling
+        self.nSamples = 0
+        self.mean = None
+        self._components = None     # (nComponents + oversampling, nFeatures)
+        self._singularValues = None
+        self.metadata = {}          # Free description saved with the basis
+
+    #---------------------------------------------------------------------------
+    #--- FITTING
+    #---------------------------------------------------------------------------
+
+    def partialFit(self, batch):
+        # Updates the basis with a batch of trials (nTrials, nFeatures)
+        batch = np.atleast_2d(np.asarray(batch, np.float64))
+        nBatch = len(batch)
+        batchMean = batch.mean(axis=0)
+        if self.nSamples == 0:
+            stack = batch - batchMean
+            mean = batchMean
+        else:
+            if batch.shape[1] != len(self.mean):
+                raise ValueError(f'Batch has {batch.shape[1]} features instead of '
+                                 f'{len(self.mean)}')
+            total = self.nSamples + nBatch
+            correction = np.sqrt(self.nSamples * nBatch / total) * (self.mean - batchMean)
+            stack = np.vstack([self._singularValues[:, None] * self._components,
+                               batch - batchMean, correction])
+            mean = self.mean + (batchMean - self.mean) * nBatch / total
+
+        _, s, vt = np.linalg.svd(stack, full_matrices=False)
+        k = min(self.nComponents + self.oversampling, len(s))
+        # Deterministic signs: largest loading of every component positive
+        signs = np.sign(vt[np.arange(k), np.abs(vt[:k]).argmax(axis=1)])
+        signs[signs == 0] = 1
+        self._components = vt[:k] * signs[:, None]
+        self._singularValues = s[:k]
+        self.mean = mean
+        self.nSamples += nBatch
+        return self
+
+    def fit(self, trials, batchSize=50):
+        # Fits the basis on an iterable of feature vectors (e.g. a generator
+        # reading the trials from a store), batchSize trials at a time
+        batch = []
+        for x in trials:
+            batch.append(np.ravel(x))
+            if len(batch) == batchSize:
+                self.partialFit(batch)
+                batch = []
+        if batch:
+            self.partialFit(batch)
+        return self
+
+    #---------------------------------------------------------------------------
+    #--- PROJECTION
+    #---------------------------------------------------------------------------
+
+    @property
+    def components(self):
+        # (nComponents, nFeatures)
+        if self._components is None:
+            return None
+        return self._components[:self.nComponents]
+
+    @property
+    def singularValues(self):
+        if self._singularValues is None:
+            return None
+        return self._singularValues[:self.nComponents]
+
+    @property
+    def explainedVariance(self):
+        return self.singularValues**2 / max(self.nSamples - 1, 1)
+
+    def transform(self, x):
+        # Projects a trial (nFeatures,) or trials (nTrials, nFeatures)
+        if self.components is None:
+            raise RuntimeError('The PCA basis has not been fitted')
+        features = (np.asarray(x, np.float64) - self.mean) @ self.components.T
+        if self.whiten:
+            features /= np.sqrt(self.explainedVariance)
+        return features
+
+    __call__ = transform
+
+    def inverseTransform(self, features):
+        if self.whiten:
+            features = features * np.sqrt(self.explainedVariance)
+        return features @ self.components + self.mean
+
+    #---------------------------------------------------------------------------
+    #--- PERSISTENCE
+    #---------------------------------------------------------------------------
+
+    def save(self, path):
+        # The oversampled components are saved too, to go on with the fit
+        np.savez(path, mean=self.mean, components=self._components,
+                 singularValues=self._singularValues, nSamples=self.nSamples,
+                 settings=json.dumps({'nComponents': self.nComponents,
+                                      'whiten': self.whiten,
+                                      'oversampling': self.oversampling,
+                                      'metadata': self.metadata}))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            settings = json.loads(str(data['settings']))
+            pca = cls(settings['nComponents'], settings['whiten'],
+                      settings.get('oversampling', 0))
+            pca.mean = data['mean']
+            pca._components = data['components']
+            pca._singularValues = data['singularValues']
+            pca.nSamples = int(data['nSamples'])
+        pca.metadata = settings['metadata']
+        return pca
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from time import perf_counter
+    from acquisition.simulatedClient import shapeResponseMaps
+    from analysis.onlineDecoder import OnlineDecoder
+    from stimuli.shapeGeometry import SHAPES
+
+    # Basis fitted on a simulated "previous session", then used to decode a
+    # new one online, compared with the decoding of the pooled pixels
+    nRepetitions, nFrames, frameShape = 8, 30, (256, 256)
+    rng = np.random.default_rng(0)
+    responses = shapeResponseMaps(SHAPES, frameShape, amplitude=-0.003)
+
+    def session():
+        for repetition in range(nRepetitions):
+            for shape in rng.permutation(list(SHAPES)):
+                movie = rng.normal(2000, 20, (nFrames,) + frameShape).astype(np.float32)
+                movie[9:20] += 2000 * responses[shape]
+                yield shape, movie.astype(np.uint16)
+
+    features = OnlineDecoder(pooling=2).features
+    t = perf_counter()
+    pca = IncrementalPCA(nComponents=30).fit(features(movie) for _, movie in session())
+    print(f'Fitted {pca.nComponents} components on {pca.nSamples} trials '
+          f'({len(pca.mean)} features) in {perf_counter() - t:.1f} s')
+    path = os.path.join(tempfile.mkdtemp(), 'pca.npz')
+    pca.save(path)
+    pca = IncrementalPCA.load(path)
+
+    decoders = {'pixels': OnlineDecoder(pooling=2),
+                'pca': OnlineDecoder(pooling=2, transform=pca)}
+    for shape, movie in session():
+        for decoder in decoders.values():
+            decoder.processTrial(shape, movie)
+    for name, decoder in decoders.items():
+        print(f'{name}:', end=' ')
+        decoder.printReport()
@@ -0,0 +1,141 @@
+import threading
+import numpy as np
+
+"""
+ResponseAccumulator CLASS
+
+Online average of the dR/R responses of every stimulus, Python counterpart of
+dRoR.m + updatePreviewFigure.m.
+
+For every trial the response map is
+
+    dR/R = mean(response frames) / mean(baseline frames) - 1
+
+which is the mean over the response window of the dR/R movie of dRoR.m,
+computed from two frame-sized float32 means of the uint16 movie (no float copy
+of the whole movie). By default the baseline is frames 0:10 and the response
+frames 9:20, as in updatePreviewFigure.m.
+
+The maps of the trials of each stimulus are accumulated with Welford's
+algorithm: for every pixel the running mean and variance across trials are
+updated in place, in O(pixels) per trial, so that the current average map,
+SNR map (mean / standard error of the mean) and number of trials of every
+stimulus are always available, also at full sensor resolution.
+
+The accumulator can be used directly as a trial processor of the
+AcquisitionServer (the trials that fail the quality control of the server are
+skipped); the maps can be read from any thread.
+"""
+
+
+def responseMap(movie, baselineFrames=slice(0, 10), responseFrames=slice(9, 20),
+                out=None, baseline=None):
+    # dR/R response map (float32) of a trial movie (nFrames, height, width).
+    # baseline is an optional frame-sized float32 work buffer.
+    if out is None:
+        out = np.empty(movie.shape[1:], np.float32)
+    if baseline is None:
+        baseline = np.empty(movie.shape[1:], np.float32)
+    np.mean(movie[baselineFrames], axis=0, dtype=np.float32, out=baseline)
+    np.mean(movie[responseFrames], axis=0, dtype=np.float32, out=out)
+    np.divide(out, baseline, out=out)
+    np.subtract(out, 1, out=out)
+    return out
+
+
+class ResponseAccumulator:
+    def __init__(self,
+                frameShape,                 # (height, width) of the frames
+                baselineFrames = (0, 10),   # [first, last) frames of the baseline
+                responseFrames = (9, 20),   # [first, last) frames of the response
+                ):
+
+        self.frameShape = tuple(frameShape)
+        self.baselineFrames = slice(*baselineFrames)
+        self.responseFrames = slice(*responseFrames)
+        self.counts = {}            # stimulus -> number of trials
+        self._means = {}            # stimulus -> running mean of dR/R
+        self._m2 = {}               # stimulus -> running sum of squared deviations
+        # Frame-sized work buffers
+        self._baseline = np.empty(self.frameShape, np.float32)
+        self._response = np.empty(self.frameShape, np.float32)
+        self._delta = np.empty(self.frameShape, np.float32)
+        self._lock = threading.Lock()
+
+    def responseMap(self, movie, out=None):
+        return responseMap(movie, self.baselineFrames, self.responseFrames, out,
+                           self._baseline)
+
+    def add(self, stimulus, movie):
+        # Adds a trial of the stimulus. Returns the number of trials of the
+        # stimulus.
+        with self._lock:
+            if stimulus not in self.counts:
+                self.counts[stimulus] = 0
+                self._means[stimulus] = np.zeros(self.frameShape, np.float32)
+                self._m2[stimulus] = np.zeros(self.frameShape, np.float32)
+            x = self.responseMap(movie, out=self._response)
+            mean, m2, delta = self._means[stimulus], self._m2[stimulus], self._delta
+            self.counts[stimulus] += 1
+
+            # Welford update: mean += (x - mean)/n; m2 += (x - oldMean)*(x - mean)
+            np.subtract(x, mean, out=delta)
+            mean += delta / self.counts[stimulus]
+            np.subtract(x, mean, out=x)
+            np.multiply(delta, x, out=delta)
+            m2 += delta
+            return self.counts[stimulus]
+
+    def __call__(self, entry, ack, movie, timestamps):
+        # Trial processor of the AcquisitionServer. Trials that failed the
+        # quality control (see acquisition/trialQC) are skipped.
+        if entry.get('qc', {}).get('passed', True):
+            self.add(entry['shape'], movie)
+
+    def reset(self, stimulus=None):
+        with self._lock:
+            for stim in ([stimulus] if stimulus is not None else list(self.counts)):
+                self.counts.pop(stim, None)
+                self._means.pop(stim, None)
+                self._m2.pop(stim, None)
+
+    @property
+    def stimuli(self):
+        return list(self.counts)
+
+    def average(self, stimulus):
+        # Average dR/R map of the trials of the stimulus
+        with self._lock:
+            return self._means[stimulus].copy()
+
+    def variance(self, stimulus):
+        # Variance across trials of the dR/R of every pixel
+        with self._lock:
+            n = self.counts[stimulus]
+            if n < 2:
+                return np.full(self.frameShape, np.nan, np.float32)
+            return self._m2[stimulus] / (n - 1)
+
+    def snr(self, stimulus):
+        # Average dR/R map divided by its standard error
+        with self._lock:
+            n = self.counts[stimulus]
+            if n < 2:
+                return np.full(self.frameShape, np.nan, np.float32)
+            sem = np.sqrt(self._m2[stimulus] / (n * (n - 1)))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return self._means[stimulus] / sem
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+
+    nTrials, nFrames, frameShape = 10, 60, (2048, 2048)
+    rng = np.random.default_rng(0)
+    movie = rng.normal(2000, 20, (nFrames,) + frameShape).astype(np.uint16)
+    accumulator = ResponseAccumulator(frameShape)
+    t = perf_counter()
+    for _ in range(nTrials):
+        accumulator.add('cross', movie)
+    elapsed = (perf_counter() - t) / nTrials
+    print(f'{frameShape} x {nFrames} frames: {1e3*elapsed:.0f} ms per trial')
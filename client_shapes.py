@@ -1,274 +1,145 @@
-from psychopy import visual, monitors, parallel
-from stimuli.shapesStimuli import Trial_flickeringShapes
-import socket
-from time import sleep
+from psychopy import logging
+from stimuli.sessionConfig import StimulusSession
+from stimuli.sessionSchedule import SessionSchedule
+from stimuli.eventLog import EventLog
+from communication.tcpProtocol import ackPayload
+from communication.controlChannel import ControlChannel
+import json
+import os
+import sys
+from time import perf_counter, sleep
 
 # ------------------------------------------------------------------------------
-# -- PARAMETERS DEFINITIONS
+# -- SESSION CONFIG
 # ------------------------------------------------------------------------------
 
-# TRIGGER
-# ---------------
-triggerPin = 1
-
-# STIMULI
-# ---------------
-shapesWidth = 20
-shapesStroke = 2
-chkbrdTempFreq = 5
-chkbrdSpFreq = 0.08
-chkbrdContrast = 0.8
-prestimFrames = 60
-stimFrames = 60
-postStimFrames = 240
-
-# MONITOR
-# ---------------
-distanceCm = 20
-monitorWidthCm = 52
-monitorResolution = [1920, 1080]
-
-# TPC/IP Communication
-# ---------------
-TCP_ip = '192.168.1.2'      # IP address of the recording machine
-TCP_port = 40000            # Port to use
-TCP_buffSize = 4096
+# All the parameters of the session (monitor, trigger, stimuli, TCP/IP, event
+# log) are in a JSON or TOML config file, given as the first argument
+# (default: session.toml next to this script). Missing keys take the defaults
+# of stimuli/sessionConfig.
+configPath = sys.argv[1] if len(sys.argv) > 1 else \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session.toml')
 
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
 
-# Setup some monitor parameters
-mon = monitors.Monitor('TestMonitor')
-mon.setDistance(distanceCm)
-mon.setWidth(monitorWidthCm)
-
-# Setup the parallel port
-pPort = parallel.ParallelPort(address = '0xD010')
-pPort.setData(int("00000001",2))
+session = StimulusSession(configPath if os.path.exists(configPath) else None)
+config = session.config
 
-# Create the main stimulation window
-stimWin = visual.Window(
-    size = monitorResolution,
-    screen = 0,
-    fullscr = True,
-    units = 'deg',
-    monitor = mon,
-    allowStencil = True)
+# Everything that happens in the session goes to the event log, on the clock
+# of the flips. Messages and warnings are also printed by its flush thread.
+eventLog = EventLog(config['eventLog']['path'], clock=logging.defaultClock.getTime,
+                    echo=('message', 'warning'))
 
-# Create the aperture object
-mask = visual.Aperture(stimWin)
+# Open the stimulation window and the parallel port. Trigger pulses are timed
+# with a busy-wait, sent right after the first flip of each trial and logged.
+# The shapes are only declared: nothing is built yet.
+session.open()
+trigger = session.trigger
 
-# Create the cross stimulus object
-cross = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='cross',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
-# Create the  circle stimulus object
-circle = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='circle',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
-# Create the  triangle stimulus object
-triangle = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='triangle',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
+# Start TCP/IP communication with the server PC. The connection is handled
+# by an I/O thread that keeps reading the socket during the trials (heartbeats,
+# abort, pause/resume, status) and reconnects if the connection drops.
+tcp = config['tcp']
+channel = ControlChannel(tcp['ip'], tcp['port'], buffSize=tcp['buffSize'], eventLog=eventLog)
+channel.start()
 
-# Create the  square stimulus object
-square = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='square',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
+# Warm-up while the channel connects: the trials of all the shapes are built
+# on a thread pool, then their apertures (or pre-rendered frames)
+warmUpTime = session.warmUp()
+eventLog.log('message', text=f'Warm-up of {len(session.bank.shapes)} shapes: '
+                             f'{warmUpTime:.2f} s')
 
-# Create the  h_letter stimulus object
-h_letter = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='h_letter',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
 
-# Create the  v_letter stimulus object
-v_letter = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='v_letter',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
+def endTrial(trialIndex, shape, trial, timing, seed=None):
+    channel.send('ACK', trialIndex, ackPayload(trialIndex, shape, timing, seed))
+    eventLog.logTrial(trialIndex, shape, trial, timing)
+    eventLog.log('message', trialIndex, timing['dropped'],
+                 f'End of trial {trialIndex}{" (ABORTED)" if timing["aborted"] else ""}'
+                 f' - dropped frames: {timing["dropped"]} (stim: {timing["droppedStim"]})')
 
-# Create the  star stimulus object
-star = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='star',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
 
-# Create the  t_letter stimulus object
-t_letter = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='t_letter',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
-
-# Create the  s_letter stimulus object
-s_letter = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='s_letter',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
-
-# Create the  s_letter stimulus object
-w_letter = Trial_flickeringShapes(
-    stimWin,
-    mask,
-    pPort = pPort,
-    triggerPin=triggerPin,
-    shape='w_letter',
-    width = shapesWidth,
-    stroke = shapesStroke,
-    chkbrdTempFreq = chkbrdTempFreq,
-    chkbrdSpFreq = chkbrdSpFreq,
-    chkbrdContrast = chkbrdContrast,
-    prestimFrames = prestimFrames,
-    stimFrames = stimFrames,
-    postStimFrames = postStimFrames
-    )
-
-# Start TCP/IP communication with the server PC
-tcpObj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-tcpObj.connect((TCP_ip, TCP_port))
-tcpObj.settimeout(60)
+def commandError(msg, error):
+    # A command that cannot be applied is logged and reported to the server
+    # (an ERROR for the trial, so that it does not wait for its ACK), without
+    # stopping the session
+    eventLog.log('warning', msg.trial, text=f'{msg.type} not applied: {error}')
+    channel.send('ERROR', msg.trial, json.dumps({'command': msg.type, 'error': str(error)}))
 
 
 # MAIN STIMULATION LOOP
-# The code will sit waiting for incoming messages.
-# When it recieves one it will parse it and start the appropriate trial
-while True:
-    msg = tcpObj.recv(TCP_buffSize)
-    msg = msg.decode('utf8')
-    print(f'TRIAL: {msg}')
-
-    if msg == 'cross':
-        cross.doTrial()
-        print('End of Trial')
-    elif msg == 'circle':
-        circle.doTrial()
-        print('End of Trial')
-    elif msg == 'triangle':
-        triangle.doTrial()
-        print('End of Trial')
-    elif msg == 'square':
-        square.doTrial()
-        print('End of Trial')
-    elif msg == 'h_letter':
-        h_letter.doTrial()
-        print('End of Trial')
-    elif msg == 'v_letter':
-        v_letter.doTrial()
-        print('End of Trial')
-    elif msg == 'star':
-        star.doTrial()
-        print('End of Trial')
-    elif msg == 't_letter':
-        t_letter.doTrial()
-        print('End of Trial')
-    elif msg == 's_letter':
-        s_letter.doTrial()
-        print('End of Trial')
-    elif msg == 'w_letter':
-        w_letter.doTrial()
-        print('End of Trial')
-    elif msg == 'stop':
-        break
\ No newline at end of file
+# The code will sit waiting for the trial commands received by the channel
+# (see communication/tcpProtocol). Trials can either be sent one by one (TRIAL)
+# or uploaded at the start of the session (SCHEDULE) and then started with a
+# GO token. While paused, queued commands wait until the server resumes.
+# A CONFIG message applies a new config to the open window.
+schedule = SessionSchedule(session.bank)
+running = True
+while running:
+    if channel.paused.is_set():
+        channel.status['state'] = 'paused'
+        sleep(0.01)
+        continue
+    channel.status['state'] = 'idle'
+    msg = channel.nextCommand(timeout=0.1)
+    if msg is None:
+        continue
+    for line in channel.malformed:
+        eventLog.log('warning', text=f'malformed message {line!r}')
+    channel.malformed.clear()
+
+    # An abort only refers to the trial running when it is received
+    channel.abort.clear()
+    if msg.type == 'TRIAL':
+        eventLog.log('message', msg.trial, text=f'TRIAL {msg.trial}: {msg.payload}')
+        if msg.payload not in session.bank:
+            commandError(msg, f'unknown shape {msg.payload!r}')
+            continue
+        channel.status.update(state='running', trial=msg.trial)
+        trial = session.bank.getTrial(msg.payload)
+        timing = trial.doTrial(abort=channel.abort)
+        endTrial(msg.trial, msg.payload, trial, timing)
+    elif msg.type == 'SCHEDULE':
+        try:
+            schedule.extend(json.loads(msg.payload))
+        except (ValueError, NameError, TypeError) as e:
+            commandError(msg, e)
+            continue
+        eventLog.log('message', text=f'SCHEDULE: {len(schedule)} trials queued')
+    elif msg.type == 'CONFIG':
+        channel.status['state'] = 'configuring'
+        # The new config is warmed up before it replaces the current one: if it
+        # cannot be applied, the session goes on with the current config
+        t = perf_counter()
+        try:
+            changed = session.applyConfig(json.loads(msg.payload))
+        except (ValueError, NameError, TypeError) as e:
+            commandError(msg, e)
+            continue
+        warmUpTime = perf_counter() - t
+        # The queued trials are prepared again with the new bank
+        pending = list(schedule.entries.values())
+        schedule = SessionSchedule(session.bank)
+        schedule.extend(pending)
+        eventLog.log('message', text=f"CONFIG: {', '.join(changed) or 'no changes'} "
+                                     f"(warm-up {warmUpTime:.2f} s)")
+    elif msg.type == 'GO':
+        if msg.trial not in schedule:
+            commandError(msg, f'trial {msg.trial} is not in the schedule')
+            continue
+        entry, trial = schedule.pop(msg.trial)
+        eventLog.log('message', msg.trial, text=f'TRIAL {msg.trial}: {entry["shape"]}')
+        channel.status.update(state='running', trial=msg.trial)
+        timing = trial.doTrial(abort=channel.abort)
+        endTrial(msg.trial, entry['shape'], trial, timing, entry.get('seed'))
+    elif msg.type == 'STOP':
+        running = False
+
+channel.stop()
+eventLog.close()
+
+summary = trigger.summary()
+if 'width' in summary:
+    print(f"Triggers: {summary['pulses']}, width {1e3*summary['width']['mean']:.3f} ms "
+          f"(max {1e3*summary['width']['max']:.3f} ms), offset from the flip "
+          f"{1e3*summary.get('flipOffset', {}).get('mean', float('nan')):.3f} ms")
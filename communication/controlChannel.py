@@ -0,0 +1,225 @@
+from collections import deque
+import json
+import socket
+import threading
+from time import monotonic
+from communication.tcpProtocol import MessageBuffer, encodeMessage
+
+"""
+ControlChannel CLASS
+
+Network side of the stimulation client, running on a dedicated I/O thread so
+that the socket is read even while the render loop is busy flipping frames.
+
+The I/O thread owns the connection to the acquisition server: it connects
+(and reconnects, without touching the psychopy window, whenever the connection
+drops), parses the incoming messages and hands the trial commands (TRIAL,
+SCHEDULE, GO, CONFIG, STOP) to the render loop through a deque, whose
+append/popleft are atomic and need no lock. Control messages are handled on the I/O thread
+itself, without waiting for the current trial to end:
+
+    HEARTBEAT  'ping' answered immediately with a 'pong' HEARTBEAT carrying
+               the same index ('pong' heartbeats are not answered)
+    ABORT      sets the abort event, checked by doTrial at every frame
+    PAUSE      sets the paused event: no new trial is started until RESUME
+    RESUME     clears the paused event
+    STATUS     answered with a STATUS message with the state of the client
+
+The render loop only reads the abort event once per frame (Event.is_set), so
+the channel adds no per-frame latency. Messages sent with send() while the
+connection is down (e.g. trial ACKs) are kept and sent, whole and in order,
+after reconnecting.
+With an EventLog (see stimuli/eventLog), every message received and sent and
+every connection and disconnection is logged, from the I/O thread.
+"""
+
+# Message types handled by the I/O thread
+CONTROL_TYPES = ('HEARTBEAT', 'ABORT', 'PAUSE', 'RESUME', 'STATUS')
+
+
+class ControlChannel:
+    def __init__(self,
+                address,                    # IP address of the acquisition server
+                port,                       # TCP port of the acquisition server
+                buffSize = 4096,            # Size of the receive buffer
+                reconnectDelay = 1,         # Seconds between reconnection attempts
+                heartbeatInterval = None,   # If set, seconds between the heartbeats sent
+                                            # by the client (the server must answer them)
+                heartbeatTimeout = None,    # If set, reconnect when nothing is received
+                                            # from the server for this many seconds
+                eventLog = None,            # Optional EventLog of the messages
+                ):
+
+        self.address = address
+        self.port = port
+        self.buffSize = buffSize
+        self.reconnectDelay = reconnectDelay
+        self.heartbeatInterval = heartbeatInterval
+        self.heartbeatTimeout = heartbeatTimeout
+        self.eventLog = eventLog
+
+        # Hand-off to the render loop
+        self.commands = deque()
+        self.newCommand = threading.Event()
+        self.abort = threading.Event()
+        self.paused = threading.Event()
+        self.connected = threading.Event()
+        # State reported to STATUS requests, updated by the render loop
+        self.status = {'state': 'idle', 'trial': 0}
+
+        self._sock = None
+        self._sendLock = threading.Lock()
+        self._pending = deque()         # Messages waiting for a connection
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ControlChannel',
+                                        daemon=True)
+        # Lines received that could not be parsed
+        self.malformed = []
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._closeSocket()
+        self._thread.join(timeout=2)
+
+    def waitConnected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    def nextCommand(self, timeout=None):
+        # Returns the next trial command, or None if none arrives within the
+        # timeout. Called by the render loop.
+        if not self.commands:
+            self.newCommand.clear()
+            if not self.commands and not self.newCommand.wait(timeout):
+                return None
+        try:
+            return self.commands.popleft()
+        except IndexError:
+            return None
+
+    def send(self, msgType, trial=0, payload=''):
+        # Sends a message to the server (from any thread). If the connection
+        # is down the message is sent after reconnecting.
+        data = encodeMessage(msgType, trial, payload)
+        self._log('sent', msgType, trial, payload)
+        with self._sendLock:
+            # Messages go through the queue, so that they are sent in order
+            self._pending.append(data)
+            return self._sock is not None and self._flushPending()
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._connect():
+                self._stop.wait(self.reconnectDelay)
+                continue
+            try:
+                self._serve()
+            except OSError:
+                pass
+            self._closeSocket()
+            if not self._stop.is_set():
+                self._stop.wait(self.reconnectDelay)
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.address, self.port), timeout=5)
+        except OSError:
+            return False
+        # Short timeout, only to periodically check heartbeats and stop
+        sock.settimeout(0.2)
+        with self._sendLock:
+            self._sock = sock
+            # Flush the messages queued while disconnected
+            if not self._flushPending():
+                return False
+        self.connected.set()
+        self._log('connected', f'{self.address}:{self.port}')
+        return True
+
+    def _flushPending(self):
+        # Sends the queued messages in order (with the send lock held).
+        # sendall can fail (or time out) after sending part of a message: the
+        # connection is then closed, dropping the partial line, and the message
+        # stays queued to be sent whole after reconnecting. Returns True if
+        # the queue was emptied.
+        try:
+            while self._pending:
+                self._sock.sendall(self._pending[0])
+                self._pending.popleft()
+        except OSError:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+            return False
+        return True
+
+    def _serve(self):
+        # send() may close the socket from another thread: recv then raises
+        sock = self._sock
+        rxBuffer = MessageBuffer()
+        lastReceived = lastHeartbeat = monotonic()
+        while not self._stop.is_set():
+            try:
+                data = sock.recv(self.buffSize)
+            except socket.timeout:
+                data = None
+            now = monotonic()
+            if data is not None:
+                if not data:            # Connection closed by the server
+                    return
+                lastReceived = now
+                for msg in rxBuffer.feed(data):
+                    self._dispatch(msg)
+                self.malformed.extend(rxBuffer.malformed)
+                rxBuffer.malformed.clear()
+            if (self.heartbeatTimeout is not None and
+                    now - lastReceived > self.heartbeatTimeout):
+                return
+            if (self.heartbeatInterval is not None and
+                    now - lastHeartbeat > self.heartbeatInterval):
+                self.send('HEARTBEAT', 0, 'ping')
+                lastHeartbeat = now
+
+    def _dispatch(self, msg):
+        self._log('received', msg.type, msg.trial, msg.payload)
+        if msg.type not in CONTROL_TYPES:
+            self.commands.append(msg)
+            self.newCommand.set()
+        elif msg.type == 'HEARTBEAT':
+            if msg.payload != 'pong':
+                self.send('HEARTBEAT', msg.trial, 'pong')
+        elif msg.type == 'ABORT':
+            self.abort.set()
+        elif msg.type == 'PAUSE':
+            self.paused.set()
+        elif msg.type == 'RESUME':
+            self.paused.clear()
+        elif msg.type == 'STATUS':
+            status = dict(self.status, paused=self.paused.is_set(),
+                          queued=len(self.commands))
+            self.send('STATUS', msg.trial, json.dumps(status))
+
+    def _log(self, event, msgType, trial=-1, payload=''):
+        if self.eventLog is not None:
+            self.eventLog.log(event, trial, text=f'{msgType} {payload}'.rstrip())
+
+    def _closeSocket(self):
+        if self.connected.is_set():
+            self._log('disconnected', f'{self.address}:{self.port}')
+        self.connected.clear()
+        with self._sendLock:
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                except OSError:
+                    pass
+                self._sock = None
@@ -0,0 +1,131 @@
+"""
+TCP PROTOCOL
+
+Message framing used between the acquisition server and the stimulation
+client. Every message is a single line of utf8 text:
+
+    <TYPE> <trial index> <payload>\n
+
+where TYPE is one of MESSAGE_TYPES, the trial index is a non-negative integer
+(0 when the message does not refer to a trial) and the payload is optional
+free text without newlines (e.g. a shape name or a JSON object).
+
+Since TCP is a stream, messages sent back to back can arrive in a single recv
+and a message can be split across several recv. MessageBuffer keeps the bytes
+received so far and returns every complete message, so any number of queued
+commands is parsed and nothing is lost.
+
+    TRIAL     run the trial <trial index> with the shape given in the payload
+    SCHEDULE  add trials to the schedule of the session. The payload is a JSON
+              list of trials, each an object with at least "trial" (index) 
+              and "shape", optionally "width", "stroke" and "seed" (and 
+              "repeatOf" for the trials that repeat a trial that failed the 
+              quality control). Can be sent again during the session
+    GO        start the (already scheduled) trial <trial index>
+    CONFIG    apply a new (partial) session config to the client, without
+              re-creating its window. The payload is a JSON object with the
+              sections and keys to change (see stimuli/sessionConfig)
+    ACK       sent back by the client at the end of trial <trial index>. The 
+              payload is a JSON object with the timing of the trial (see 
+              ackPayload)
+    ERROR     sent back by the client when a command (e.g. SCHEDULE, CONFIG)
+              cannot be applied. The payload is a JSON object with the
+              "command" type and the "error"
+    STOP      end of the session
+
+Control messages, handled by the client even during a trial (see 
+communication/controlChannel):
+
+    HEARTBEAT liveness check. A 'ping' payload is answered with a 'pong'
+              HEARTBEAT with the same index
+    ABORT     interrupt the current trial (its ACK has "aborted": true)
+    PAUSE     do not start new trials until RESUME
+    RESUME    start trials again
+    STATUS    request the state of the client, answered with a STATUS message
+              with a JSON payload
+"""
+
+from collections import namedtuple
+import json
+
+MESSAGE_TYPES = ('TRIAL', 'SCHEDULE', 'GO', 'CONFIG', 'ACK', 'ERROR', 'STOP',
+                 'HEARTBEAT', 'ABORT', 'PAUSE', 'RESUME', 'STATUS')
+TERMINATOR = b'\n'
+ENCODING = 'utf8'
+
+Message = namedtuple('Message', ['type', 'trial', 'payload'])
+
+
+def encodeMessage(msgType, trial=0, payload=''):
+    # Returns the bytes of a message, ready to be sent
+    if msgType not in MESSAGE_TYPES:
+        raise ValueError(f"Unknown message type '{msgType}'")
+    if '\n' in payload:
+        raise ValueError("The payload of a message cannot contain newlines")
+    return f'{msgType} {int(trial)} {payload}'.encode(ENCODING) + TERMINATOR
+
+
+def ackPayload(trial, shape, timing, seed=None):
+    # JSON payload of the ACK of a trial, from the timing report returned by
+    # Trial_flickeringShapes.doTrial(). Times are in seconds on the clock of
+    # the stimulation PC (the psychopy flip clock).
+    return json.dumps({
+        'trial': int(trial),
+        'shape': shape,
+        'seed': seed,
+        'triggerTime': timing['triggerTime'],
+        'firstFlip': timing['firstFlip'],
+        'stimOnset': timing['stimOnset'],
+        'stimOffset': timing['stimOffset'],
+        'lastFlip': timing['lastFlip'],
+        'dropped': timing['dropped'],
+        'droppedStim': timing['droppedStim'],
+        'reversalOffset': timing.get('reversalOffset'),
+        'setupTime': timing['setupTime'],
+        'aborted': timing['aborted'],
+        'framesPresented': timing['framesPresented'],
+    })
+
+
+def decodeMessage(line):
+    # Parses a single line (without terminator) into a Message
+    fields = line.decode(ENCODING).rstrip('\r').split(' ', 2)
+    if len(fields) < 2 or fields[0] not in MESSAGE_TYPES:
+        raise ValueError(f'Malformed message: {line!r}')
+    payload = fields[2] if len(fields) > 2 else ''
+    return Message(fields[0], int(fields[1]), payload)
+
+
+class MessageBuffer:
+    def __init__(self):
+        # Bytes received but not yet terminated
+        self.buffer = bytearray()
+        # Lines that could not be parsed
+        self.malformed = []
+
+    def feed(self, data):
+        # Adds received bytes and returns the list of complete messages
+        self.buffer += data
+        messages = []
+        end = self.buffer.rfind(TERMINATOR)
+        if end < 0:
+            return messages
+        lines = bytes(self.buffer[:end]).split(TERMINATOR)
+        del self.buffer[:end+1]
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                messages.append(decodeMessage(line))
+            except ValueError:
+                self.malformed.append(line)
+        return messages
+
+
+def recvMessages(sock, msgBuffer, buffSize=4096):
+    # Blocks until some data is received on the socket and returns the 
+    # complete messages. Returns None if the connection was closed.
+    data = sock.recv(buffSize)
+    if not data:
+        return None
+    return msgBuffer.feed(data)
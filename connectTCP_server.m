@@ -1,9 +1,17 @@
-function tcp = connectTCP_server(IP, port)
+function tcp = connectTCP_server(IP, port, bufferSize)
+% The default buffers of tcpip (512 bytes) are smaller than the SCHEDULE
+% message and the ACK payloads: both are set to bufferSize bytes (default
+% 1 MB) before the connection is opened
 
+if nargin < 3
+    bufferSize = 2^20;
+end
 
 fprintf(['Starting TCP/IP server on [Address: ' IP...
     ' - Port: %u]...'], port)
 
 tcp = tcpip(IP, port,'NetworkRole', 'server');
+tcp.OutputBufferSize = bufferSize;
+tcp.InputBufferSize = bufferSize;
 
-fprintf('Server Ready!\nWaiting for connection from clients...\n')
\ No newline at end of file
+fprintf('Server Ready!\nWaiting for connection from clients...\n')
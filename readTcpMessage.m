@@ -0,0 +1,29 @@
+function [type, trial, payload] = readTcpMessage(tcp)
+% [type, trial, payload] = readTcpMessage(tcp)
+%
+% Reads one message sent by the stimulation client with the framing defined
+% in communication/tcpProtocol.py: a single line "<TYPE> <trial> <payload>\n"
+% Blocks until a full line is received or the timeout of tcp expires.
+%
+% OUTPUT
+% type: message type (e.g. 'ACK'), empty if nothing was received
+% trial: index of the trial the message refers to
+% payload: text of the payload (e.g. JSON), empty if none
+%
+% see also sendTcpMessage
+
+type = '';
+trial = 0;
+payload = '';
+
+line = fgetl(tcp);
+if ~ischar(line) || isempty(line)
+    return
+end
+
+[type, rest] = strtok(line, ' ');
+[trialStr, payload] = strtok(rest, ' ');
+trial = str2double(trialStr);
+if ~isempty(payload)
+    payload = payload(2:end);
+end
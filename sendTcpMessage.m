@@ -0,0 +1,23 @@
+function sendTcpMessage(tcp, type, trial, payload)
+% sendTcpMessage(tcp, type, trial, payload)
+%
+% Sends a message to the stimulation client with the framing defined in
+% communication/tcpProtocol.py: a single line "<TYPE> <trial> <payload>\n"
+%
+% INPUT
+% tcp: tcpip object connected to the client
+% type: message type (e.g. 'TRIAL', 'STOP')
+% trial: index of the trial the message refers to (0 if none)
+% payload: optional text without newlines (e.g. the shape name)
+
+if nargin < 4
+    payload = '';
+end
+
+msg = sprintf('%s %u %s\n', type, trial, payload);
+if length(msg) > tcp.OutputBufferSize
+    error('sendTcpMessage:bufferSize', ['%s message of %u bytes is larger ' ...
+        'than the OutputBufferSize of the connection (%u bytes)'], ...
+        type, length(msg), tcp.OutputBufferSize)
+end
+fwrite(tcp, msg);
@@ -9,6 +9,9 @@ settings.repetitions = 40;
 settings.preStim = 1;                           % in seconds
 settings.durStim = 1;                           % in seconds
 settings.postStim = 4;                          % in seconds
+settings.armPause = 1;                          % in seconds, between arming the camera and starting the trial
+settings.ackTimeout = 30;                       % in seconds, max wait for the end of trial ACK
+settings.frameTimeout = 5;                      % in seconds, max wait for the last frames after the ACK
 
 % Folder where to save the result of the experiments
 settings.savingFolder = 'F:\stimDecoding\gNex_26\';
@@ -17,6 +20,7 @@ settings.savingFolder = 'F:\stimDecoding\gNex_26\';
 % -------------------------------------------------------------------------
 settings.tcp.address = '192.168.1.3';
 settings.tcp.port = 40000;
+settings.tcp.bufferSize = 2^20;                 % in bytes, input and output buffers (SCHEDULE message)
 
 nFrames = 60;
 
@@ -26,9 +30,18 @@ nFrames = 60;
 %% Setup TCP/IP connection with the psychopy instance on localhost
 stimList = pseudorandomSequence(settings.stimuli, settings.repetitions);
 
-tcp = connectTCP_server(settings.tcp.address, settings.tcp.port);
+tcp = connectTCP_server(settings.tcp.address, settings.tcp.port, ...
+    settings.tcp.bufferSize);
+tcp.Timeout = settings.ackTimeout;
 fopen(tcp);
 
+% Upload the whole schedule to the client, that prepares the trials in
+% advance. Every trial is then started with a GO message.
+schedule = struct('trial', num2cell(1:length(stimList)), 'shape', stimList, ...
+    'seed', num2cell(randi(intmax('int32'), 1, length(stimList))));
+settings.schedule = schedule;
+sendTcpMessage(tcp, 'SCHEDULE', 0, jsonencode(schedule));
+
 %% MAIN LOOP
 h = src.H5HardwareROI_Height;
 w = src.H2HardwareROI_Width;
@@ -50,6 +63,9 @@ m.rawCross = rawCross;
 m.settings = settings;
 
 clear rawTriangle rawCircle rawCross
+% Timing of every trial as reported by the stimulation client
+trialTiming = cell(1, length(stimList));
+m.trialTiming = trialTiming;
 crossN = 1;
 triangleN = 1;
 circleN = 1;
@@ -60,11 +76,24 @@ for i = 1:length(stimList)
     fprintf('start, ')
     trigger(vid)
     fprintf('soft Trig, ')
-    pause(1)
-    % Send current trial to python that whil trigget the camera
-    fwrite(tcp, stimList{i});
-    % Wait for the acquisition to finish
-    wait(vid,25)
+    % The camera gives no signal once it is armed: its first frame only comes
+    % with the hardware trigger of the stimulus (sequence_trigger), and
+    % islogging is already true when trigger returns. Keep a fixed arming
+    % delay after the trigger.
+    pause(settings.armPause)
+    % Start the current trial on python that whil trigget the camera
+    sendTcpMessage(tcp, 'GO', i);
+    % Wait for the client to acknowledge the end of the trial (skipping the
+    % late ACKs of previous trials), then for the last frames of the acquisition
+    [msgType, ~, payload] = waitTcpMessage(tcp, 'ACK', i, settings.ackTimeout);
+    if ~isempty(msgType)
+        trialTiming{i} = jsondecode(payload);
+        m.trialTiming = trialTiming;
+        fprintf('ack (dropped frames: %u), ', trialTiming{i}.dropped)
+    else
+        fprintf('NO ACK, ')
+    end
+    wait(vid, settings.frameTimeout)
     fprintf(' done.\n Processing...')
     % Preprocess data, save it and display preview
     [data,time] = getdata(vid, nFrames);
@@ -92,7 +121,7 @@ for i = 1:length(stimList)
     fprintf('done.\n')
 end
 fprintf('END OF RECORDING.\n')
-fwrite(tcp, 'stop');
+sendTcpMessage(tcp, 'STOP', 0);
 fclose(tcp);
 
 %% cleanup
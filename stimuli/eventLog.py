@@ -0,0 +1,277 @@
+import json
+import os
+import threading
+from datetime import datetime
+from time import perf_counter, time as wallClock
+import numpy as np
+
+"""
+EventLog CLASS
+
+Append-only binary log of the events of a stimulation session (trial start
+and end, flips, checkerboard reversals, triggers, strobe words, network
+messages, warnings...), with the timestamps of a monotonic clock.
+
+The events are written into a preallocated in-memory buffer of fixed-size
+records (EVENT_DTYPE), and a background thread flushes the buffer to disk in
+batches, every flushInterval seconds or as soon as it is half full. Logging
+an event is a single record assignment under a lock, with no I/O and no
+allocation on the render thread; the flips of a trial are logged all at once
+from the flipTimes buffer after the trial (logTrial). The flush thread swaps
+the full buffer with a spare one, so the render thread never waits for the
+disk; if the buffer fills up before the flush thread runs, it is grown to
+twice its size (counted in overflows) rather than flushed by the caller.
+
+The file starts with a JSON header line (record dtype, event names, and the
+clock and wall time at the start of the session, to align the log with other
+clocks), followed by the raw records. A log can be reopened to append more
+events, and a log truncated by a crash is read up to its last complete record.
+readEventLog() loads a whole session log as a NumPy structured array (or one
+array per event type), eventLogHeader() reads its header.
+
+The text of the events (shape names, message payloads) is truncated to
+TEXT_SIZE bytes in the file. Text events listed in echo are also printed to
+the console, with their full text, by the flush thread, off the render thread.
+"""
+
+EVENTS = ('sessionStart', 'sessionEnd', 'trialStart', 'trialEnd', 'flip', 'reversal',
+          'trigger', 'word', 'received', 'sent', 'connected', 'disconnected',
+          'message', 'warning')
+EVENT_CODES = {name: code for code, name in enumerate(EVENTS)}
+
+TEXT_SIZE = 47                  # Bytes of text per event (64-byte records)
+EVENT_DTYPE = np.dtype([('time', 'f8'), ('event', 'u1'), ('trial', 'i4'),
+                        ('value', 'i4'), ('text', f'S{TEXT_SIZE}')])
+
+LOG_FORMAT = 'stimDecoding event log'
+
+
+class EventLog:
+    def __init__(self,
+                path,                       # File of the log (appended if it exists)
+                capacity = 65536,           # Events kept in memory between flushes (grown if full)
+                flushInterval = 0.5,        # Seconds between the flushes to disk
+                clock = None,               # Clock of the events (default: perf_counter).
+                                            # Use the clock of the flips (psychopy
+                                            # logging.defaultClock.getTime)
+                echo = (),                  # Events whose text is printed when flushed
+                fsync = False,              # os.fsync the file at every flush
+                ):
+
+        self.path = path
+        self.capacity = capacity
+        self.flushInterval = flushInterval
+        self.clock = clock or perf_counter
+        self.echo = {EVENT_CODES[event] for event in echo}
+        self.fsync = fsync
+        self.overflows = 0
+        self.nEvents = 0            # Events written to the file
+
+        self._buffer = np.zeros(capacity, EVENT_DTYPE)
+        self._spare = np.zeros(capacity, EVENT_DTYPE)
+        self._n = 0
+        self._echoed = []           # Full text of the echoed events not yet printed
+        self._lock = threading.Lock()           # Buffer
+        self._flushLock = threading.Lock()      # File
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+        self._file = self._open(path)
+        self._thread = threading.Thread(target=self._run, name='EventLog', daemon=True)
+        self._thread.start()
+        self.log('sessionStart', text=datetime.now().isoformat(timespec='seconds'))
+
+    #---------------------------------------------------------------------------
+    #--- LOGGING
+    #---------------------------------------------------------------------------
+
+    def log(self, event, trial=-1, value=0, text=b'', time=None):
+        # Logs an event (at the current time of the clock if time is None)
+        if time is None:
+            time = self.clock()
+        code = EVENT_CODES[event]
+        fullText = text
+        if isinstance(text, str):
+            text = text.encode()
+        with self._lock:
+            if self._n == len(self._buffer):
+                self._grow(self._n + 1)
+            self._buffer[self._n] = (time, code, trial, value, text)
+            self._n += 1
+            if code in self.echo:
+                self._echoed.append((code, fullText))
+            if self._n == len(self._buffer) // 2:
+                self._wake.set()
+
+    def logMany(self, event, times, trial=-1, values=0):
+        # Logs many events of the same type at once (e.g. the flips of a trial)
+        times = np.asarray(times)
+        values = np.broadcast_to(values, times.shape)
+        with self._lock:
+            if self._n + len(times) > len(self._buffer):
+                self._grow(self._n + len(times))
+            records = self._buffer[self._n:self._n + len(times)]
+            records['time'] = times
+            records['event'] = EVENT_CODES[event]
+            records['trial'] = trial
+            records['value'] = values
+            records['text'] = b''
+            self._n += len(times)
+            if self._n >= len(self._buffer) // 2:
+                self._wake.set()
+
+    def logTrial(self, index, shape, trial, timing):
+        # Logs a trial run by a Trial_flickeringShapes object (trial), with the
+        # report (timing) returned by its doTrial(): start and end, every flip
+        # (value: frame), every reversal of the checkerboard, trigger and word
+        n = trial.framesPresented
+        if n == 0:
+            self.log('trialEnd', index, 0, 'aborted')
+            return
+        flipTimes = trial.flipTimes[:n]
+        self.log('trialStart', index, getattr(trial, 'shapeId', -1), shape, flipTimes[0])
+        self.logMany('flip', flipTimes, index, np.arange(n))
+        reversals = trial.prestimFrames + np.flatnonzero(trial.reversalFrames)
+        reversals = reversals[reversals < n]
+        self.logMany('reversal', flipTimes[reversals], index, reversals)
+        if timing.get('triggerTime') is not None:
+            self.log('trigger', index, trial.trigValue, time=timing['triggerTime'])
+        if timing.get('word') is not None and trial.trigger.words:
+            wordTime, symbols = trial.trigger.words[-1]
+            self.log('word', index, symbols[0], ' '.join(map(str, symbols)), wordTime)
+        self.log('trialEnd', index, timing['dropped'],
+                 'aborted' if timing['aborted'] else '', flipTimes[-1])
+
+    #---------------------------------------------------------------------------
+    #--- FILE
+    #---------------------------------------------------------------------------
+
+    def flush(self):
+        # Writes the buffered events to the file
+        with self._flushLock:
+            # The spare buffer follows the growth of the buffer
+            if len(self._spare) < self.capacity:
+                self._spare = np.zeros(self.capacity, EVENT_DTYPE)
+            with self._lock:
+                n = self._n
+                records = self._buffer[:n]
+                self._buffer, self._spare = self._spare, self._buffer
+                self._n = 0
+                echoed, self._echoed = self._echoed, []
+            if n == 0:
+                return
+            self._file.write(records.tobytes())
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.nEvents += n
+            for code, text in echoed:
+                if isinstance(text, bytes):
+                    text = text.decode(errors='replace')
+                print(f"{EVENTS[code].upper()}: {text}")
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.log('sessionEnd')
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _open(self, path):
+        # Opens the file for appending, writing the header of a new log
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            header, offset = _readHeader(path)
+            if header['dtype'] != EVENT_DTYPE.descr:
+                raise ValueError(f'{path} is an event log with different records')
+            # Drop a record truncated by a crash
+            size = os.path.getsize(path)
+            complete = offset + (size - offset) // EVENT_DTYPE.itemsize * EVENT_DTYPE.itemsize
+            if complete < size:
+                os.truncate(path, complete)
+            return open(path, 'ab')
+        header = {'format': LOG_FORMAT, 'dtype': EVENT_DTYPE.descr, 'events': EVENTS,
+                  'clockTime': self.clock(), 'wallTime': wallClock()}
+        f = open(path, 'ab')
+        f.write((json.dumps(header) + '\n').encode())
+        f.flush()
+        return f
+
+    def _grow(self, size):
+        # Replaces the full buffer with a larger one (called with the lock held)
+        buffer = np.zeros(max(2 * len(self._buffer), size), EVENT_DTYPE)
+        buffer[:self._n] = self._buffer[:self._n]
+        self._buffer = buffer
+        self.capacity = max(self.capacity, len(buffer))
+        self.overflows += 1
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flushInterval)
+            self._wake.clear()
+            self.flush()
+
+
+def _readHeader(path):
+    # Header of a log and offset of its first record
+    with open(path, 'rb') as f:
+        line = f.readline()
+    header = json.loads(line)
+    if header.get('format') != LOG_FORMAT:
+        raise ValueError(f'{path} is not an event log')
+    header['dtype'] = [tuple(field) for field in header['dtype']]
+    return header, len(line)
+
+
+def eventLogHeader(path):
+    # Header of a log: clock and wall time at the start of the session, to
+    # convert the times of the events to another clock
+    return _readHeader(path)[0]
+
+
+def readEventLog(path, split=False):
+    # Events of a log as a structured array (EVENT_DTYPE), or as a dictionary
+    # event name -> structured array if split
+    header, offset = _readHeader(path)
+    dtype = np.dtype(header['dtype'])
+    data = np.fromfile(path, np.uint8, offset=offset)
+    records = data[:len(data) // dtype.itemsize * dtype.itemsize].view(dtype)
+    if not split:
+        return records
+    names = header['events']
+    return {name: records[records['event'] == code] for code, name in enumerate(names)
+            if (records['event'] == code).any()}
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    # Cost of logging an event on the render thread
+    path = os.path.join(tempfile.mkdtemp(), 'session.events')
+    nEvents = 200000
+    with EventLog(path) as eventLog:
+        t = perf_counter()
+        for i in range(nEvents):
+            eventLog.log('flip', 0, i)
+        elapsed = perf_counter() - t
+        flips = np.cumsum(np.full(nEvents, 1/60))
+        t = perf_counter()
+        eventLog.logMany('flip', flips, 1, np.arange(nEvents))
+        elapsedMany = perf_counter() - t
+    events = readEventLog(path, split=True)
+    print(f'log(): {1e9*elapsed/nEvents:.0f} ns per event, logMany(): '
+          f'{1e9*elapsedMany/nEvents:.0f} ns per event, {eventLog.overflows} overflows')
+    print({name: len(records) for name, records in events.items()})
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from psychopy import visual
+import numpy as np
+from stimuli.shapeMasks import shapeMask, checkerboardImage, maskBox
+
+"""
+FrameCache CLASS
+
+Cache of pre-rendered stimulus frames for the playback mode of
+Trial_flickeringShapes. For every shape the two phases of the checkerboard
+are composited once with the (anti-aliased) mask of the shape using numpy
+(see shapeMasks) and uploaded as two psychopy ImageStim textures. During a
+trial the stimulation loop then draws a single image per frame, instead of the
+checkerboard through the aperture plus the hole-filling patch.
+
+Frames are cropped to the bounding box of the shape and positioned on the
+window in pixel units. The cache is limited to memoryBudgetMB of frame data:
+when a new shape does not fit, the least recently used shapes are evicted.
+Call warmUp() with the trials that will be presented to render them before
+the first trial (e.g. while waiting for the first TCP message). With
+workers > 1 the frames are composited on a thread pool, and only the textures
+are created on the calling thread.
+"""
+
+
+class FrameCache:
+    def __init__(self,
+                stimWin,                    # Psychopy window object
+                pixPerDeg,                  # Pixels per degree of the window
+                memoryBudgetMB = 512,       # Maximum size of the cached frames
+                supersample = 2,            # Anti-aliasing of the edges of the shapes
+                ):
+
+        self.stimWindow = stimWin
+        self.pixPerDeg = pixPerDeg
+        self.memoryBudget = memoryBudgetMB * 2**20
+        self.supersample = supersample
+        # key -> (ImageStim of phase 0, ImageStim of phase 0.5, nbytes)
+        self.frames = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, trial):
+        # Returns the two pre-rendered frames of a trial, rendering them if
+        # they are not in the cache
+        key = self._key(trial)
+        if key in self.frames:
+            self.frames.move_to_end(key)
+        else:
+            self._add(key, trial)
+        return self.frames[key][:2]
+
+    def warmUp(self, trials, workers=1):
+        # Renders the frames of the given trials (as long as they fit in the
+        # memory budget)
+        trials = [trial for trial in trials if trial not in self]
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            for trial, rendered in zip(trials, pool.map(self._render, trials)):
+                key = self._key(trial)
+                if key not in self.frames:
+                    self._add(key, trial, rendered)
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
+
+    def __contains__(self, trial):
+        return self._key(trial) in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _key(self, trial):
+        return (trial.shape, trial.width, trial.stroke, trial.chkbrdSpFreq,
+                trial.chkbrdContrast)
+
+    def _add(self, key, trial, rendered=None):
+        images, pos = rendered if rendered is not None else self._render(trial)
+        nbytes = sum(image.nbytes for image in images)
+        # Evict the least recently used shapes until the new one fits
+        while self.frames and self.nbytes + nbytes > self.memoryBudget:
+            _, _, evicted = self.frames.popitem(last=False)[1]
+            self.nbytes -= evicted
+        stims = [visual.ImageStim(
+                    self.stimWindow,
+                    image = image,
+                    units = 'pix',
+                    size = (image.shape[1], image.shape[0]),
+                    pos = pos,
+                    interpolate = False)
+                 for image in images]
+        self.frames[key] = (stims[0], stims[1], nbytes)
+        self.nbytes += nbytes
+
+    def _render(self, trial):
+        # Composites the checkerboard and the mask of the shape for both
+        # phases, cropped to the bounding box of the shape, gray (0) outside
+        # the shape. The masks are in image convention (first row at the top),
+        # the returned textures in OpenGL convention (first row at the bottom).
+        width, height = (int(v) for v in self.stimWindow.size)
+        mask = shapeMask(trial.shape, trial.width, trial.stroke, (height, width),
+                         self.pixPerDeg, supersample=self.supersample,
+                         tessellation=trial.tessellation)
+        box = maskBox(mask)
+        if box is None:         # Shape outside of the window
+            box = (0, 1, 0, 1)
+        rowStart, rowEnd, colStart, colEnd = box
+        visible = trial.chkbrdContrast * mask[rowStart:rowEnd, colStart:colEnd]
+        images = [checkerboardImage((height, width), self.pixPerDeg,
+                                    trial.chkbrdSpFreq, phase, box) * visible
+                  for phase in (0, 0.5)]
+        # Position of the center of the box in pixels from the window center
+        pos = ((colStart + colEnd)/2 - width/2, height/2 - (rowStart + rowEnd)/2)
+        # psychopy only flips PIL/file images: numpy textures are uploaded with
+        # their first row at the bottom, so the images are flipped here
+        return [np.ascontiguousarray(np.flipud(image), np.float32) for image in images], pos
@@ -0,0 +1,281 @@
+import copy
+import json
+import os
+from time import perf_counter
+from stimuli.shapeGeometry import SHAPES
+
+"""
+SESSION CONFIG
+
+Configuration of a stimulation session in a JSON or TOML file (see
+session.toml), with one section per part of the setup:
+
+    monitor     calibration and resolution of the stimulation monitor
+    trigger     parallel port backend and address, trigger pin, strobe words
+    stimuli     shapes of the session and parameters shared by all of them
+    tcp         address of the acquisition server
+    eventLog    path of the event log of the session
+    warmUp      threads of the warm-up
+
+Any key left out of the file takes its value from DEFAULT_CONFIG, and unknown
+sections or keys, or values of the wrong type (see checkValue), are rejected,
+so that a typo never silently falls back to a default or fails later. loadConfig() reads a file (or takes a dictionary) and returns the
+complete config.
+
+StimulusSession CLASS
+
+Stimuli of a session built from a config. The window and the trigger are
+opened once by open(); the shapes of the StimulusBank are only declared, and
+their trials are built lazily on first use, or all at once by warmUp(): the
+geometry of the trials and the compositing of pre-rendered frames run on a
+thread pool, while the psychopy objects are created on the calling thread.
+Since the ControlChannel connects on its own thread, the warm-up runs while
+the TCP connection is being established.
+
+applyConfig() applies a new (partial) config to the open window, without
+creating it again: a change of the shape set only declares the new shapes,
+any other change of the stimuli creates a new bank on the same window, reusing
+the apertures of the unchanged shapes. The shapes are then warmed up, and the
+config is only saved once the new bank is ready, so that a config that cannot
+be applied leaves the session unchanged. Changes of the monitor resolution,
+screen or fullscreen mode need a new window and are rejected; tcp and eventLog
+only take effect at the next session.
+"""
+
+DEFAULT_CONFIG = {
+    'monitor': {
+        'name': 'TestMonitor',
+        'distanceCm': 20,
+        'widthCm': 52,
+        'resolution': [1920, 1080],
+        'screen': 0,
+        'fullscr': True,
+    },
+    'trigger': {
+        'backend': 'parallel',      # See triggers.TRIGGER_BACKENDS
+        'address': '0xD010',        # Address of the parallel port
+        'pin': 1,
+        'strobeWord': False,        # Send the shape ID as a strobe word (see triggers)
+    },
+    'stimuli': {
+        'shapes': ['cross', 'circle', 'triangle', 'square', 'h_letter', 'v_letter',
+                   'star', 't_letter', 's_letter', 'w_letter'],
+        'width': 20,
+        'stroke': 2,
+        'chkbrdTempFreq': 5,
+        'chkbrdSpFreq': 0.08,
+        'chkbrdContrast': 0.8,
+        'prestimFrames': 60,
+        'stimFrames': 60,
+        'postStimFrames': 240,
+        'playback': False,          # Pre-rendered frames (for slower stimulation PCs)
+    },
+    'tcp': {
+        'ip': '192.168.1.2',        # IP address of the recording machine
+        'port': 40000,
+        'buffSize': 4096,
+    },
+    'eventLog': {
+        'path': 'session.events',
+    },
+    'warmUp': {
+        'workers': 4,
+    },
+}
+
+# Monitor keys that can only be applied by creating a new window
+WINDOW_KEYS = ('resolution', 'screen', 'fullscr')
+
+# Keys whose values can be any number, although their default is an integer
+NUMBER_KEYS = {('monitor', 'distanceCm'), ('monitor', 'widthCm'), ('stimuli', 'width'),
+               ('stimuli', 'stroke'), ('stimuli', 'chkbrdTempFreq')}
+
+
+def readConfigFile(path):
+    # Parses a JSON or TOML config file
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def checkValue(section, key, value):
+    # Raises a ValueError if value has not the type of the default value of the
+    # key (an int for an int default, a list of the same type of items...)
+    def valid(value, default, number):
+        if isinstance(default, bool) or isinstance(value, bool):
+            return isinstance(value, bool) and isinstance(default, bool)
+        if isinstance(default, float) or (number and isinstance(default, int)):
+            return isinstance(value, (int, float))
+        if isinstance(default, list):
+            return isinstance(value, list) and all(valid(v, default[0], number) for v in value)
+        return isinstance(value, type(default))
+    default = DEFAULT_CONFIG[section][key]
+    if not valid(value, default, (section, key) in NUMBER_KEYS):
+        expected = type(default).__name__ + (f' of {type(default[0]).__name__}'
+                                             if isinstance(default, list) else '')
+        raise ValueError(f"Config key '{section}.{key}' must be of type {expected} "
+                         f"(got {value!r})")
+
+
+def mergeConfig(config, overrides):
+    # Copy of config with the sections and keys of overrides replaced
+    merged = copy.deepcopy(config)
+    if not isinstance(overrides or {}, dict):
+        raise ValueError(f'The config must be a dictionary of sections (got {overrides!r})')
+    for section, values in (overrides or {}).items():
+        if section not in DEFAULT_CONFIG:
+            raise ValueError(f"Unknown config section '{section}' "
+                             f"(must be in {list(DEFAULT_CONFIG)})")
+        if not isinstance(values, dict):
+            raise ValueError(f"Config section '{section}' must be a dictionary "
+                             f"of keys (got {values!r})")
+        unknown = set(values) - set(DEFAULT_CONFIG[section])
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)} in config section "
+                             f"'{section}' (must be in {list(DEFAULT_CONFIG[section])})")
+        for key, value in values.items():
+            checkValue(section, key, value)
+        merged[section].update(copy.deepcopy(values))
+    unknownShapes = [s for s in merged['stimuli']['shapes'] if s not in SHAPES]
+    if unknownShapes:
+        raise NameError(f"Unknown shapes {unknownShapes} (must be in {list(SHAPES)})")
+    return merged
+
+
+def loadConfig(source=None):
+    # Complete config from a file (JSON or TOML), a dictionary, or the
+    # defaults if source is None
+    if isinstance(source, (str, os.PathLike)):
+        source = readConfigFile(os.fspath(source))
+    return mergeConfig(DEFAULT_CONFIG, source)
+
+
+def bankParams(config):
+    # Arguments of StimulusBank from the stimuli and trigger sections
+    stimuli, trigger = config['stimuli'], config['trigger']
+    params = {key: value for key, value in stimuli.items() if key != 'shapes'}
+    params.update(triggerPin=trigger['pin'], strobeWord=trigger['strobeWord'])
+    return params
+
+
+class StimulusSession:
+    def __init__(self,
+                config = None,              # Config file, dictionary or None (defaults)
+                stimWin = None,             # Psychopy window (created by open() if None)
+                trigger = None,             # Trigger (opened from the config if None)
+                ):
+
+        self.config = loadConfig(config)
+        self.stimWindow = stimWin
+        self.trigger = trigger
+        self.bank = None
+        self._stencils = None
+
+    #---------------------------------------------------------------------------
+    #--- SETUP
+    #---------------------------------------------------------------------------
+
+    def open(self):
+        # Opens the window and the trigger (unless given) and declares the
+        # shapes of a new bank. Nothing is built yet.
+        if self.stimWindow is None:
+            self.stimWindow = self._openWindow()
+        if self.trigger is None:
+            self.trigger = self._openTrigger(self.config)
+        self.bank, self._stencils = self._newBank(self.config, self.trigger, self._stencils)
+        return self
+
+    def warmUp(self):
+        # Builds the trials and the apertures (or pre-rendered frames) of all
+        # the shapes. Returns the seconds spent.
+        t = perf_counter()
+        self.bank.warmUp(self.config['warmUp']['workers'])
+        return perf_counter() - t
+
+    def applyConfig(self, overrides):
+        # Applies a new (partial) config to the open window and warms up its
+        # shapes. Returns the sections that changed. The new bank is built and
+        # warmed up before the config is saved: if any step fails, the session
+        # keeps its previous config, trigger and bank.
+        newConfig = mergeConfig(self.config, overrides)
+        changed = [section for section in newConfig if newConfig[section] != self.config[section]]
+        monitor, oldMonitor = newConfig['monitor'], self.config['monitor']
+        needsWindow = [key for key in WINDOW_KEYS if monitor[key] != oldMonitor[key]]
+        if needsWindow:
+            raise ValueError(f'Changing {needsWindow} needs a new window')
+
+        trigger, bank, stencils = self.trigger, self.bank, self._stencils
+        declared, trials = list(bank.declared), dict(bank.trials)
+        try:
+            if 'monitor' in changed:
+                # The tessellation of the shapes depends on the monitor calibration
+                self._setMonitor(monitor)
+                stencils = None
+            newTrigger = any(newConfig['trigger'][key] != self.config['trigger'][key]
+                             for key in ('backend', 'address'))
+            if newTrigger:
+                trigger = self._openTrigger(newConfig)
+            if newTrigger or bankParams(newConfig) != bankParams(self.config) \
+                    or 'monitor' in changed:
+                bank, stencils = self._newBank(newConfig, trigger, stencils)
+            elif 'stimuli' in changed:
+                # Only the shape set changed: the built trials are kept
+                shapes = newConfig['stimuli']['shapes']
+                bank.declared = [key for key in declared if key[0] in shapes]
+                bank.trials = {key: trial for key, trial in trials.items() if key[0] in shapes}
+                for shape in shapes:
+                    bank.declare(shape)
+            bank.warmUp(newConfig['warmUp']['workers'])
+        except Exception:
+            if 'monitor' in changed:
+                self._setMonitor(oldMonitor)
+            self.bank.declared, self.bank.trials = declared, trials
+            raise
+        self.config, self.trigger, self.bank, self._stencils = newConfig, trigger, bank, stencils
+        return changed
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _openWindow(self):
+        from psychopy import visual, monitors
+        config = self.config['monitor']
+        mon = monitors.Monitor(config['name'])
+        mon.setDistance(config['distanceCm'])
+        mon.setWidth(config['widthCm'])
+        return visual.Window(
+            size = config['resolution'],
+            screen = config['screen'],
+            fullscr = config['fullscr'],
+            units = 'deg',
+            monitor = mon,
+            allowStencil = True)
+
+    def _setMonitor(self, monitor):
+        self.stimWindow.monitor.setDistance(monitor['distanceCm'])
+        self.stimWindow.monitor.setWidth(monitor['widthCm'])
+
+    def _openTrigger(self, config):
+        from stimuli.triggers import openTrigger
+        config = config['trigger']
+        parameters = {'address': config['address']} if config['backend'] == 'parallel' else {}
+        trigger = openTrigger(config['backend'], **parameters)
+        # Idle level: trigger pin HIGH
+        trigger.setData(2**(config['pin'] - 1))
+        return trigger
+
+    def _newBank(self, config, trigger, stencils):
+        # New bank of the config on the open window, sharing the apertures of
+        # the previous one (stencils). Returns the bank and its stencils.
+        from stimuli.shapesStimuli import StimulusBank, StencilCache
+        if stencils is None:
+            stencils = StencilCache(self.stimWindow)
+        bank = StimulusBank(self.stimWindow, pPort=trigger, stencils=stencils,
+                            **bankParams(config))
+        for shape in config['stimuli']['shapes']:
+            bank.declare(shape)
+        return bank, stencils
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from stimuli.shapeGeometry import SHAPES
+
+"""
+SessionSchedule CLASS
+
+In-memory queue of the trials of a session, uploaded once by the acquisition
+server (SCHEDULE message, see communication/tcpProtocol) instead of sending a
+shape name per trial. Every entry is a dictionary with at least the trial
+index ('trial') and the 'shape', and optionally the 'width' and 'stroke' of
+the shape and a 'seed' that is kept with the trial metadata.
+
+The schedule resolves the Trial_flickeringShapes object of the next
+`prefetch` trials ahead of time through a StimulusBank (creating shapes with
+new sizes and building their aperture, or their pre-rendered frames), so that
+a trial can start as soon as its GO token arrives.
+"""
+
+
+class SessionSchedule:
+    def __init__(self,
+                bank,                       # StimulusBank used to build the trials
+                prefetch = 3,               # Number of upcoming trials prepared in advance
+                ):
+
+        self.bank = bank
+        self.prefetch = prefetch
+        # trial index -> entry, in presentation order
+        self.entries = OrderedDict()
+        # trial index -> prepared Trial_flickeringShapes object
+        self.prepared = {}
+
+    def extend(self, entries):
+        # Appends trials to the schedule (a later entry with the same index
+        # replaces the earlier one). Nothing is added if any entry is invalid,
+        # or if the upcoming trials cannot be prepared.
+        normalized = [self._normalize(entry) for entry in entries]
+        oldEntries, oldPrepared = OrderedDict(self.entries), dict(self.prepared)
+        try:
+            for entry in normalized:
+                self.entries[entry['trial']] = entry
+                self.prepared.pop(entry['trial'], None)
+            self._prefetch()
+        except Exception:
+            self.entries, self.prepared = oldEntries, oldPrepared
+            raise
+
+    def pop(self, index=None):
+        # Removes a trial from the schedule (the first one if index is None)
+        # and returns its entry and its ready-to-run trial object
+        if index is None:
+            index = next(iter(self.entries))
+        entry = self.entries.pop(index)
+        trial = self.prepared.pop(index, None)
+        if trial is None:
+            trial = self._prepare(entry)
+        self._prefetch()
+        return entry, trial
+
+    def __contains__(self, index):
+        return index in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    #---------------------------------------------------------------------------
+    #--- INTERNAL FUNCTIONS
+    #---------------------------------------------------------------------------
+
+    def _normalize(self, entry):
+        # Copy of an entry with an integer trial index and numeric sizes.
+        # Raises NameError or ValueError if the entry is invalid.
+        if not isinstance(entry, dict) or 'trial' not in entry or 'shape' not in entry:
+            raise NameError(f"Schedule entries need 'trial' and 'shape': {entry}")
+        if entry['shape'] not in SHAPES:
+            raise NameError(f"Unknown shape in schedule: {entry['shape']}")
+        entry = dict(entry)
+        if isinstance(entry['trial'], bool) or not isinstance(entry['trial'], (int, float)) \
+                or not float(entry['trial']).is_integer():
+            raise ValueError(f"Invalid trial index in schedule: {entry['trial']!r}")
+        entry['trial'] = int(entry['trial'])
+        for key in ('width', 'stroke'):
+            value = entry.get(key)
+            if value is not None and (isinstance(value, bool) or
+                                      not isinstance(value, (int, float)) or value <= 0):
+                raise ValueError(f"Invalid {key} of trial {entry['trial']}: {value!r}")
+        return entry
+
+    def _prepare(self, entry):
+        trial = self.bank.getTrial(entry['shape'], width=entry.get('width'),
+                                   stroke=entry.get('stroke'))
+        self.bank.prepare(trial)
+        return trial
+
+    def _prefetch(self):
+        for index in list(self.entries)[:self.prefetch]:
+            if index not in self.prepared:
+                self.prepared[index] = self._prepare(self.entries[index])
@@ -0,0 +1,180 @@
+"""
+SHAPE GEOMETRY
+
+Registry of the shapes that can be presented by Trial_flickeringShapes, with
+the functions generating their vertices. Every generator takes the width (in
+degrees) of the shape, its stroke (thickness) and a tessellation (number of
+vertices used for curved edges, ignored by polygonal shapes) and returns either:
+  - a (M by 2) array with the [x,y] coordinates of the outline of the shape, or
+  - a (M by 2 by 2) array for shapes with a hole, where coord[:,:,0] are the
+    outer edges and coord[:,:,1] are the inner edges.
+
+Polygonal shapes are linear in the half-width and the stroke, so they are
+described by two constant templates and computed as
+    coord = (width/2) * widthTemplate + stroke * strokeTemplate
+
+Use shapeCoordinates() to get the coordinates of a shape: results are memoized
+on (shape, width, stroke, tessellation) and returned as read-only arrays.
+New shapes are added with the registerShape decorator (or registerTemplate for
+polygons) and are then available everywhere a shape name is accepted.
+
+This module only depends on numpy, so it can be used on machines without a
+display (e.g. for analysis).
+"""
+
+from functools import lru_cache
+import math
+import numpy as np
+
+# Shape name -> generator(width, stroke, tessellation)
+SHAPES = {}
+# Shapes whose generator uses the tessellation argument
+TESSELLATED_SHAPES = set()
+
+DEFAULT_TESSELLATION = 100      # Vertices of curved edges if no pixel size is known
+
+
+def registerShape(name, tessellated=False):
+    # Decorator adding a coordinate generator to the registry
+    def decorator(generator):
+        SHAPES[name] = generator
+        if tessellated:
+            TESSELLATED_SHAPES.add(name)
+        return generator
+    return decorator
+
+
+def registerTemplate(name, widthTemplate, strokeTemplate):
+    # Registers a polygonal shape from its width and stroke templates
+    widthTemplate = np.asarray(widthTemplate, dtype=float)
+    strokeTemplate = np.asarray(strokeTemplate, dtype=float)
+    # Stack the templates of shapes with a hole as (M by 2 by 2)
+    if widthTemplate.ndim > 2:
+        widthTemplate = np.moveaxis(widthTemplate, 0, -1)
+        strokeTemplate = np.moveaxis(strokeTemplate, 0, -1)
+
+    def generator(width, stroke, tessellation=None):
+        return (width/2) * widthTemplate + stroke * strokeTemplate
+    return registerShape(name)(generator)
+
+
+def shapeCoordinates(shape, width=10, stroke=2, tessellation=None):
+    # Returns the (read-only, memoized) coordinates of a shape
+    if shape not in SHAPES:
+        raise NameError(f"Unknown shape '{shape}'. Shape must be one of {list(SHAPES)}")
+    if shape in TESSELLATED_SHAPES:
+        if tessellation is None:
+            tessellation = DEFAULT_TESSELLATION
+        tessellation = int(tessellation)
+    else:
+        tessellation = None     # So that polygons are cached only once
+    return _cachedCoordinates(shape, float(width), float(stroke), tessellation)
+
+
+@lru_cache(maxsize=4096)
+def _cachedCoordinates(shape, width, stroke, tessellation):
+    coord = np.array(SHAPES[shape](width, stroke, tessellation), dtype=float)
+    coord.flags.writeable = False
+    return coord
+
+
+def clearCache():
+    _cachedCoordinates.cache_clear()
+
+
+def pixPerDegree(distanceCm, monitorWidthCm, monitorWidthPix):
+    # Pixels per degree of visual angle at the center of the monitor, with
+    # the same (non-corrected) conversion used by psychopy for 'deg' units
+    return monitorWidthPix / monitorWidthCm * distanceCm * math.pi / 180
+
+
+def adaptiveTessellation(radius, pixPerDeg, segmentPix=3, minVertices=16,
+                         maxVertices=1024):
+    # Number of vertices of a circle of the given radius (in degrees) such
+    # that every edge is about segmentPix pixels long on the screen
+    if pixPerDeg is None:
+        return DEFAULT_TESSELLATION
+    circumference = 2 * math.pi * radius * pixPerDeg
+    nVertices = math.ceil(circumference / segmentPix)
+    return int(min(max(nVertices, minVertices), maxVertices))
+
+
+def equilateralVertices(edges, radius=5):
+    # Get vertices for an equilateral shape with a given number of sides
+    angles = np.arange(int(round(edges))) * (2 * np.pi / edges)
+    return np.column_stack((np.sin(angles), np.cos(angles))) * radius
+
+
+#-------------------------------------------------------------------------------
+#--- SHAPES
+#-------------------------------------------------------------------------------
+
+# Cross: 12 vertices (square form factor since width = height)
+registerTemplate('cross',
+    [[-1, 1], [-1, 1], [0, 0], [1, 1], [1, 1], [0, 0],
+     [1,-1], [1,-1], [0, 0], [-1,-1], [-1,-1], [0, 0]],
+    [[-1, 1], [1, 1], [0, 1], [-1, 1], [1, 1], [1, 0],
+     [1,-1], [-1,-1], [0,-1], [1,-1], [-1,-1], [-1, 0]])
+
+# Equilateral triangle (outer and inner), centered vertically
+_cos30 = math.cos(math.radians(30))
+_yBase = 1 - 1.5/_cos30
+registerTemplate('triangle',
+    [[[0, 1], [1, _yBase], [-1, _yBase]],               # outer
+     [[0, 1], [1, _yBase], [-1, _yBase]]],              # inner
+    [[[0, 1], [_cos30, -0.5], [-_cos30, -0.5]],
+     [[0, -1], [-_cos30, 0.5], [_cos30, 0.5]]])
+
+# Circle (outer and inner), tessellated
+@registerShape('circle', tessellated=True)
+def _circleCoordinates(width, stroke, tessellation=None):
+    # Coordinates of 2 concentric circles
+    if tessellation is None:
+        tessellation = DEFAULT_TESSELLATION
+    unit = equilateralVertices(tessellation, radius=1)
+    radii = np.array([width/2 + stroke, width/2 - stroke])
+    return unit[:,:,np.newaxis] * radii
+
+# Square (outer and inner)
+registerTemplate('square',
+    [[[-1,-1], [1,-1], [1, 1], [-1, 1]],
+     [[-1,-1], [1,-1], [1, 1], [-1, 1]]],
+    [[[-1,-1], [1,-1], [1, 1], [-1, 1]],
+     [[1, 1], [-1, 1], [-1,-1], [1,-1]]])
+
+# Letter H: 12 vertices
+registerTemplate('h_letter',
+    [[-1,-1], [-1,-1], [-1, 0], [1, 0], [1,-1], [1,-1],
+     [1, 1], [1, 1], [1, 0], [-1, 0], [-1, 1], [-1, 1]],
+    [[-1,-1], [1,-1], [1,-1], [-1,-1], [-1,-1], [1,-1],
+     [1, 1], [-1, 1], [-1, 1], [1, 1], [1, 1], [-1, 1]])
+
+# Letter V: 6 vertices
+_k = 1/(2*math.sqrt(2))
+registerTemplate('v_letter',
+    [[0,-1], [1, 1], [1, 1], [0,-1], [-1, 1], [-1, 1]],
+    [[0, -1-_k], [0.5,-0.5], [-0.5, 0.5], [0, 1+_k], [0.5, 0.5], [-0.5,-0.5]])
+
+# Star: 10 vertices, scaled by width/2 + stroke
+_star = [[-0.6,-0.9], [0,-0.4], [0.6,-0.9], [0.35,-0.15], [0.9, 0.25],
+         [0.2, 0.25], [0, 1], [-0.2, 0.25], [-0.9, 0.25], [-0.35,-0.15]]
+registerTemplate('star', _star, _star)
+
+# Letter T: 8 vertices
+registerTemplate('t_letter',
+    [[0,-1], [0,-1], [0, 1], [1, 1], [1, 1], [-1, 1], [-1, 1], [0, 1]],
+    [[-1,-1], [1,-1], [1,-1], [1,-1], [1, 1], [-1, 1], [-1,-1], [-1,-1]])
+
+# Letter S: 12 vertices
+registerTemplate('s_letter',
+    [[-1,-1], [1,-1], [1, 0], [-1, 0], [-1, 1], [1, 1],
+     [1, 1], [-1, 1], [-1, 0], [1, 0], [1,-1], [-1,-1]],
+    [[-1,-1], [1,-1], [1, 1], [1, 1], [1,-1], [1,-1],
+     [1, 1], [-1, 1], [-1,-1], [-1,-1], [-1, 1], [-1, 1]])
+
+# Letter W: 12 vertices
+registerTemplate('w_letter',
+    [[-0.5,-1], [-0.5,-1], [0, 0], [0.5,-1], [0.5,-1], [1, 1],
+     [1, 1], [0.5, 0], [0, 0], [-0.5, 0], [-1, 1], [-1, 1]],
+    [[-1,-1], [0.5,-1], [0,-1], [-0.5,-1], [1,-1], [1, 1],
+     [-1, 1], [-0.25,-1], [0, 1.5], [0.25,-1], [1, 1], [-1, 1]])
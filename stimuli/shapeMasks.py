@@ -0,0 +1,189 @@
+"""
+SHAPE MASKS
+
+Headless rasterizer of the stimuli shapes. It turns the same coordinates used
+by Trial_flickeringShapes (see shapeGeometry) into pixel masks of the stimulus
+at any resolution, without a psychopy window, a display or a GPU, e.g. to
+compare the stimuli with the cortical responses recorded by the camera.
+
+Polygons are filled with a vectorized even-odd scanline algorithm: the
+crossings of every edge with every pixel row are computed at once and turned
+into a mask with a cumulative sum along the rows, inside the bounding box of
+the polygon. Shapes with a hole are the
+outer polygon minus the inner one, as in the stimulation window.
+
+The mapping from degrees to pixels is given by pixPerDeg and by the position
+(in degrees) of the center of the shape with respect to the center of the
+image. With supersample > 1 the mask is anti-aliased: it is rendered at a
+higher resolution and averaged back, giving the fraction of each pixel
+covered by the shape.
+
+shapeMask() keeps the last MASK_CACHE_SIZE rendered masks in memory.
+checkerboardImage() renders the checkerboard pattern of the stimuli on the same
+pixel grid, so that masked stimulus frames can be composited without OpenGL.
+"""
+
+from functools import lru_cache
+import numpy as np
+from stimuli.shapeGeometry import shapeCoordinates, adaptiveTessellation
+
+MASK_CACHE_SIZE = 256
+
+
+def rasterizePolygon(vertices, size, pixPerDeg, center=(0, 0), supersample=1):
+    # Rasterizes a closed polygon with [x,y] vertices in degrees into a mask
+    # of size (height, width) pixels. Returns a boolean mask, or a float32
+    # coverage mask if supersample > 1.
+    height, width = size
+    supersample = int(supersample)
+    inside = _fillPolygon(np.asarray(vertices, dtype=float), height*supersample,
+                          width*supersample, pixPerDeg*supersample, center)
+    if supersample == 1:
+        return inside
+    return _downsampleCoverage(inside, supersample)
+
+
+def rasterizeShape(coord, size, pixPerDeg, center=(0, 0), supersample=1):
+    # Rasterizes shape coordinates as returned by shapeCoordinates(),
+    # removing the inner part of shapes with a hole
+    coord = np.asarray(coord, dtype=float)
+    height, width = size
+    supersample = int(supersample)
+    sizeS = (height*supersample, width*supersample)
+    if coord.ndim > 2:
+        inside = _fillPolygon(coord[:,:,0], *sizeS, pixPerDeg*supersample, center)
+        inside &= ~_fillPolygon(coord[:,:,1], *sizeS, pixPerDeg*supersample, center)
+    else:
+        inside = _fillPolygon(coord, *sizeS, pixPerDeg*supersample, center)
+    if supersample == 1:
+        return inside
+    return _downsampleCoverage(inside, supersample)
+
+
+def shapeMask(shape, width, stroke, size, pixPerDeg, center=(0, 0),
+              supersample=1, tessellation=None):
+    # Returns the (cached, read-only) mask of a registered shape
+    if tessellation is None:
+        tessellation = adaptiveTessellation(width/2 + stroke, pixPerDeg)
+    return _cachedMask(shape, float(width), float(stroke), tuple(size),
+                       float(pixPerDeg), tuple(center), int(supersample),
+                       int(tessellation))
+
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def _cachedMask(shape, width, stroke, size, pixPerDeg, center, supersample,
+                tessellation):
+    coord = shapeCoordinates(shape, width, stroke, tessellation)
+    mask = rasterizeShape(coord, size, pixPerDeg, center, supersample)
+    mask.flags.writeable = False
+    return mask
+
+
+def clearCache():
+    _cachedMask.cache_clear()
+
+
+def checkerboardImage(size, pixPerDeg, sf, phase=0, box=None):
+    # Checkerboard with values -1/+1 as drawn by the GratingStim of 
+    # Trial_flickeringShapes: squares of 1/(2*sf) degrees, shifted 
+    # horizontally by phase cycles. box = (rowStart, rowEnd, colStart, colEnd) 
+    # renders only part of the image.
+    height, width = size
+    if box is None:
+        box = (0, height, 0, width)
+    rowStart, rowEnd, colStart, colEnd = box
+    # Coordinates (in cycles) of the pixel centers
+    x = ((np.arange(colStart, colEnd) + 0.5 - width/2) / pixPerDeg) * sf + phase
+    y = ((height/2 - np.arange(rowStart, rowEnd) - 0.5) / pixPerDeg) * sf
+    xParity = np.floor(2*x).astype(np.int64) & 1
+    yParity = np.floor(2*y).astype(np.int64) & 1
+    checker = (yParity[:, np.newaxis] ^ xParity).astype(np.float32)
+    return 2*checker - 1
+
+
+def maskBox(mask):
+    # Bounding box (rowStart, rowEnd, colStart, colEnd) of the nonzero
+    # pixels of a mask, None if the mask is empty
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return None
+    return int(rows[0]), int(rows[-1]+1), int(cols[0]), int(cols[-1]+1)
+
+
+#-------------------------------------------------------------------------------
+#--- INTERNAL FUNCTIONS
+#-------------------------------------------------------------------------------
+
+def _fillPolygon(vertices, height, width, pixPerDeg, center):
+    # Even-odd scanline fill. Vertices are converted to continuous pixel
+    # coordinates (columns to the right, rows downwards, pixel edges on
+    # integers) and every pixel whose center is inside the polygon is set.
+    # Only the bounding box of the polygon is scanned.
+    col = (vertices[:,0] + center[0]) * pixPerDeg + width/2
+    row = height/2 - (vertices[:,1] + center[1]) * pixPerDeg
+    mask = np.zeros((height, width), dtype=bool)
+    rowStart = int(np.clip(np.floor(row.min()), 0, height))
+    rowEnd = int(np.clip(np.ceil(row.max()), 0, height))
+    colStart = int(np.clip(np.floor(col.min()), 0, width))
+    colEnd = int(np.clip(np.ceil(col.max()), 0, width))
+    boxHeight, boxWidth = rowEnd - rowStart, colEnd - colStart
+    if boxHeight == 0 or boxWidth == 0:
+        return mask
+
+    col0, row0 = col - colStart, row - rowStart
+    col1, row1 = np.roll(col0, -1), np.roll(row0, -1)
+
+    # Crossings of every edge with the center line of every row
+    rowCenters = np.arange(boxHeight)[:, np.newaxis] + 0.5
+    crosses = (row0 <= rowCenters) != (row1 <= rowCenters)
+    r, e = np.nonzero(crosses)
+    t = (rowCenters[r, 0] - row0[e]) / (row1[e] - row0[e])
+    colCross = col0[e] + t * (col1[e] - col0[e])
+
+    # Every crossing toggles the inside/outside state from the first pixel
+    # whose center lies to its right. Only the parity of the cumulative sum
+    # matters, so it is computed in uint8 (wrapping around 256 keeps parity).
+    firstCol = np.clip(np.ceil(colCross - 0.5), 0, boxWidth).astype(np.intp)
+    toggles = np.bincount(r * (boxWidth+1) + firstCol,
+                          minlength=boxHeight*(boxWidth+1))
+    toggles = toggles.astype(np.uint8).reshape(boxHeight, boxWidth+1)[:, :boxWidth]
+    inside = np.cumsum(toggles, axis=1, dtype=np.uint8)
+    inside &= 1
+    mask[rowStart:rowEnd, colStart:colEnd] = inside.view(bool)
+    return mask
+
+
+def _downsampleCoverage(inside, supersample):
+    # Fraction of each (supersample x supersample) block covered by the mask,
+    # summing the strided sub-grids of the block
+    height = inside.shape[0] // supersample
+    width = inside.shape[1] // supersample
+    inside = inside.view(np.uint8)
+    coverage = np.zeros((height, width), dtype=np.uint16)
+    for i in range(supersample):
+        for j in range(supersample):
+            coverage += inside[i::supersample, j::supersample]
+    return coverage * np.float32(1/supersample**2)
+
+
+if __name__ == '__main__':
+    # Rasterize all the shapes for a sweep of widths and strokes and report
+    # the time it takes
+    from time import perf_counter
+    from stimuli.shapeGeometry import SHAPES
+
+    size = (270, 480)       # e.g. a binned camera frame
+    pixPerDeg = 5
+    widths = np.arange(10, 40, 3)
+    strokes = [1, 2, 3, 4]
+
+    start = perf_counter()
+    for shape in SHAPES:
+        for width in widths:
+            for stroke in strokes:
+                shapeMask(shape, width, stroke, size, pixPerDeg, supersample=2)
+    elapsed = perf_counter() - start
+    nMasks = len(SHAPES) * len(widths) * len(strokes)
+    print(f'{nMasks} masks of {size[0]}x{size[1]} pixels in {elapsed:.3f} s '
+          f'({1e3*elapsed/nMasks:.2f} ms per mask)')
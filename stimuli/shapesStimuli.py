@@ -1,7 +1,12 @@
-from psychopy import core, visual
+from psychopy import visual, logging
 import numpy as np
-import math
-from time import sleep
+from time import perf_counter
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from stimuli.shapeGeometry import (SHAPES, shapeCoordinates, adaptiveTessellation,
+                                   pixPerDegree)
+from stimuli.frameCache import FrameCache
+from stimuli.triggers import asTrigger, encodeWord
 
 """
 Trial_flickeringShapes CLASS
@@ -10,32 +15,77 @@ This class can be used to generate complex visual stimuli in which a geometric
 shape, containing a phase-reversing checkerboard pattern, is presented.
 
 It works by generating stimuli inside a psychopy window object that has to be
-provided in the stimWin argument. All the shapes require the use of a psychopy
-aperture object that also has to be provided as the aperture argument.
+provided in the stimWin argument (the window needs allowStencil=True). The shapes
+are cut out of the checkerboard by psychopy apertures, which are kept in a 
+StencilCache. A cache can be shared between trials through the stencils 
+argument, otherwise each trial creates its own. As in the earlier versions of
+the class, the second argument can also be a single psychopy Aperture shared
+by all the trials: its vertices are then replaced at the start of every trial.
 
 Optionally, the class can also send a trigger through a parallel port at the beginning of 
 each trial to trigger recording equipment. To do this, you have to provide a
-psychopy parallelPort object as the optional pPort object. Also you have to specify 
-which of the 8 pins of the LPT port you want to use as a trigger with the triggerPin 
-argument (default:1).
+psychopy parallelPort object (or a Trigger, see triggers) as the optional pPort object.
+Also you have to specify which of the 8 pins of the LPT port you want to use as a 
+trigger with the triggerPin argument (default:1). The trigger pulse is sent right 
+after the first flip of the trial, and its offset from the flip is logged by the Trigger.
+With strobeWord=True the trial also sends, on the first flip of the stimulus, a
+strobe-coded word with the shape ID and a trial counter on the other 7 pins, so
+that the trials can be labeled from the recorded digital channel alone (see 
+triggers and acquisition/triggerDecoding).
 
 Parameters of the visual stimulation can be fine tuned by changing the various
 arguments at the moment of object instantiation.
 
-Run a trial for a Trial_flickeringShapes object with the method doTrial()
-
-For an example use case of how to use the class see the section under
-if __name__ == "__main__"
+Run a trial for a Trial_flickeringShapes object with the method doTrial().
+The timestamp of every flip of the trial is stored in the flipTimes array and
+doTrial() returns a summary of the frame timing (frame intervals, frames dropped
+in the prestim, stim and poststim periods, measured stimulus onset and offset).
+
+StencilCache CLASS
+
+Cache of psychopy apertures, one per shape geometry, built lazily on first use
+(or all at once with StimulusBank.buildStencils()) and re-enabled at the start 
+of every following trial. Call invalidate() to drop apertures whose width or 
+stroke changed.
+
+StimulusBank CLASS
+
+Container for running many shapes in the same window. The bank owns a single
+checkerboard GratingStim and a single hole-filling ShapeStim that are shared by 
+all of its Trial_flickeringShapes objects, so that only the geometry of each 
+shape is stored per trial. Selecting a trial swaps the vertices of the shared 
+objects. Add shapes with addShape() and run them with doTrial(shape) or 
+bank[shape].doTrial(). Shapes can also only be declared with declare(): their
+trial is then built on first use, or by warmUp().
+
+With playback=True the bank presents the stimuli in playback mode: the two
+checkerboard phases of each shape are pre-rendered into textures (see 
+FrameCache) and the stimulation loop draws a single image per frame. Call 
+warmUp() before the first trial to build the apertures (or render the frames)
+of all the shapes. With workers > 1 the numpy part of the warm-up (geometry of
+the trials, compositing of the pre-rendered frames) runs on a thread pool, and
+only the psychopy objects are created on the calling thread, which must be the
+one owning the window. A StencilCache can be shared between banks on the same
+window (e.g. when a new session config is applied), so that the apertures of
+the shapes that did not change are not built again.
+
+For an example use case of how to use the classes see the section under
+if __name__ == "__main__" (run it from the repository root with
+python -m stimuli.shapesStimuli)
 """
 
 
 class Trial_flickeringShapes:
     def __init__(self,
                 stimWin,                    # Psychopy window object
-                aperture,                   # Psychopy aperture object
-                pPort = 0,                  # Psychopy parallel port object (for triggering)
+                stencils = None,            # StencilCache with the apertures of the shapes,
+                                            # or a psychopy Aperture shared by the trials
+                pPort = 0,                  # Psychopy parallel port object or Trigger (for triggering)
                 triggerPin = 1,             # If the parallel port is available, which pin to use
-                shape = 'cross',            # Stimulus shape. can be 'cross','triangle', or 'circle'
+                strobeWord = False,         # Send the shape ID as a strobe word at stimulus onset
+                strobeSymbolWidth = 0.002,  # Minimum duration (s) of each strobe phase of the word
+                strobeCounter = True,       # Include the trial counter in the word
+                shape = 'cross',            # Stimulus shape. One of the shapes in shapeGeometry.SHAPES
                 width = 20,                 # Width (in degrees) of the shape
                 stroke = 2,                 # Thickness of the shape
                 chkbrdTempFreq = 5,         # Temporal freq of the flickering checkerboard
@@ -46,12 +96,34 @@ class Trial_flickeringShapes:
                                             # so 60 frames in a 60Hz monitor will be 1 second
                 stimFrames = 60,            # Number of frames the stimulus is visible
                 postStimFrames = 180,       # Number of post-stimulation 'gray' frames
+                lateFlipTolerance = 1.5,    # A flip interval longer than this many refresh
+                                            # periods is counted as a late/dropped frame
+                refreshRate = None,         # Refresh rate (Hz) of the stimulation monitor. 
+                                            # By default the nominal rate measured by the window
+                pixPerDeg = None,           # Pixels per degree, used to tessellate curved shapes.
+                                            # By default calculated from the window monitor
+                checkerboard = None,        # Optional checkerboard GratingStim shared with other
+                                            # trials (see StimulusBank). Created if not provided
+                outBckg = None,             # Optional hole-filling ShapeStim shared with other
+                                            # trials (see StimulusBank). Created if not provided
+                frameCache = None,          # Optional FrameCache. If provided, the trial is 
+                                            # presented in playback mode (pre-rendered frames)
                 ):
 
         self.stimWindow = stimWin
-        self.aperture = aperture
+        if stencils is None:
+            stencils = StencilCache(stimWin)
+        elif isinstance(stencils, visual.Aperture):
+            stencils = _SharedAperture(stencils)
+        self.stencils = stencils
+        self.frameCache = frameCache
         self.pPort = pPort 
+        # Pulses are timed and logged by a Trigger, on the clock of the flips
+        self.trigger = asTrigger(pPort, logging.defaultClock.getTime)
         self.triggerPin = triggerPin
+        self.strobeWord = strobeWord
+        self.strobeSymbolWidth = strobeSymbolWidth
+        self.strobeCounter = strobeCounter
         self.shape = shape
         self.width = width
         self.stroke = stroke
@@ -61,11 +133,14 @@ class Trial_flickeringShapes:
         self.prestimFrames = prestimFrames
         self.stimFrames = stimFrames
         self.postStimFrames = postStimFrames
+        self.lateFlipTolerance = lateFlipTolerance
+        if refreshRate is None:
+            refreshRate = round(1/self.stimWindow.monitorFramePeriod)
+        self.refreshRate = refreshRate
 
         # Check that a supported shape is requested
-        msg = "Shape must be one of 'cross','triangle', or 'circle'"
-        assert shape in ['cross', 'triangle', 'circle', 'square', 'h_letter',
-                         'v_letter', 'star', 't_letter', 's_letter', 'w_letter', msg]
+        if shape not in SHAPES:
+            raise NameError(f"Shape must be one of {list(SHAPES)}")
         
         # Check that the pin for the trigger is an int between 1 and 8
         msg = "triggerPin must be an integer between 1 and 8."
@@ -76,32 +151,19 @@ class Trial_flickeringShapes:
         # Calculate the value to send to the parallel port to switch up only the
         # desired pin
         self.trigValue = 2**(self.triggerPin-1)
+        self.shapeId = list(SHAPES).index(shape)
 
-        # Calculate the proper shape coordinates
+        # Calculate the proper shape coordinates from the shape registry
         # coord is a (M by 2 by 2) np array.
         # coord[:,:,0] are the [x,y] coordinates of the outer edges of the shape;
         # coord[:,:,1] are the [x,y] coordinates of the inner edges in case the 
-        # shape has a hole (like circle and triangle), otherwise it is empty.
-        if shape == 'cross':
-            coord = self._crossCoordinates(width=width, stroke=stroke)
-        elif shape == 'triangle':
-            coord = self._triangleCoordinates(width=width, stroke=stroke)
-        elif shape == 'circle':
-            coord = self._circleCoordinates(width=width, stroke=stroke)
-        elif shape == 'square':
-            coord = self._squareCoordinates(width=width, stroke=stroke)
-        elif shape == 'h_letter':
-            coord = self._h_letterCoordinates(width=width, stroke=stroke)
-        elif shape == 'v_letter':
-            coord = self._v_letterCoordinates(width=width, stroke=stroke)
-        elif shape == 'star':
-            coord = self._starCoordinates(width=width, stroke=stroke)
-        elif shape == 't_letter':
-            coord = self._t_letterCoordinates(width=width, stroke=stroke)
-        elif shape == 's_letter':
-            coord = self._s_letterCoordinates(width=width, stroke=stroke)
-        elif shape == 'w_letter':
-            coord = self._w_letterCoordinates(width=width, stroke=stroke)
+        # shape has a hole (like circle and triangle), otherwise it is (M by 2).
+        # Curved edges are tessellated according to their size on the screen.
+        if pixPerDeg is None:
+            pixPerDeg = windowPixPerDegree(self.stimWindow)
+        self.pixPerDeg = pixPerDeg
+        self.tessellation = adaptiveTessellation(width/2 + stroke, pixPerDeg)
+        coord = shapeCoordinates(shape, width, stroke, self.tessellation)
 
         # Generate the coordinates for restricting the stimulus visibility by
         # using both aperture and an optional shapeStim for shapes with holes
@@ -111,239 +173,493 @@ class Trial_flickeringShapes:
         else:                       # For shapes without a hole
             self.outerEdges = coord
             self.innerEdges = [[0,0]]   # Dummy value
-
-        # Generate the Background Checkerboard
-        chkb_texture = np.array([[-1,1],[1,-1]])
-        self.checkerboard = visual.GratingStim(
-            self.stimWindow,
-            size = [180,180],           # 180 degrees to get full field coverage
-            sf = self.chkbrdSpFreq,
-            contrast = self.chkbrdContrast,
-            ori = 0,
-            tex = chkb_texture,
-            autoDraw = False
-        )
-
-        # Shape object for filling central holes in stimuli shapes like circle 
-        # or triangle with a gray patch
-        self.outBckg = visual.ShapeStim(
-            self.stimWindow,
-            vertices = self.innerEdges, 
-            fillColor = [0,0,0],            # gray
-            lineWidth=0
-            )
-
-        # Generate a clock for flickering the background checkerboard
-        self.revClock = core.Clock()
-        self.revClock.reset()
-
-    def doTrial(self):
-        # Change the aperture to only render the central part of the stimulus
-        # This uses internal functions of the psychopy aperture class since by default
-        # they don't allow updating vertices of an already created aperture.
-        self.aperture._shape.vertices = self.outerEdges
-        self.aperture._needVertexUpdate = True
-        self.aperture._reset()
+        # Key of the aperture of this shape in the stencil cache
+        self.stencilKey = (shape, width, stroke)
+
+        # Generate the Background Checkerboard and the shape object for filling
+        # central holes, unless they are shared with other trials. Shared 
+        # objects get the vertices of this shape at the start of every trial.
+        self.sharedStims = outBckg is not None
+        if checkerboard is None:
+            checkerboard = _makeCheckerboard(self.stimWindow, self.chkbrdSpFreq,
+                                             self.chkbrdContrast)
+        if outBckg is None:
+            outBckg = _makeHoleFiller(self.stimWindow, self.innerEdges)
+        self.checkerboard = checkerboard
+        self.outBckg = outBckg
+
+        # Precompute the phase of the checkerboard for every stimulus frame.
+        # The checkerboard reverses every 1/chkbrdTempFreq seconds, counted in
+        # frames of the monitor refresh rate. reversalFrames marks the frames
+        # where the phase changes (always including the first one, so that
+        # every trial starts from the same phase).
+        self.phaseSchedule, self.reversalFrames = self._reversalSchedule(
+            self.stimFrames, self.refreshRate, self.chkbrdTempFreq)
+        # Index (0 or 1) of the pre-rendered frame to show in playback mode
+        self.phaseIndex = (2 * self.phaseSchedule).astype(int)
+
+        # Preallocate the buffer for the timestamps of every flip of a trial
+        # so that the stimulation loop does not allocate anything per frame
+        self.nFrames = self.prestimFrames + self.stimFrames + self.postStimFrames
+        self.flipTimes = np.zeros(self.nFrames)
+        self.framesPresented = 0
+
+    def doTrial(self, abort=None):
+        # abort is an optional threading.Event: when it is set (e.g. by another
+        # thread) the trial is interrupted at the next frame and the screen 
+        # goes back to gray
+        isAborted = (abort or _NEVER_ABORT).is_set
+        setupStart = perf_counter()
+        if self.frameCache is None:
+            # Enable the aperture to only render the central part of the stimulus.
+            # The aperture of each shape is built once and then only re-enabled.
+            self.stencils.enable(self.stencilKey, self.outerEdges)
+            if self.sharedStims:
+                self.outBckg.vertices = self.innerEdges
+        else:
+            # Playback mode: the frames are already masked, so no aperture
+            self.stencils.disable()
+            frames = self.frameCache.get(self)
+        setupTime = perf_counter() - setupStart
 
         # Send a Trigger for the start of the trial in case the user specified 
-        # a parallel port object
-        if self.pPort != 0:
-            self.pPort.setData(int("00000000",2))   # Force all the pins LOW
-            sleep(.001)                             # 1ms trigger length
-            self.pPort.setData(self.trigValue)      # Pull back HIGH the desired pin 
+        # a parallel port object. The pulse (all pins LOW for 1ms, then the 
+        # desired pin HIGH) is sent right after the first flip, so that it is
+        # locked to the screen refresh
+        # The calls scheduled on a flip are cancelled if the trial is aborted
+        # before that flip, so that nothing is sent on the flip back to gray
+        onFlipCalls = []
+        if self.trigger is not None and not isAborted():
+            onFlipCalls.append(self.trigger.onFlip(self.stimWindow, self.trigValue))
+        # The word with the shape ID (and the number of the word, as trial 
+        # counter) is sent right after the first flip of the stimulus
+        word = None
+        if self.trigger is not None and self.strobeWord:
+            counter = len(self.trigger.words) if self.strobeCounter else None
+            word = encodeWord(self.shapeId, counter)
 
         # STIMULATION LOOP
         # -----------------------------    
 
-        # PRESTIM
-        for _ in range(self.prestimFrames):
-            self.stimWindow.flip()
-        # STIMULUS
-        for _ in range(self.stimFrames):
-            if self.revClock.getTime() >= 1/self.chkbrdTempFreq:
-                self.checkerboard.phase += (0.5, 0)
-                self.revClock.reset()
-
-            self.checkerboard.draw()
-            self.outBckg.draw()
-            self.stimWindow.flip()
-        # POSTSTIM
-        for _ in range(self.postStimFrames):
-            self.stimWindow.flip()
-        
+        # Every flip timestamp is stored in the preallocated flipTimes buffer
+        flipTimes = self.flipTimes
+        stimStart = self.prestimFrames
+        stimEnd = self.prestimFrames + self.stimFrames
+
+        n = 0
+        aborted = False
+        wordCall = None
+        try:
+            # PRESTIM
+            for n in range(stimStart):
+                if isAborted(): raise _TrialAborted
+                flipTimes[n] = self.stimWindow.flip()
+            # STIMULUS
+            if word is not None and self.stimFrames > 0 and not isAborted():
+                wordCall = self.trigger.wordOnFlip(self.stimWindow, word, self.trigValue,
+                                                   self.triggerPin, self.strobeSymbolWidth)
+                onFlipCalls.append(wordCall)
+            if self.frameCache is None:
+                phaseSchedule = self.phaseSchedule
+                reversalFrames = self.reversalFrames
+                for n in range(stimStart, stimEnd):
+                    if isAborted(): raise _TrialAborted
+                    k = n - stimStart
+                    if reversalFrames[k]:
+                        self.checkerboard.phase = (phaseSchedule[k], 0)
+
+                    self.checkerboard.draw()
+                    self.outBckg.draw()
+                    flipTimes[n] = self.stimWindow.flip()
+            else:
+                phaseIndex = self.phaseIndex
+                for n in range(stimStart, stimEnd):
+                    if isAborted(): raise _TrialAborted
+                    frames[phaseIndex[n - stimStart]].draw()
+                    flipTimes[n] = self.stimWindow.flip()
+            # POSTSTIM
+            for n in range(stimEnd, self.nFrames):
+                if isAborted(): raise _TrialAborted
+                flipTimes[n] = self.stimWindow.flip()
+            n = self.nFrames
+        except _TrialAborted:
+            aborted = True
+            for call in onFlipCalls:
+                call.cancel()
+            self.stimWindow.flip()          # Back to gray
+        self.framesPresented = n
+        if word is not None and not (wordCall is not None and wordCall.called):
+            word = None                     # Not sent
+
+        # Same clock used by psychopy for the flip timestamps
+        triggerTime = None
+        if self.trigger is not None and n > 0:
+            self.trigger.recordFlip(flipTimes[0])
+            triggerTime = self.trigger.lastTime
+
+        report = self.frameTimingReport()
+        report['setupTime'] = setupTime     # Trial start latency (shape switch)
+        report['triggerTime'] = triggerTime
+        report['word'] = word
+        report['aborted'] = aborted
+        return report
+
+    def frameTimingReport(self):
+        # Summarizes the flip timestamps of the last trial. Frame intervals are 
+        # compared with the refresh period of the monitor: an interval lasting
+        # k periods means that k-1 frames were dropped. Each interval is 
+        # assigned to the phase of the frame that it ends on.
+        # Only the frames presented before an abort are considered
+        flipTimes = self.flipTimes[:self.framesPresented]
+        framePeriod = self.stimWindow.monitorFramePeriod
+        intervals = np.diff(flipTimes)
+        missed = np.rint(intervals / framePeriod).astype(int) - 1
+        missed[intervals <= self.lateFlipTolerance * framePeriod] = 0
+
+        stimStart = self.prestimFrames
+        stimEnd = self.prestimFrames + self.stimFrames
+        # missed[n-1] is the interval ending on frame n
+        nPresented = self.framesPresented
+        report = {
+            'nFrames': self.nFrames,
+            'framesPresented': nPresented,
+            'framePeriod': framePeriod,
+            'intervalMean': intervals.mean() if intervals.size else 0.,
+            'intervalStd': intervals.std() if intervals.size else 0.,
+            'intervalMin': intervals.min() if intervals.size else 0.,
+            'intervalMax': intervals.max() if intervals.size else 0.,
+            'droppedPrestim': int(missed[:max(stimStart-1, 0)].sum()),
+            'droppedStim': int(missed[max(stimStart-1, 0):max(stimEnd-1, 0)].sum()),
+            'droppedPoststim': int(missed[max(stimEnd-1, 0):].sum()),
+            'firstFlip': flipTimes[0] if nPresented else None,
+            'lastFlip': flipTimes[-1] if nPresented else None,
+            # The onset is the first flip showing the stimulus, the offset is 
+            # the first flip after it that is gray again
+            'stimOnset': flipTimes[stimStart] if stimStart < nPresented and self.stimFrames else None,
+            'stimOffset': flipTimes[stimEnd] if stimEnd < nPresented else None,
+        }
+        report['dropped'] = (report['droppedPrestim'] + report['droppedStim']
+                             + report['droppedPoststim'])
+        # Largest delay of a checkerboard reversal from its nominal time (the
+        # onset plus a whole number of refresh periods)
+        reversals = np.flatnonzero(self.reversalFrames)
+        reversals = reversals[stimStart + reversals < nPresented]
+        report['reversalOffset'] = float(np.abs(
+            flipTimes[stimStart + reversals] - flipTimes[stimStart]
+            - reversals * framePeriod).max()) if reversals.size else 0.
+        return report
+
     #---------------------------------------------------------------------------
     #--- INTERNAL FUNCTIONS
     #---------------------------------------------------------------------------
 
-    def _crossCoordinates(self, width=10, stroke=2):
-        # Calculates the coordinates of the 12 vertices of a cross (square form 
-        # factor since witdh = height) given its width and the desired thickness
-        height = width
-        coord = np.zeros([12,2])
-        coord[0,:] = np.array([-(width/2) - stroke, height/2])
-        coord[1,:] = np.array([-(width/2) + stroke, height/2])
-        coord[2,:] = np.array([0, (height/2)*stroke/(width/2)])
-        coord[3,:] = np.array([-coord[1,0], height/2])
-        coord[4,:] = np.array([-coord[0,0], height/2])
-        coord[5,:] = np.array([stroke,0])
-        coord[6,:] = np.array([coord[4,0], -height/2])
-        coord[7,:] = np.array([coord[3,0], -height/2])
-        coord[8,:] = np.array([0, -coord[2,1]])
-        coord[9,:] = np.array([coord[1,0], -height/2])
-        coord[10,:] = np.array([coord[0,0], -height/2])
-        coord[11,:] = np.array([-stroke,0])
-
-        coord[[0,1,3,4],1] += stroke
-        coord[[6,7,9,10],1] -= stroke
-        return coord
-
-    def _triangleCoordinates(self, width=10, stroke=2):
-        # Calulates the coordinates of the 6 vertices of an equilateral triangle. 
-
-        aboveZero = (width/2) / math.cos(math.radians(30))
-
-        coordInt = np.zeros([3,2])
-        coordExt = np.zeros([3,2])
-        coordExt[0,:] = np.array([0, aboveZero+stroke])
-        coordExt[1,:] = np.array([(aboveZero+stroke)* math.cos(math.radians(30)), 
-            -(aboveZero+stroke)* math.sin(math.radians(30))])
-        coordExt[2,:] = np.array([-coordExt[1,0], coordExt[1,1]])
-        coordInt[0,:] = np.array([0, aboveZero-stroke])
-        coordInt[1,:] = np.array([(aboveZero-stroke)* math.cos(math.radians(30)),
-            -(aboveZero-stroke)* math.sin(math.radians(30))])
-        coordInt[2,:] = np.array([-coordInt[1,0], coordInt[1,1]])
-
-        # Center the triangle vertically
-        offsetUp = aboveZero - (width/2)
-        coordExt[:,1] = coordExt[:,1] - offsetUp
-        coordInt[:,1] = coordInt[:,1] - offsetUp
-
-        coord = np.dstack((coordExt, coordInt))
-        return coord
-
-    def _circleCoordinates(self, width=10, stroke=2):
-        # Calulates the coordinates of 2 circles. 100 [x,y] coordinates are calculated
-        # which are usually fine for a relatively smooth circle  
-        coordExt = self._calcEquilateralVertices(100, radius = width/2 + stroke)
-        coordInt = self._calcEquilateralVertices(100, radius = width/2 - stroke)
-
-        coord = np.dstack((coordExt, coordInt))
-        return coord
-
-    def _calcEquilateralVertices(self, edges, radius=5):
-        # Get vertices for an equilateral shape with a given number of sides
-        d = np.pi * 2 / edges
-        vertices = np.asarray(
-            [np.asarray((np.sin(e * d), np.cos(e * d))) * radius
-             for e in range(int(round(edges)))])
-        return vertices
-
-    def _squareCoordinates(self, width=10, stroke=2):
-        # calculates the 8 coordinates of external and internal square
-        coordExt = np.zeros([4,2])
-        coordInt = np.zeros([4,2])
-
-        coordExt[0,:] = [-width/2 - stroke, -width/2 - stroke]
-        coordExt[1,:] = [width/2 + stroke, -width/2 - stroke]
-        coordExt[2,:] = [width/2 + stroke, width/2 + stroke]
-        coordExt[3,:] = [-width/2 - stroke, width/2 + stroke]
-
-        coordInt[0, :] = [-width/2 + stroke, -width/2 + stroke]
-        coordInt[1, :] = [width/2 - stroke, -width/2 + stroke]
-        coordInt[2, :] = [width/2 - stroke, width/2 - stroke]
-        coordInt[3, :] = [-width/2 + stroke, width/2 - stroke]
-
-        coord = np.dstack((coordExt, coordInt))
-        return coord
-
-    def _h_letterCoordinates(self, width=10, stroke=2):
-        # calculates the 12 coordinates of letter H
-        coord = np.zeros([12,2])
-        coord[0,:] = [-width/2 - stroke, -width/2- stroke]
-        coord[1,:] = [-width/2 + stroke, -width/2- stroke]
-        coord[2,:] = [-width/2 + stroke, - stroke]
-        coord[3,:] = [width/2 - stroke, -stroke]
-        coord[4,:] = [width/2 - stroke, -width/2- stroke]
-        coord[5,:] = [width/2 + stroke, -width/2- stroke]
-        coord[6,:] = [width/2 + stroke, width/2+ stroke]
-        coord[7,:] = [width/2 - stroke, width/2+ stroke]
-        coord[8,:] = [width/2 - stroke, stroke]
-        coord[9,:] = [-width/2 + stroke, stroke]
-        coord[10,:] = [-width/2 + stroke, width/2+ stroke]
-        coord[11,:] = [-width/2 - stroke, width/2+ stroke]
-        return coord
-
-    def _v_letterCoordinates(self, width=10, stroke=2):
-        # calculates the 12 coordinates of letter V
-        k = stroke/(2*math.sqrt(2))
-        coord = np.zeros([6,2])
-        coord[0,:] = [0, -width/2 - stroke-k]
-        coord[1,:] = [width/2 + stroke/2, width/2-stroke/2]
-        coord[2,:] = [width/2 - stroke/2, width/2 + stroke/2]
-        coord[3,:] = [0, -width/2 + stroke+k]
-        coord[4,:] = [-width/2 + stroke/2, width/2 + stroke/2]
-        coord[5,:] = [-width/2 - stroke/2, width/2 - stroke/2]
-        return coord
-
-    def _starCoordinates(self, width=10, stroke=2):
-        # calculates the 12 coordinates of letter V
-        k = width/2 + stroke
-        coord = np.zeros([10,2])
-        coord[0,:] = [-0.6*k, -0.9*k]
-        coord[1,:] = [0, -0.4*k]
-        coord[2,:] = [0.6*k, -0.9*k]
-        coord[3,:] = [0.35*k, -0.15*k]
-        coord[4,:] = [0.9*k, 0.25*k]
-        coord[5,:] = [0.2*k, 0.25*k]
-        coord[6,:] = [0, k]
-        coord[7,:] = [-0.2*k, 0.25*k]
-        coord[8,:] = [-0.9*k, 0.25*k]
-        coord[9,:] = [-0.35*k, -0.15*k]
-        return coord
-
-    def _t_letterCoordinates(self, width=10, stroke=2):
-        coord = np.zeros([8,2])
-        coord[0, :] = [-stroke, -width/2 - stroke]
-        coord[1, :] = [stroke, -width/2 - stroke]
-        coord[2, :] = [stroke, width/2 - stroke]
-        coord[3, :] = [width/2 + stroke, width/2 - stroke]
-        coord[4, :] = [width/2 + stroke,width/2 + stroke]
-        coord[5, :] = [-width/2 - stroke, width/2 + stroke]
-        coord[6, :] = [-width/2 - stroke, width/2 - stroke]
-        coord[7, :] = [-stroke, width/2 - stroke]
-        return coord
-
-    def _s_letterCoordinates(self, width=10, stroke=2):
-        coord = np.zeros([12, 2])
-        coord[0,:] = [-width/2 - stroke, -width/2 - stroke]
-        coord[1,:] = [width/2 + stroke, -width/2-stroke]
-        coord[2,:] = [width/2 + stroke, stroke]
-        coord[3,:] = [-width/2 + stroke, stroke]
-        coord[4,:] = [-width/2 + stroke, width/2 - stroke]
-        coord[5,:] = [width/2 + stroke, width/2 - stroke]
-        coord[6,:] = [width/2 + stroke, width/2 + stroke]
-        coord[7,:] = [-width/2 - stroke, width/2 + stroke]
-        coord[8,:] = [-width/2 - stroke, -stroke]
-        coord[9,:] = [width/2 - stroke, -stroke]
-        coord[10, :] = [width/2 - stroke, -width/2 + stroke]
-        coord[11, :] = [- width/2 - stroke, -width/2 + stroke]
-        return coord
-
-    def _w_letterCoordinates(self, width=10, stroke=2):
-        coord = np.zeros([12, 2])
-        coord[0, :] = [-width/4 - stroke, -width/2 - stroke]
-        coord[1, :] = [-width/4 + stroke/2, -width/2 - stroke]
-        coord[2, :] = [0, -stroke]
-        coord[3, :] = [width/4 - stroke/2, -width/2 - stroke]
-        coord[4, :] = [width/4 + stroke, -width/2 - stroke]
-        coord[5, :] = [width/2 + stroke, width/2 + stroke]
-        coord[6, :] = [width/2 - stroke, width/2 + stroke]
-        coord[7, :] = [width/4 - stroke/4, -stroke]
-        coord[8, :] = [0, (3/2)*stroke]
-        coord[9, :] = [-width/4 + stroke/4, -stroke]
-        coord[10, :] = [-width/2 + stroke, width/2 + stroke]
-        coord[11, :] = [-width/2 - stroke, width/2 + stroke]
-        return coord
+    def _reversalSchedule(self, stimFrames, refreshRate, tempFreq):
+        # Calculates the checkerboard phase (0 or 0.5) of each stimulus frame
+        # and a boolean mask of the frames on which the phase has to be updated
+        nReversals = np.floor(np.arange(stimFrames) * tempFreq / refreshRate + 1e-9)
+        phase = (nReversals % 2) * 0.5
+        reversal = np.ones(stimFrames, dtype=bool)
+        reversal[1:] = phase[1:] != phase[:-1]
+        return phase, reversal
+
+class _SharedAperture:
+    # StencilCache interface over a single psychopy Aperture, whose vertices
+    # are replaced for every shape (as in the earlier versions of the trials).
+    # This uses internal functions of the psychopy aperture class since by
+    # default they don't allow updating vertices of an already created aperture.
+    def __init__(self, aperture):
+        self.aperture = aperture
+        self.active = None
+
+    def get(self, key, vertices):
+        if key != self.active:
+            self.aperture._shape.vertices = vertices
+            self.aperture._needVertexUpdate = True
+            self.aperture._reset()
+            self.active = key
+        return self.aperture
+
+    def enable(self, key, vertices):
+        aperture = self.get(key, vertices)
+        aperture.enable()
+        return aperture
+
+    def disable(self):
+        self.aperture.disable()
+        self.active = None
+
+    def invalidate(self, shape=None, width=None, stroke=None):
+        self.active = None
+
+    def __contains__(self, key):
+        return key == self.active
+
+    def __len__(self):
+        return 1
+
+
+class StencilCache:
+    def __init__(self, stimWin):
+        # One psychopy aperture per shape geometry, stored by 
+        # (shape, width, stroke). The vertices of an aperture are tessellated 
+        # only once, when it is created; switching shape then only redraws the
+        # already built aperture into the stencil buffer.
+        self.stimWindow = stimWin
+        self.apertures = {}
+        self.active = None
+
+    def get(self, key, vertices):
+        # Returns the aperture for a geometry, building it on first use
+        if key not in self.apertures:
+            self.apertures[key] = visual.Aperture(
+                self.stimWindow, 
+                shape = np.array(vertices),
+                size = 1)
+            # A new aperture is enabled on creation
+            self.active = key
+        return self.apertures[key]
+
+    def enable(self, key, vertices):
+        # Writes the aperture of the given geometry into the stencil buffer
+        # (always, so that repeating a shape costs the same as switching)
+        aperture = self.get(key, vertices)
+        aperture.enable()
+        self.active = key
+        return aperture
+
+    def disable(self):
+        # Disables the currently active aperture (everything is drawn)
+        if self.active is not None:
+            self.apertures[self.active].disable()
+            self.active = None
+
+    def invalidate(self, shape=None, width=None, stroke=None):
+        # Removes the cached apertures matching the given arguments (None 
+        # matches anything). Has to be called when the width or stroke of a 
+        # shape changes.
+        for key in list(self.apertures):
+            if ((shape is None or key[0] == shape) and
+                (width is None or key[1] == width) and
+                (stroke is None or key[2] == stroke)):
+                if key == self.active:
+                    self.apertures[key].disable()
+                    self.active = None
+                del self.apertures[key]
+
+    def __contains__(self, key):
+        return key in self.apertures
+
+    def __len__(self):
+        return len(self.apertures)
+
+
+class StimulusBank:
+    def __init__(self,
+                stimWin,                    # Psychopy window object
+                pPort = 0,                  # Psychopy parallel port object or Trigger (for triggering)
+                triggerPin = 1,             # If the parallel port is available, which pin to use
+                strobeWord = False,         # See Trial_flickeringShapes
+                strobeSymbolWidth = 0.002,  # See Trial_flickeringShapes
+                strobeCounter = True,       # See Trial_flickeringShapes
+                width = 20,                 # Default width (in degrees) of the shapes
+                stroke = 2,                 # Default thickness of the shapes
+                chkbrdTempFreq = 5,         # Temporal freq of the flickering checkerboard
+                chkbrdSpFreq = 0.08,        # Spatial frequency of the checkerboard
+                chkbrdContrast = 0.8,       # Contrast of the checkerboard
+                prestimFrames = 60,         # Number of 'gray' frames before the stimulus onset
+                stimFrames = 60,            # Number of frames the stimulus is visible
+                postStimFrames = 180,       # Number of post-stimulation 'gray' frames
+                lateFlipTolerance = 1.5,    # See Trial_flickeringShapes
+                refreshRate = None,         # See Trial_flickeringShapes
+                pixPerDeg = None,           # See Trial_flickeringShapes
+                playback = False,           # Present the shapes with pre-rendered frames
+                playbackBudgetMB = 512,     # Memory budget of the pre-rendered frames
+                stencils = None,            # Optional StencilCache shared with other banks
+                ):
+
+        self.stimWindow = stimWin
+        self.stencils = stencils if stencils is not None else StencilCache(stimWin)
+        self.width = width
+        self.stroke = stroke
+        # A single Trigger (and log) for all the trials of the bank
+        self.trigger = asTrigger(pPort, logging.defaultClock.getTime)
+        self.trialParams = dict(
+            pPort = self.trigger or 0,
+            triggerPin = triggerPin,
+            strobeWord = strobeWord,
+            strobeSymbolWidth = strobeSymbolWidth,
+            strobeCounter = strobeCounter,
+            chkbrdTempFreq = chkbrdTempFreq,
+            chkbrdSpFreq = chkbrdSpFreq,
+            chkbrdContrast = chkbrdContrast,
+            prestimFrames = prestimFrames,
+            stimFrames = stimFrames,
+            postStimFrames = postStimFrames,
+            lateFlipTolerance = lateFlipTolerance,
+            refreshRate = refreshRate,
+            pixPerDeg = pixPerDeg,
+        )
+
+        # The only two psychopy stimuli of the bank: a single full field 
+        # checkerboard and a single hole-filling patch shared by all the shapes
+        self.checkerboard = _makeCheckerboard(stimWin, chkbrdSpFreq, chkbrdContrast)
+        self.outBckg = _makeHoleFiller(stimWin, [[0,0]])
+
+        # Optional cache of pre-rendered frames for the playback mode
+        self.frameCache = None
+        if playback:
+            if pixPerDeg is None:
+                pixPerDeg = windowPixPerDegree(stimWin)
+            if pixPerDeg is None:
+                raise NameError("playback needs pixPerDeg or a monitor with distance and width")
+            self.frameCache = FrameCache(stimWin, pixPerDeg, 
+                                         memoryBudgetMB=playbackBudgetMB)
+
+        # Trials are stored by (shape, width, stroke). Declared shapes are
+        # only built on first use (or by warmUp)
+        self.trials = {}
+        self.declared = []
+
+    def declare(self, shape, width=None, stroke=None):
+        # Adds a shape to the bank without building its trial
+        if shape not in SHAPES:
+            raise NameError(f"Shape must be one of {list(SHAPES)}")
+        key = self._key(shape, width, stroke)
+        if key not in self.declared:
+            self.declared.append(key)
+        return key
+
+    def addShape(self, shape, width=None, stroke=None):
+        # Creates (or returns the already existing) trial for a shape. Only the
+        # geometry and the timing buffers are allocated per shape.
+        key = self.declare(shape, width, stroke)
+        if key not in self.trials:
+            self.trials[key] = self._build(key)
+        return self.trials[key]
+
+    def buildTrials(self, workers=1):
+        # Builds the trials of all the declared shapes, on a thread pool if
+        # workers > 1 (the trials create no psychopy object)
+        keys = [key for key in self.declared if key not in self.trials]
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            for key, trial in zip(keys, pool.map(self._build, keys)):
+                self.trials[key] = trial
+
+    def buildStencils(self):
+        # Builds the apertures of all the shapes in the bank, so that no trial
+        # pays for it at its start
+        for trial in self.trials.values():
+            self.stencils.get(trial.stencilKey, trial.outerEdges)
+
+    def prepare(self, trial):
+        # Makes a trial ready to start: builds its aperture, or renders its
+        # frames in playback mode
+        if self.frameCache is None:
+            self.stencils.get(trial.stencilKey, trial.outerEdges)
+        else:
+            self.frameCache.get(trial)
+
+    def warmUp(self, workers=1):
+        # Builds and prepares all the shapes of the bank before the first trial
+        self.buildTrials(workers)
+        if self.frameCache is not None:
+            self.frameCache.warmUp(self.trials.values(), workers)
+        for trial in self.trials.values():
+            self.prepare(trial)
+
+    def setShapeSize(self, width=None, stroke=None):
+        # Changes the default width and/or stroke of the shapes. The trials 
+        # with the old default size are rebuilt and their apertures dropped.
+        oldWidth, oldStroke = self.width, self.stroke
+        if width is not None:
+            self.width = width
+        if stroke is not None:
+            self.stroke = stroke
+        for key in [k for k in self.trials if k[1:] == (oldWidth, oldStroke)]:
+            del self.trials[key]
+            self.stencils.invalidate(*key)
+            self.addShape(key[0])
+        self.declared = [(k[0], self.width, self.stroke) if k[1:] == (oldWidth, oldStroke)
+                         else k for k in self.declared]
+        self.declared = list(dict.fromkeys(self.declared))
+
+    def getTrial(self, shape, width=None, stroke=None):
+        return self.addShape(shape, width=width, stroke=stroke)
+
+    def doTrial(self, shape, width=None, stroke=None, abort=None):
+        return self.getTrial(shape, width=width, stroke=stroke).doTrial(abort=abort)
+
+    @property
+    def shapes(self):
+        # Names of the shapes currently in the bank (built or only declared)
+        return list(dict.fromkeys(key[0] for key in self.declared + list(self.trials)))
+
+    def __getitem__(self, shape):
+        return self.getTrial(shape)
+
+    def __contains__(self, shape):
+        return shape in self.shapes
+
+    def _key(self, shape, width, stroke):
+        return (shape, self.width if width is None else width,
+                self.stroke if stroke is None else stroke)
+
+    def _build(self, key):
+        shape, width, stroke = key
+        return Trial_flickeringShapes(
+            self.stimWindow,
+            self.stencils,
+            shape = shape,
+            width = width,
+            stroke = stroke,
+            checkerboard = self.checkerboard,
+            outBckg = self.outBckg,
+            frameCache = self.frameCache,
+            **self.trialParams)
+
+
+class _TrialAborted(Exception):
+    pass
+
+
+# Event that is never set, used when doTrial is not given an abort event
+_NEVER_ABORT = threading.Event()
+
+
+def windowPixPerDegree(stimWin):
+    # Pixels per degree at the center of the window, from its monitor 
+    # calibration. Returns None if the monitor does not define its size.
+    try:
+        return pixPerDegree(stimWin.monitor.getDistance(), 
+                            stimWin.monitor.getWidth(), stimWin.size[0])
+    except (AttributeError, TypeError, ZeroDivisionError):
+        return None
+
+
+def _makeCheckerboard(stimWin, chkbrdSpFreq, chkbrdContrast):
+    # Generate the full field background checkerboard
+    chkb_texture = np.array([[-1,1],[1,-1]])
+    return visual.GratingStim(
+        stimWin,
+        size = [180,180],           # 180 degrees to get full field coverage
+        sf = chkbrdSpFreq,
+        contrast = chkbrdContrast,
+        ori = 0,
+        tex = chkb_texture,
+        autoDraw = False
+    )
+
+
+def _makeHoleFiller(stimWin, vertices):
+    # Shape object for filling central holes in stimuli shapes like circle 
+    # or triangle with a gray patch
+    return visual.ShapeStim(
+        stimWin,
+        vertices = vertices, 
+        fillColor = [0,0,0],            # gray
+        lineWidth=0
+        )
+
 
 # Example implementation of the three stimuli
 if __name__ == '__main__':
@@ -382,14 +698,10 @@ if __name__ == '__main__':
         allowStencil = True
     )
 
-    # Create a Psychopy aperture object
-    mask = visual.Aperture(stimWin)
-
-    # Create an object for the cross
-    cross = Trial_flickeringShapes(
+    # Create a bank holding all the shapes. The checkerboard is generated only
+    # once and shared by all of them
+    bank = StimulusBank(
         stimWin,
-        mask,
-        shape='cross',
         width = width,
         stroke = stroke,
         chkbrdSpFreq=chkbrdSpFreq,
@@ -398,143 +710,20 @@ if __name__ == '__main__':
         prestimFrames=prestimFrames,
         stimFrames=stimFrames,
         postStimFrames=postStimFrames)
-
-    # Create an object for the circle
-    circle = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='circle',
-        width = width,
-        stroke = stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-    
-    # Create an object for the triangle
-    triangle = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='triangle',
-        width = width,
-        stroke = stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the square
-    square = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='square',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the h_letter
-    h_letter = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='h_letter',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the v_letter
-    v_letter = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='v_letter',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the star
-    star = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='star',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the t_letter
-    t_letter = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='t_letter',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the s_letter
-    s_letter = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='s_letter',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
-
-    # Create an object for the w_letter
-    w_letter = Trial_flickeringShapes(
-        stimWin,
-        mask,
-        shape='w_letter',
-        width=width,
-        stroke=stroke,
-        chkbrdSpFreq=chkbrdSpFreq,
-        chkbrdTempFreq=chkbrdTempFreq,
-        chkbrdContrast=chkbrdContrast,
-        prestimFrames=prestimFrames,
-        stimFrames=stimFrames,
-        postStimFrames=postStimFrames)
+    for shape in ['cross', 'triangle', 'circle', 'square', 'h_letter', 
+                  'v_letter', 'star', 't_letter', 's_letter', 'w_letter']:
+        bank.addShape(shape)
+    bank.warmUp()
 
     # Show trials for each shape
     for _ in range(1):
-        cross.doTrial()
-        #triangle.doTrial()
-        #circle.doTrial()
-        #square.doTrial()
-        #h_letter.doTrial()
-        #v_letter.doTrial()
-        #star.doTrial()
-        #t_letter.doTrial()
-        #s_letter.doTrial()
-        w_letter.doTrial()
-
+        bank.doTrial('cross')
+        #bank.doTrial('triangle')
+        #bank.doTrial('circle')
+        #bank.doTrial('square')
+        #bank.doTrial('h_letter')
+        #bank.doTrial('v_letter')
+        #bank.doTrial('star')
+        #bank.doTrial('t_letter')
+        #bank.doTrial('s_letter')
+        bank.doTrial('w_letter')
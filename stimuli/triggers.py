@@ -0,0 +1,359 @@
+from time import perf_counter, sleep
+import threading
+import numpy as np
+
+"""
+TRIGGERS
+
+Hardware triggers for the recording equipment, sent through a pluggable
+backend. A backend only has to implement setData(value), which sets the 8
+data pins of the port:
+
+    'parallel'  psychopy parallel port (LPT), e.g. address '0xD010'
+    'mock'      in-memory port recording every setData call with its time,
+                to test and benchmark without hardware
+
+Backends are registered by name with the registerTrigger decorator and opened
+with openTrigger(name, **parameters).
+
+A Trigger sends pulses: all the pins go LOW for the pulse width, then the
+pins of the value go HIGH (and stay HIGH until the next pulse). The width is
+timed with a busy-wait on time.perf_counter instead of time.sleep, whose
+resolution on Windows can stretch a 1 ms pulse to ~15 ms.
+
+To lock the trigger to the screen, onFlip() schedules the pulse with the
+callOnFlip method of the psychopy window: it is sent right after the buffer
+swap of the next flip. After that flip, recordFlip(flipTime) stores the offset
+between the flip timestamp and the trigger. onFlip() and wordOnFlip() return
+the scheduled call, whose cancel() drops it if the flip has not happened yet
+(e.g. a trial aborted before its first flip).
+
+Every pulse is logged with its time, measured width and flip offset (see log
+and summary()).
+
+STROBE WORDS
+
+Besides the trigger pulse, the identity of a trial can be sent on the pins as
+a strobe-coded word, so that trials can be labeled from the recorded digital
+channel without the TCP messages. The 7 pins other than the trigger pin carry
+the word (the trigger pin keeps its level): the highest of them is the strobe
+and the other 6 are the data bits of a symbol. Each symbol is first set on the
+data bits with the strobe LOW, then the strobe goes HIGH: a reader samples the
+data bits on the rising edges of the strobe. Since the word is self-clocked,
+only the minimum symbol width matters: the first symbol is set right away
+(e.g. on the flip of the stimulus onset) and the others by a background
+thread, without blocking the stimulation loop. A word is
+
+    [shape ID, trial counter (WORD_COUNTER_SYMBOLS symbols, low first), checksum]
+
+(or [shape ID, checksum] without the counter), where the shape ID is the position of the shape in shapeGeometry.SHAPES and
+the checksum is the XOR of the other symbols. See acquisition/triggerDecoding
+for the decoder.
+
+Run the jitter benchmark (histogram of the pulse widths, compared with
+time.sleep, and with --window of the offsets from the flips) with:
+    python -m stimuli.triggers --backend mock
+    python -m stimuli.triggers --backend parallel --address 0xD010 --window
+"""
+
+# Backend name -> backend class
+TRIGGER_BACKENDS = {}
+
+LOG_DTYPE = np.dtype([('time', 'f8'), ('value', 'u1'), ('width', 'f8'),
+                      ('flipOffset', 'f8')])
+
+SYMBOL_BITS = 6                 # Data bits of every symbol of a strobe word
+WORD_COUNTER_SYMBOLS = 2        # Symbols of the trial counter (counter modulo 2**12)
+
+
+def wordPins(triggerPin=1):
+    # Bits of the port (0-7) used by the strobe words: (data bits, strobe bit)
+    bits = [b for b in range(8) if b != triggerPin - 1]
+    return bits[:SYMBOL_BITS], bits[SYMBOL_BITS]
+
+
+def encodeWord(shapeId, counter=None):
+    # Symbols of the word of a trial (counter None: no trial counter)
+    if not 0 <= shapeId < 2**SYMBOL_BITS:
+        raise ValueError(f'Shape ID must be between 0 and {2**SYMBOL_BITS - 1}')
+    symbols = [shapeId]
+    if counter is not None:
+        counter %= 2**(SYMBOL_BITS * WORD_COUNTER_SYMBOLS)
+        symbols += [(counter >> (SYMBOL_BITS * i)) & (2**SYMBOL_BITS - 1)
+                    for i in range(WORD_COUNTER_SYMBOLS)]
+    checksum = 0
+    for symbol in symbols:
+        checksum ^= symbol
+    return symbols + [checksum]
+
+
+def symbolsToPort(symbols, triggerPin=1):
+    # Port values of the symbols (on the data bits, strobe LOW)
+    dataBits, _ = wordPins(triggerPin)
+    symbols = np.asarray(symbols)
+    values = np.zeros(symbols.shape, int)
+    for i, bit in enumerate(dataBits):
+        values |= ((symbols >> i) & 1) << bit
+    return values
+
+
+def registerTrigger(name):
+    def decorator(cls):
+        TRIGGER_BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def openTrigger(name, **parameters):
+    # Trigger with a new backend of the given type
+    if name not in TRIGGER_BACKENDS:
+        raise ValueError(f"Unknown trigger backend '{name}'. "
+                         f"Available backends: {list(TRIGGER_BACKENDS)}")
+    width = parameters.pop('width', 0.001)
+    return Trigger(TRIGGER_BACKENDS[name](**parameters), width=width)
+
+
+@registerTrigger('parallel')
+class ParallelPortBackend:
+    def __init__(self,
+                address = '0xD010',         # Address of the LPT port
+                port = None,                # Already opened psychopy ParallelPort (optional)
+                ):
+
+        if port is None:
+            from psychopy import parallel
+            port = parallel.ParallelPort(address=address)
+        self.port = port
+
+    def setData(self, value):
+        self.port.setData(value)
+
+
+@registerTrigger('mock')
+class MockBackend:
+    def __init__(self):
+        # (perf_counter time, value) of every setData call
+        self.events = []
+
+    def setData(self, value):
+        self.events.append((perf_counter(), value))
+
+    @property
+    def value(self):
+        return self.events[-1][1] if self.events else 0
+
+
+def asTrigger(pPort, clock=None):
+    # Trigger of a psychopy parallel port object (None if pPort is 0 or None).
+    # Triggers are returned as they are, with the clock set if they have none.
+    if pPort is None or pPort == 0:
+        return None
+    if isinstance(pPort, Trigger):
+        if pPort.clock is None:
+            pPort.clock = clock
+        return pPort
+    return Trigger(ParallelPortBackend(port=pPort), clock=clock)
+
+
+class OnFlipCall:
+    # Call scheduled on the next flip of a window, that can be cancelled
+    # until the flip happens
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def __call__(self):
+        if not self.cancelled:
+            self.called = True
+            self.function(*self.args)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def busyWait(until):
+    # Waits until the perf_counter time until, without sleeping
+    while perf_counter() < until:
+        pass
+
+
+class Trigger:
+    def __init__(self,
+                backend,                    # Trigger backend (see TRIGGER_BACKENDS)
+                width = 0.001,              # Pulse width (seconds)
+                clock = None,               # Clock of the logged times (default perf_counter),
+                                            # e.g. the psychopy clock of the flip timestamps
+                logSize = 1024,             # Initial size of the log
+                ):
+
+        self.backend = backend
+        self.width = width
+        self.clock = clock
+        self.log = np.zeros(logSize, LOG_DTYPE)
+        self.nPulses = 0
+        self.words = []             # (time, symbols) of every strobe word sent
+        self._lock = threading.Lock()
+        self._wordThread = None
+
+    def pulse(self, value):
+        # Sends a pulse: all pins LOW for the pulse width, then value. Returns
+        # the time (clock) of the rising edge.
+        with self._lock:
+            start = perf_counter()
+            self.backend.setData(0)
+            busyWait(start + self.width)
+            self.backend.setData(value)
+            width = perf_counter() - start
+        time = (self.clock or perf_counter)()
+        self._logPulse(time, value, width)
+        return time
+
+    def onFlip(self, win, value):
+        # Schedules a pulse right after the next flip of the psychopy window.
+        # Returns the scheduled OnFlipCall.
+        call = OnFlipCall(self.pulse, value)
+        win.callOnFlip(call)
+        return call
+
+    def sendWord(self, symbols, idle=0, triggerPin=1, symbolWidth=0.002):
+        # Sends a strobe-coded word (see encodeWord) on the pins other than the
+        # trigger pin, which keeps its idle level. The first symbol is set
+        # immediately, the rest of the word by a background thread. Returns
+        # the time (clock) of the first symbol.
+        self.waitWord()
+        _, strobeBit = wordPins(triggerPin)
+        triggerMask = 2**(triggerPin - 1)
+        values = (symbolsToPort(symbols, triggerPin) | (idle & triggerMask)).tolist()
+        with self._lock:
+            self.backend.setData(values[0])
+            time = (self.clock or perf_counter)()
+        self.words.append((time, list(symbols)))
+        self._wordThread = threading.Thread(
+            target=self._strobe, args=(values, 2**strobeBit, idle, symbolWidth),
+            name='TriggerWord', daemon=True)
+        self._wordThread.start()
+        return time
+
+    def wordOnFlip(self, win, symbols, idle=0, triggerPin=1, symbolWidth=0.002):
+        # Schedules a strobe word right after the next flip of the window.
+        # Returns the scheduled OnFlipCall.
+        call = OnFlipCall(self.sendWord, symbols, idle, triggerPin, symbolWidth)
+        win.callOnFlip(call)
+        return call
+
+    def waitWord(self):
+        # Waits until the last strobe word has been sent
+        if self._wordThread is not None:
+            self._wordThread.join()
+            self._wordThread = None
+
+    def recordFlip(self, flipTime):
+        # Stores the offset between the flip timestamp (same clock of the
+        # trigger) and the last pulse
+        if self.nPulses:
+            self.log[self.nPulses - 1]['flipOffset'] = self.lastTime - flipTime
+
+    def setData(self, value):
+        # Sets the pins without a pulse (e.g. the idle level)
+        self.backend.setData(value)
+
+    @property
+    def lastTime(self):
+        return float(self.log[self.nPulses - 1]['time']) if self.nPulses else None
+
+    @property
+    def pulses(self):
+        return self.log[:self.nPulses]
+
+    def summary(self):
+        # Statistics (seconds) of the pulse widths and flip offsets
+        pulses = self.pulses
+        offsets = pulses['flipOffset'][~np.isnan(pulses['flipOffset'])]
+        summary = {'pulses': len(pulses)}
+        for name, values in (('width', pulses['width']), ('flipOffset', offsets)):
+            if len(values):
+                summary[name] = {'mean': float(values.mean()), 'std': float(values.std()),
+                                 'min': float(values.min()), 'max': float(values.max())}
+        return summary
+
+    def _strobe(self, values, strobe, idle, symbolWidth):
+        # Strobe of the symbols (the first is already on the pins), then back
+        # to the idle level. Only the minimum widths matter, so sleep is enough.
+        for i, value in enumerate(values):
+            if i:
+                with self._lock:
+                    self.backend.setData(value)
+            sleep(symbolWidth)
+            with self._lock:
+                self.backend.setData(value | strobe)
+            sleep(symbolWidth)
+        with self._lock:
+            self.backend.setData(idle)
+
+    def _logPulse(self, time, value, width):
+        if self.nPulses == len(self.log):
+            self.log = np.concatenate([self.log, np.zeros(len(self.log), LOG_DTYPE)])
+        self.log[self.nPulses] = (time, value, width, np.nan)
+        self.nPulses += 1
+
+
+def printHistogram(values, bins=20, label='', scale=1e3, unit='ms'):
+    # Text histogram of values
+    counts, edges = np.histogram(np.asarray(values) * scale, bins=bins)
+    print(f'{label} (n={len(values)}, mean {scale*np.mean(values):.3f} {unit}, '
+          f'std {scale*np.std(values):.3f} {unit}, max {scale*np.max(values):.3f} {unit})')
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print(f'  {low:8.3f} - {high:8.3f} {unit} | {"#" * int(50 * count / counts.max()):<50} {count}')
+
+
+def benchmark(trigger, nPulses=1000, interval=0.005, value=1):
+    # Widths of pulses timed with time.sleep and with the busy-wait
+    sleepWidths = np.empty(nPulses)
+    for i in range(nPulses):
+        start = perf_counter()
+        trigger.setData(0)
+        sleep(trigger.width)
+        trigger.setData(value)
+        sleepWidths[i] = perf_counter() - start
+        sleep(interval)
+    for i in range(nPulses):
+        trigger.pulse(value)
+        sleep(interval)
+    return sleepWidths, trigger.pulses['width'][-nPulses:]
+
+
+def flipBenchmark(trigger, win, nFrames=300, value=1):
+    # Offsets between the flips of the psychopy window and the pulses
+    # scheduled on them
+    from psychopy import logging
+    trigger.clock = logging.defaultClock.getTime
+    for _ in range(nFrames):
+        trigger.onFlip(win, value)
+        trigger.recordFlip(win.flip())
+    return trigger.pulses['flipOffset'][-nFrames:]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Jitter benchmark of the trigger pulses')
+    parser.add_argument('--backend', choices=list(TRIGGER_BACKENDS), default='mock')
+    parser.add_argument('--address', default='0xD010', help='address of the parallel port')
+    parser.add_argument('--width', type=float, default=0.001, help='pulse width (s)')
+    parser.add_argument('--pulses', type=int, default=500)
+    parser.add_argument('--window', action='store_true',
+                        help='also measure the offsets from the flips of a psychopy window')
+    args = parser.parse_args()
+
+    parameters = {'address': args.address} if args.backend == 'parallel' else {}
+    trigger = openTrigger(args.backend, width=args.width, **parameters)
+    sleepWidths, busyWidths = benchmark(trigger, args.pulses)
+    printHistogram(sleepWidths, label=f'time.sleep({args.width})')
+    printHistogram(busyWidths, label=f'busy-wait {args.width} s')
+    if args.window:
+        from psychopy import visual
+        win = visual.Window(fullscr=True, color=(0, 0, 0), units='pix')
+        offsets = flipBenchmark(trigger, win, args.pulses)
+        win.close()
+        printHistogram(offsets, label='Flip to trigger offset')
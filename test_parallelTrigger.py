@@ -2,16 +2,30 @@
 TEST SCRIPT
 IT can be usefult to send specific signals to the parallel port to test the 
 proper functioning of triggered equipment.
+
+It sends trigger pulses through the parallel port and prints the histogram of 
+their measured widths, timed with time.sleep and with the busy-wait used by the
+stimulation (see stimuli/triggers). Set testFlips = True to also measure the
+offset between the flips of a psychopy window and the pulses locked to them.
 """
 
-from psychopy import parallel
-import time
+from stimuli.triggers import openTrigger, benchmark, flipBenchmark, printHistogram
+
+address = '0xD010'
+nPulses = 500
+pulseWidth = 0.001
+testFlips = False
+
+trigger = openTrigger('parallel', address = address, width = pulseWidth)
+trigger.setData(int("00000000",2))
 
-pPort = parallel.ParallelPort(address = '0xD010')
-# pPort.setData(int("00000000",2))
+sleepWidths, busyWidths = benchmark(trigger, nPulses)
+printHistogram(sleepWidths, label=f'time.sleep({pulseWidth})')
+printHistogram(busyWidths, label=f'busy-wait {pulseWidth} s')
 
-for _ in range(1):
-    pPort.setData(int("00001000",2))
-    time.sleep(0.1)
-    pPort.setData(int("00000001",2))
-    time.sleep(1)
+if testFlips:
+    from psychopy import visual
+    win = visual.Window(fullscr = True, color = (0, 0, 0), units = 'pix')
+    offsets = flipBenchmark(trigger, win, nPulses)
+    win.close()
+    printHistogram(offsets, label='Flip to trigger offset')
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from analysis.batchDecoding import BatchDecoder, decodeJob, makeDemoSessions, sessionFeatures
+
+
+def test_sessionFeaturesWithoutMetadata(tmp_path):
+    # Trials written with the default metadata=None are stored as null
+    makeDemoSessions(str(tmp_path), nSessions=1, nRepetitions=2, nFrames=20,
+                     frameShape=(32, 32))
+    cacheFolder = tmp_path / 'cache'
+    cacheFolder.mkdir()
+    cacheFile = sessionFeatures(str(tmp_path / 'session1'), ((0, 10), (9, 20)), 4,
+                                None, str(cacheFolder))
+    with np.load(cacheFile) as data:
+        assert len(data['labels']) == 2 * len(set(data['labels'].tolist()))
+
+
+def test_decodeStoreWithoutMetadata(tmp_path):
+    makeDemoSessions(str(tmp_path), nSessions=1, nRepetitions=4, nFrames=20,
+                     frameShape=(32, 32))
+    decoder = BatchDecoder(str(tmp_path), folds=2, workers=1)
+    summary = decoder.summary(decoder.run())
+    assert all(0 <= window['accuracy'] <= 1 for window in summary.values())
+
+
+def test_losoNeedsTwoSessions(tmp_path):
+    makeDemoSessions(str(tmp_path), nSessions=1, nRepetitions=2, nFrames=20,
+                     frameShape=(32, 32))
+    decoder = BatchDecoder(str(tmp_path), workers=1)
+    with pytest.raises(ValueError, match='at least 2 sessions'):
+        decoder.jobs('loso')
+
+
+def test_unpredictedTrialsAreErrors(tmp_path):
+    # Without training trials nothing is predicted: all the test trials are errors
+    makeDemoSessions(str(tmp_path), nSessions=1, nRepetitions=2, nFrames=20,
+                     frameShape=(32, 32))
+    decoder = BatchDecoder(str(tmp_path), workers=1)
+    job = decoder.jobs('kfold')[0]
+    cacheFile, _ = job['test'][0]
+    with np.load(cacheFile) as data:
+        nTrials = len(data['labels'])
+    job = dict(job, train=[(cacheFile, np.zeros(nTrials, bool))],
+               test=[(cacheFile, np.ones(nTrials, bool))])
+    result = decodeJob(job)
+    assert result['unpredicted'] == result['nTest'] == nTrials
+    assert result['accuracy'] == 0
+    summary = decoder.summary([result])
+    assert summary[job['window']]['accuracy'] == 0
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from acquisition.compressedStore import CompressedMovieStore
+from acquisition.movieStore import MovieStore
+
+
+@pytest.mark.parametrize('frames', [slice(None), slice(3, 40, 3), slice(69, 10, -7), 5, -1,
+                                    [0, 33, 69, 2], np.array([[1, 2], [40, 41]]), slice(10, 10)])
+def test_readSameIndexesAsMovieStore(tmp_path, frames):
+    movie = np.random.default_rng(0).integers(0, 4000, (70, 6, 5)).astype(np.uint16)
+    with CompressedMovieStore(str(tmp_path / 'compressed')) as compressed, \
+            MovieStore(str(tmp_path / 'raw')) as raw:
+        compressed.write('cross', movie)
+        raw.write('cross', movie)
+        compressed.flush()
+        expected = np.asarray(raw.read('cross', 0, frames))
+        assert np.array_equal(compressed.read('cross', 0, frames), expected)
+        assert compressed.read('cross', 0, frames).shape == expected.shape
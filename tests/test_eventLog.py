@@ -0,0 +1,30 @@
+import threading
+
+from stimuli.eventLog import EventLog, readEventLog
+
+
+def test_overflowGrowsTheBuffer(tmp_path):
+    # A full buffer is grown, and only flushed by the flush thread
+    path = str(tmp_path / 'session.events')
+    with EventLog(path, capacity=8, flushInterval=60) as eventLog:
+        flushThreads = []
+        flush = eventLog.flush
+
+        def recordedFlush():
+            flushThreads.append(threading.current_thread())
+            flush()
+        eventLog.flush = recordedFlush
+        for i in range(30):
+            eventLog.log('flip', 0, i)
+        eventLog.logMany('flip', range(100), 1)
+        assert eventLog.overflows > 0
+        assert threading.current_thread() not in flushThreads
+    events = readEventLog(path, split=True)
+    assert len(events['flip']) == 130
+
+
+def test_echoFullText(tmp_path, capsys):
+    text = 'SCHEDULE not applied: Unknown shape in schedule: pentagon_large'
+    with EventLog(str(tmp_path / 'session.events'), echo=('warning',)) as eventLog:
+        eventLog.log('warning', text=text)
+    assert f'WARNING: {text}' in capsys.readouterr().out
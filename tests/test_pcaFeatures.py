@@ -0,0 +1,52 @@
+import numpy as np
+
+from analysis.pcaFeatures import IncrementalPCA
+
+
+def features(seed=0, nTrials=300, nFeatures=50):
+    # Trials with a decaying spectrum (-15% per component), in random directions
+    rng = np.random.default_rng(seed)
+    basis, _ = np.linalg.qr(rng.normal(size=(nFeatures, nFeatures)))
+    spectrum = 3 * 0.85**np.arange(nFeatures)
+    return (rng.normal(size=(nTrials, nFeatures)) * spectrum) @ basis.T
+
+
+def exactPCA(x, k):
+    _, s, vt = np.linalg.svd(x - x.mean(axis=0), full_matrices=False)
+    return s[:k], vt[:k]
+
+
+def test_incrementalMatchesExactSVD():
+    x = features()
+    s, vt = exactPCA(x, 10)
+    pca = IncrementalPCA(nComponents=10).fit(x, batchSize=37)
+    assert np.allclose(pca.mean, x.mean(axis=0))
+    assert np.abs(pca.singularValues - s).max() < 1e-3 * s[0]
+    assert np.abs(np.sum(pca.components * vt, axis=1)).min() > 0.999
+
+
+def test_oversamplingReducesTheError():
+    x = features()
+    s, vt = exactPCA(x, 10)
+    errors = [np.abs(IncrementalPCA(10, oversampling=n).fit(x, 37).singularValues - s).max()
+              for n in (0, 10)]
+    assert errors[1] < errors[0]
+
+
+def test_exactWithoutTruncation():
+    # Keeping as many components as features, nothing is ever dropped
+    x = features()
+    s, vt = exactPCA(x, 10)
+    pca = IncrementalPCA(nComponents=10, oversampling=40).fit(x, batchSize=37)
+    assert np.allclose(pca.singularValues, s)
+    assert np.allclose(np.abs(np.sum(pca.components * vt, axis=1)), 1)
+
+
+def test_saveAndContinueFit(tmp_path):
+    x = features()
+    pca = IncrementalPCA(nComponents=10).fit(x[:150], batchSize=37)
+    path = str(tmp_path / 'pca.npz')
+    pca.save(path)
+    loaded = IncrementalPCA.load(path).fit(x[150:], batchSize=37)
+    pca.fit(x[150:], batchSize=37)
+    assert np.allclose(loaded.transform(x[:5]), pca.transform(x[:5]))
@@ -0,0 +1,23 @@
+import pytest
+
+from stimuli.sessionConfig import DEFAULT_CONFIG, loadConfig, mergeConfig
+
+
+@pytest.mark.parametrize('overrides', [
+    {'stimuli': 3},
+    {'stimuli': {'shapes': 3}},
+    {'stimuli': {'stimFrames': '60'}},
+    {'stimuli': {'playback': 1}},
+    {'warmUp': {'workers': '4'}},
+    {'monitor': {'resolution': [1920, 1080.5]}},
+])
+def test_invalidValuesAreRejected(overrides):
+    with pytest.raises(ValueError):
+        mergeConfig(DEFAULT_CONFIG, overrides)
+
+
+def test_validValues():
+    config = loadConfig({'stimuli': {'width': 12.5, 'chkbrdSpFreq': 1, 'shapes': ['star']}})
+    assert config['stimuli']['width'] == 12.5
+    assert config['stimuli']['shapes'] == ['star']
+    assert config['warmUp'] == DEFAULT_CONFIG['warmUp']
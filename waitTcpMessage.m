@@ -0,0 +1,46 @@
+function [type, trial, payload] = waitTcpMessage(tcp, msgType, msgTrial, timeout)
+% [type, trial, payload] = waitTcpMessage(tcp, msgType, msgTrial, timeout)
+%
+% Reads the messages of the stimulation client until the one of the given
+% type and trial arrives, or until timeout seconds have passed. Messages of
+% other types or trials (e.g. the late ACK of a previous trial) are skipped,
+% so that a single timeout does not shift all the following trials. An ERROR
+% of the client for the trial ends the wait.
+%
+% INPUT
+% tcp: tcpip object connected to the client
+% msgType: type of the message to wait for (e.g. 'ACK')
+% msgTrial: index of the trial the message has to refer to
+% timeout: overall deadline in seconds
+%
+% OUTPUT
+% type, trial, payload: the message (see readTcpMessage), type is empty if
+% it did not arrive before the deadline or the client reported an ERROR
+%
+% see also readTcpMessage
+
+waitStart = tic;
+readTimeout = tcp.Timeout;
+type = '';
+trial = 0;
+payload = '';
+while toc(waitStart) < timeout
+    tcp.Timeout = max(timeout - toc(waitStart), 0.01);
+    [t, n, p] = readTcpMessage(tcp);
+    if isempty(t)
+        continue
+    end
+    if strcmp(t, msgType) && n == msgTrial
+        type = t;
+        trial = n;
+        payload = p;
+        break
+    end
+    if strcmp(t, 'ERROR') && n == msgTrial
+        % The client could not run the command of this trial
+        fprintf('(ERROR %s) ', p)
+        break
+    end
+    fprintf('(skipped %s %u) ', t, n)
+end
+tcp.Timeout = readTimeout;